@@ -0,0 +1,20 @@
+"""
+Benchmarks of the simulation kernels, the sorts and the curvature flow smoothing.
+
+Run from the src directory with `python -m benchmarks.run`, see run.py.
+"""
+import numpy as np
+
+
+def summarize(times):
+    """
+    Summary statistics of a list of times.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    return {
+        'count': len(times),
+        'mean': float(times.mean()),
+        'median': float(np.median(times)),
+        'min': float(times.min()),
+        'max': float(times.max()),
+    }
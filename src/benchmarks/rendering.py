@@ -0,0 +1,79 @@
+"""
+Cost of a curvatureFlow iteration (see fluid_rendering/curvature_flow.cl) at several resolutions.
+Runs on plain OpenCL images, no OpenGL needed.
+"""
+import os
+
+import numpy as np
+import pyopencl as cl
+
+from sph.program_cache import build_program
+from . import summarize
+
+
+def build_curvature_flow(ctx, size, projection_matrix):
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+    with open('%s/../fluid_rendering/curvature_flow.cl' % cur_dir) as f:
+        from mako.template import Template
+        code = str(Template(f.read()).render(
+            window_size=size,
+            dt=0.005,
+            projection_matrix=projection_matrix
+            ))
+    return build_program(ctx, code)
+
+
+def test_depth(size, fill=0.5):
+    """
+    Depth image of a noisy sphere covering about fill of the image (0 = empty pixel, like the depth target).
+    """
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width]
+    r2 = ((x - width/2.)**2 + (y - height/2.)**2) / (fill * width * height / np.pi)
+    depth = np.where(r2 < 1, -20 + 2*np.sqrt(np.maximum(0, 1 - r2)), 0)
+    depth += np.where(r2 < 1, 0.01 * np.random.randn(height, width), 0)
+    return depth.astype(np.float32)
+
+
+def benchmark_curvature_flow(ctx, queue, size, iterations=20):
+    """
+    Profiles iterations curvatureFlow iterations (each one kernel launch) on a size = (width, height) depth image.
+    queue must have profiling enabled.
+    """
+    if not all(device.image_support for device in ctx.devices):
+        return None
+
+    projection_matrix = np.array([[1.5, 0, 0, 0],
+                                  [0, 1.5 * size[0] / float(size[1]), 0, 0],
+                                  [0, 0, -1, -0.2],
+                                  [0, 0, -1, 0]])
+    prg = build_curvature_flow(ctx, size, projection_matrix)
+
+    mf = cl.mem_flags
+    image_format = cl.ImageFormat(cl.channel_order.R, cl.channel_type.FLOAT)
+    depth = cl.Image(ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, image_format, shape=size, hostbuf=test_depth(size))
+    depth2 = cl.Image(ctx, mf.READ_WRITE, image_format, shape=size)
+
+    kernel = cl.Kernel(prg, 'curvatureFlow')
+    kernel.set_args(depth, depth2, np.float32(0.005), np.float32(10))
+    # warm up
+    cl.enqueue_nd_range_kernel(queue, kernel, size, None)
+    queue.finish()
+
+    events = []
+    for i in range(iterations):
+        # alternate between reading depth and depth2
+        kernel.set_arg(0, depth)
+        kernel.set_arg(1, depth2)
+        events.append(cl.enqueue_nd_range_kernel(queue, kernel, size, None))
+        depth, depth2 = depth2, depth
+    queue.finish()
+    times = [1e-6 * (event.profile.end - event.profile.start) for event in events]
+
+    return {
+        'width': size[0],
+        'height': size[1],
+        'iterations': iterations,
+        'ms_per_iteration': summarize(times),
+        'mpixels_per_second': size[0] * size[1] / (1000. * np.median(times)),
+    }
@@ -0,0 +1,121 @@
+"""
+Runs the benchmarks and writes the results to a JSON file:
+
+    python -m benchmarks.run --device cpu --output benchmarks.json
+
+- simulator: per-kernel times of FluidSimulator steps for each N and box size,
+- sorts: RadixSort vs BitonicSort throughput,
+- curvature_flow: cost of a curvatureFlow iteration at several resolutions.
+
+The results include the git commit, so that runs of different commits can be compared.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pyopencl as cl
+
+from sph import DevicePolicy, FluidSimulator
+from sph.device import device_info
+from .simulator import benchmark_simulator
+from .sorts import benchmark_sorts
+from .rendering import benchmark_curvature_flow
+
+suites = ('simulator', 'sorts', 'curvature_flow')
+
+
+def parse_size(s):
+    width, height = s.lower().split('x')
+    return int(width), int(height)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                     description='Benchmark the simulator, the sorts and the curvature flow smoothing.')
+    parser.add_argument('--device', default=None, metavar='POLICY',
+                        help="OpenCL device policy, e.g. 'cpu' (default: $PYSPH_DEVICE, or a GPU with fallback to a CPU device).")
+    parser.add_argument('--suites', nargs='+', choices=suites, default=list(suites),
+                        help='benchmarks to run (default: all).')
+    parser.add_argument('-N', type=int, nargs='+', default=[2000, 8000, 32000],
+                        help='numbers of particles for the simulator benchmark (default: 2000 8000 32000).')
+    parser.add_argument('--boxsizes', nargs='+', default=['10,10,10', '20,10,10'], metavar='X,Y,Z',
+                        help='box sizes for the simulator benchmark (default: 10,10,10 20,10,10).')
+    parser.add_argument('--hash-modes', nargs='+', choices=FluidSimulator.hash_modes, default=list(FluidSimulator.hash_modes),
+                        help='grid hashes to compare in the simulator benchmark (default: all).')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='measured simulation steps (default: 20).')
+    parser.add_argument('--sort-sizes', type=int, nargs='+', default=[2**14, 2**16, 2**18, 2**20],
+                        help='numbers of keys for the sort benchmark (default: 2^14 2^16 2^18 2^20).')
+    parser.add_argument('--resolutions', type=parse_size, nargs='+', default=[(640, 360), (1280, 720), (1920, 1080)],
+                        metavar='WxH', help='resolutions for the curvature flow benchmark (default: 640x360 1280x720 1920x1080).')
+    parser.add_argument('--output', default='benchmarks.json',
+                        help='JSON file to write the results to (default: benchmarks.json).')
+    return parser.parse_args(argv)
+
+
+def git_commit():
+    """
+    The current git commit of the source tree, None if unknown.
+    """
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=cur_dir, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    policy = DevicePolicy.from_string(args.device) if args.device else DevicePolicy.from_env()
+    device = policy.pick()
+
+    results = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'pyopencl': cl.VERSION_TEXT,
+        'device': device_info(device),
+    }
+
+    if 'simulator' in args.suites:
+        results['simulator'] = []
+        for boxsize in args.boxsizes:
+            boxsize = tuple(float(b) for b in boxsize.split(','))
+            for N in args.N:
+                for hash_mode in args.hash_modes:
+                    result = benchmark_simulator(N, boxsize, device_policy=policy, steps=args.steps, hash_mode=hash_mode)
+                    print('simulator N=%i boxsize=%s hash=%s: %.2f ms/step' % (
+                            result['N'], boxsize, hash_mode, result['wall_ms_per_step']))
+                    results['simulator'].append(result)
+
+    if 'sorts' in args.suites or 'curvature_flow' in args.suites:
+        ctx = cl.Context(devices=[device])
+        queue = cl.CommandQueue(ctx, device=device, properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+    if 'sorts' in args.suites:
+        results['sorts'] = []
+        for N in args.sort_sizes:
+            for result in benchmark_sorts(ctx, queue, N):
+                print('%s N=%i: %.1f Mkeys/s' % (result['sort'], N, result['mkeys_per_second']))
+                results['sorts'].append(result)
+
+    if 'curvature_flow' in args.suites:
+        results['curvature_flow'] = []
+        for size in args.resolutions:
+            result = benchmark_curvature_flow(ctx, queue, size)
+            if result is None:
+                print('curvature flow: device has no image support, skipped')
+                break
+            print('curvatureFlow %ix%i: %.3f ms/iteration' % (size[0], size[1], result['ms_per_iteration']['median']))
+            results['curvature_flow'].append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results written to %s' % args.output)
+
+if __name__ == '__main__':
+    main()
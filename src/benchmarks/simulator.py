@@ -0,0 +1,34 @@
+"""
+Per-kernel timings of FluidSimulator steps, using OpenCL profiling events (FluidSimulator.stats()).
+"""
+import time
+
+from sph import FluidSimulator
+
+
+def benchmark_simulator(N, boxsize, device_policy=None, steps=20, warmup=5, hash_mode='linear'):
+    """
+    Runs warmup steps, then measures steps simulation steps: wall clock time of
+    FluidSimulator.advance() and per-kernel device times.
+    """
+    fs = FluidSimulator(N, boxsize, device_policy=device_policy, profile=True, hash_mode=hash_mode)
+    fs.cl_init()
+
+    fs.advance(warmup)
+    fs.reset_stats()
+    t = time.time()
+    fs.advance(steps)
+    wall_ms = 1000 * (time.time() - t) / steps
+
+    kernels = fs.stats()
+    return {
+        'N': fs.N,
+        'boxsize': list(boxsize),
+        'cells': fs.total_number_of_cells,
+        'hashes': fs.number_of_hashes,
+        'hash_mode': hash_mode,
+        'steps': steps,
+        'wall_ms_per_step': wall_ms,
+        'kernel_ms_per_step': sum(kernel['total'] for kernel in kernels.values()) / steps,
+        'kernels': kernels,
+    }
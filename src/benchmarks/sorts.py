@@ -0,0 +1,61 @@
+"""
+Throughput of RadixSort and BitonicSort on random uint32 key/value pairs.
+"""
+import time
+
+import numpy as np
+import pyopencl as cl
+
+from sph.radix_sort import RadixSort
+from sph.bitonic_sort.bitonic_sort import BitonicSort
+from . import summarize
+
+
+def time_sort(queue, sort, keys, vals, d_keys, d_vals, repeats):
+    """
+    Wall clock times (ms) of repeats sorts of keys/vals, restoring the unsorted input before each sort.
+    """
+    times = []
+    for i in range(repeats):
+        cl.enqueue_copy(queue, d_keys, keys)
+        cl.enqueue_copy(queue, d_vals, vals)
+        queue.finish()
+        t = time.time()
+        sort()
+        queue.finish()
+        times.append(1000 * (time.time() - t))
+    return times
+
+
+def benchmark_sorts(ctx, queue, N, key_bits=32, repeats=5):
+    """
+    Sorts N random keys (key_bits bits wide) with RadixSort and, if N is a power of two, BitonicSort.
+    The first sort of each is a warm up and not counted.
+    """
+    mf = cl.mem_flags
+    keys = np.random.randint(0, 2**key_bits, size=N, dtype=np.uint64).astype(np.uint32)
+    vals = np.arange(N, dtype=np.uint32)
+    d_keys = cl.Buffer(ctx, mf.READ_WRITE, size=keys.nbytes)
+    d_vals = cl.Buffer(ctx, mf.READ_WRITE, size=vals.nbytes)
+
+    results = []
+
+    radix_sort = RadixSort(ctx, queue, N, np.uint32)
+    sort = lambda: radix_sort.sort(d_keys, d_vals, N, key_bits=key_bits)
+    times = time_sort(queue, sort, keys, vals, d_keys, d_vals, repeats + 1)[1:]
+    results.append(('RadixSort', times))
+
+    # bitonic sort only supports power of two lengths.
+    if N & (N - 1) == 0:
+        bitonic_sort = BitonicSort(ctx, queue)
+        sort = lambda: bitonic_sort.sort_in_place(d_keys, d_vals, N, 1)
+        times = time_sort(queue, sort, keys, vals, d_keys, d_vals, repeats + 1)[1:]
+        results.append(('BitonicSort', times))
+
+    return [{
+        'sort': name,
+        'N': N,
+        'key_bits': key_bits,
+        'ms': summarize(times),
+        'mkeys_per_second': N / (1000. * np.median(times)),
+    } for name, times in results]
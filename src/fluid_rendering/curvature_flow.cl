@@ -211,3 +211,57 @@ __kernel void curvatureFlow(__read_only image2d_t depth_in, __write_only image2d
   
 }
 
+
+// Smoothing at a reduced resolution: each pixel of depth_out is the mean of the non-empty
+// (non-zero) pixels of the corresponding factor x factor block of depth_in.
+__kernel void downsampleDepth(__read_only image2d_t depth_in, __write_only image2d_t depth_out, const int factor)  {
+  int2 coords = (int2)(get_global_id(0), get_global_id(1));
+  if(coords.x >= get_image_width(depth_out) || coords.y >= get_image_height(depth_out)) return;
+
+  float sum = 0;
+  int n = 0;
+  for(int dy = 0; dy < factor; dy++) {
+    for(int dx = 0; dx < factor; dx++) {
+      float d = DEPTH(coords*factor + (int2)(dx, dy));
+      if(d != 0) {
+	sum += d;
+	n++;
+      }
+    }
+  }
+  write_imagef(depth_out, coords, (float4)(n ? sum/n : 0, 0, 0, 1));
+}
+
+// Joint bilateral upsampling of the smoothed low resolution depth (depth_low) to the resolution of depth_in.
+// The full resolution depth guides the interpolation: the bilinear weights of the low resolution samples
+// are multiplied by exp(-((d_low-d)/sigma)^2), so that samples from across a depth edge do not bleed in.
+// Empty pixels stay empty, the silhouette is the one of the full resolution depth.
+__kernel void upsampleDepth(__read_only image2d_t depth_in, __read_only image2d_t depth_low, __write_only image2d_t depth_out, const int factor, const float sigma)  {
+  int2 coords = (int2)(get_global_id(0), get_global_id(1));
+  if(coords.x >= get_image_width(depth_out) || coords.y >= get_image_height(depth_out)) return;
+
+  float depth = DEPTH(coords);
+  if(depth == 0) {
+    write_imagef(depth_out, coords, (float4)(depth, 0, 0, 1));
+    return;
+  }
+
+  // position in the low resolution image, relative to the texel centers
+  float2 p = ((float2)(coords.x, coords.y) + .5f)/factor - .5f;
+  float2 p0 = floor(p);
+  float2 f = p - p0;
+  int2 base = (int2)((int)p0.x, (int)p0.y);
+
+  float sum = 0, weights = 0;
+  for(int j = 0; j < 2; j++) {
+    for(int i = 0; i < 2; i++) {
+      float d = read_imagef(depth_low, smp, base + (int2)(i, j)).x;
+      if(d == 0) continue;
+      float dz = (d - depth)/sigma;
+      float weight = (i ? f.x : 1-f.x) * (j ? f.y : 1-f.y) * exp(-dz*dz);
+      sum += weight*d;
+      weights += weight;
+    }
+  }
+  write_imagef(depth_out, coords, (float4)(weights > 1e-6f ? sum/weights : depth, 0, 0, 1));
+}
@@ -2,9 +2,10 @@ from OpenGL.GL import *
 import pyopencl as cl
 
 import numpy as np
-import os
+import os, time
 
 from cg import CGDefaultShader, cg_gl_platform, cg_gl
+from sph.program_cache import build_program
 from . import simple
 
 from .blur_shader import BlurShader
@@ -55,13 +56,22 @@ class FluidRenderer(object):
     # can be changed on the fly at each framerate if desired.
     smoothing_dt = 0.005
 
+    # if set, smoothing_iterations is adapted after each frame so that the smoothing
+    # takes about this many milliseconds (e.g. 4 to leave room for the rest of a 60 fps frame).
+    smoothing_budget_ms = None
+    smoothing_iterations_range = (1, 100)
+
     render_mean_curvature = False
     
-    def __init__(self, window_size, fluid_simulator, projection_matrix):
+    def __init__(self, window_size, fluid_simulator, projection_matrix, smoothing_downsample=1):
         """
         projection_matrix: a 4x4 numpy array describing the projection matrix in use.
+        smoothing_downsample: if larger than 1, the depth is smoothed at 1/smoothing_downsample of the
+        window resolution and upsampled (bilateral) back into depth_target. Can be set back to 1 later on
+        to smooth at full resolution again.
         """
         self.window_size = window_size
+        self.smoothing_downsample = smoothing_downsample
         self.fluid_simulator = fluid_simulator
         self.projection_matrix = projection_matrix
 
@@ -70,6 +80,8 @@ class FluidRenderer(object):
 
 
         radius = fluid_simulator.h * 0.25
+        # bilateral upsampling: low resolution depths differing by more than about this are ignored (edges).
+        self.upsample_depth_sigma = 4 * radius
 
         # blur parameters tuned to this example. should be generalized.
         # should make the radius/sigma dependent on the largest screen-space particle size
@@ -97,11 +109,8 @@ class FluidRenderer(object):
         self.cl_init()
 
     def cl_pick_device(self):
-        for platform in cl.get_platforms():
-            for device in platform.get_devices():
-                if device.type == cl.device_type.GPU:
-                    return device
-        raise Exception("No suitable device found")
+        # render with the device the simulation runs on (see sph.DevicePolicy).
+        return self.fluid_simulator.cl_pick_device()
 
     def cl_init_context(self):
         """
@@ -120,35 +129,55 @@ class FluidRenderer(object):
             self.ctx = cl.Context(properties=[(cl.context_properties.PLATFORM, platform)] + additional_properties, devices=[device])
         self.queue = cl.CommandQueue(self.ctx, device=device, properties=cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE)
 
-    def cl_init(self):
-        self.cl_init_context()
-
+    def cl_build_program(self, window_size):
+        """
+        Build the curvature flow program for images of size window_size.
+        """
         cur_dir = os.path.dirname(os.path.abspath(__file__))
         with open('%s/curvature_flow.cl' % cur_dir) as f:
             from mako.template import Template
             code = str(Template(f.read()).render(
-                window_size=self.window_size,
+                window_size=window_size,
                 # smoothing timestep
                 dt=self.smoothing_dt,
                 projection_matrix=self.projection_matrix
                 ))
-            self.prg = cl.Program(self.ctx, code).build()
+            return build_program(self.ctx, code)
+
+    def cl_init(self):
+        self.cl_init_context()
+
+        self.prg = self.cl_build_program(self.window_size)
             
         self.depth_cl = cl.GLTexture(self.ctx, cl.mem_flags.READ_WRITE, GL_TEXTURE_2D, 0, self.depth_target.texture, 2)
         self.depth2_cl = cl.GLTexture(self.ctx, cl.mem_flags.READ_WRITE, GL_TEXTURE_2D, 0, self.depth2_target.texture, 2)
         self.test_cl = cl.GLTexture(self.ctx, cl.mem_flags.READ_WRITE, GL_TEXTURE_2D, 0, self.test_target.texture, 2)
         self.cl_gl_objects = [self.depth_cl, self.depth2_cl, self.test_cl]
 
-        # local work size: (lw, lh) where lw (lh) must divide window width (height).
-        lw, lh = 16, 16
+        self.cl_local_size = self.cl_pick_local_size(self.window_size)
+
+        if self.smoothing_downsample > 1:
+            # the low resolution depth images are only used by opencl, no need for gl textures.
+            factor = self.smoothing_downsample
+            self.low_size = (-(-self.window_size[0] // factor), -(-self.window_size[1] // factor))
+            self.prg_low = self.cl_build_program(self.low_size)
+            image_format = cl.ImageFormat(cl.channel_order.R, cl.channel_type.FLOAT)
+            self.depth_low_cl = cl.Image(self.ctx, cl.mem_flags.READ_WRITE, image_format, shape=self.low_size)
+            self.depth_low2_cl = cl.Image(self.ctx, cl.mem_flags.READ_WRITE, image_format, shape=self.low_size)
+            self.cl_low_local_size = self.cl_pick_local_size(self.low_size)
+
+    def cl_pick_local_size(self, size):
+        """
+        Local work size (lw, lh) for images of the given size. lw (lh) must divide the width (height),
+        so it is the largest of 16, 8, 4, 2, 1 that does.
+        """
         local_size_limit = min(device.max_work_group_size for device in self.ctx.devices)
+        lw, lh = [max(l for l in (16, 8, 4, 2, 1) if length % l == 0) for length in size]
         if lw*lh > local_size_limit:
             import sys
             sys.stderr.write('Warning: work group size too large, try reducing it. Until then, we are letting OpenCL implementation can pick something.\n')
-            self.cl_local_size = None
-        else:
-            assert self.window_size[0] % lw == 0 and self.window_size[1] % lh == 0, "Window width (height) must be divisible by %i (%i)" % (lw, lh)
-            self.cl_local_size = (lw, lh)
+            return None
+        return (lw, lh)
 
     def render(self):
         render_mode = self.render_mode
@@ -230,16 +259,7 @@ class FluidRenderer(object):
 
         # smooth depth texture
         if self.smooth_depth:
-            cl.enqueue_acquire_gl_objects(self.queue, self.cl_gl_objects)
-            local_size = self.cl_local_size
-            for i in range(self.smoothing_iterations):
-                # alternate between writing to depth2_target and depth1_target
-                # (can't read from and write to the same texture at the same time).
-                args = (np.float32(self.smoothing_dt),
-                        np.float32(self.smoothing_z_contrib),)
-                self.prg.curvatureFlow(self.queue, self.window_size, local_size, self.depth_cl, self.depth2_cl, *args).wait()
-                self.prg.curvatureFlow(self.queue, self.window_size, local_size, self.depth2_cl, self.depth_cl, *args).wait()
-            cl.enqueue_release_gl_objects(self.queue, self.cl_gl_objects)
+            self.smooth_depth_texture()
 
 
         if self.render_mean_curvature:
@@ -274,6 +294,54 @@ class FluidRenderer(object):
 
         glDisable(GL_BLEND)
 
+    def smooth_depth_texture(self):
+        """
+        Smooth the depth texture with curvature flow, at full or reduced resolution (see smoothing_downsample).
+        If smoothing_budget_ms is set, adapts smoothing_iterations to the time this took.
+        """
+        queue = self.queue
+        t = time.time()
+        event = cl.enqueue_acquire_gl_objects(queue, self.cl_gl_objects)
+
+        args = (np.float32(self.smoothing_dt),
+                np.float32(self.smoothing_z_contrib),)
+        factor = self.smoothing_downsample
+        if factor > 1:
+            prg, size, local_size = self.prg_low, self.low_size, self.cl_low_local_size
+            depth, depth2 = self.depth_low_cl, self.depth_low2_cl
+            event = self.prg.downsampleDepth(queue, size, None, self.depth_cl, depth, np.int32(factor), wait_for=[event])
+        else:
+            prg, size, local_size = self.prg, self.window_size, self.cl_local_size
+            depth, depth2 = self.depth_cl, self.depth2_cl
+
+        for i in range(self.smoothing_iterations):
+            # alternate between writing to depth2 and depth
+            # (can't read from and write to the same texture at the same time).
+            event = prg.curvatureFlow(queue, size, local_size, depth, depth2, *args, wait_for=[event])
+            event = prg.curvatureFlow(queue, size, local_size, depth2, depth, *args, wait_for=[event])
+
+        if factor > 1:
+            # upsample into depth2_target, then copy back into depth_target.
+            event = self.prg.upsampleDepth(queue, self.window_size, None, self.depth_cl, depth, self.depth2_cl,
+                                           np.int32(factor), np.float32(self.upsample_depth_sigma), wait_for=[event])
+            event = cl.enqueue_copy(queue, self.depth_cl, self.depth2_cl, src_origin=(0, 0), dest_origin=(0, 0),
+                                    region=self.window_size, wait_for=[event])
+
+        cl.enqueue_release_gl_objects(queue, self.cl_gl_objects, wait_for=[event]).wait()
+
+        if self.smoothing_budget_ms is not None:
+            self.adapt_smoothing_iterations(1000 * (time.time() - t))
+
+    def adapt_smoothing_iterations(self, elapsed_ms):
+        """
+        Scale smoothing_iterations so that the next frame's smoothing takes about smoothing_budget_ms.
+        Only moves halfway to the estimate, so that timing noise does not make the iterations jump around.
+        """
+        iterations = max(1, self.smoothing_iterations)
+        estimate = iterations * self.smoothing_budget_ms / max(elapsed_ms, 1e-3)
+        low, high = self.smoothing_iterations_range
+        self.smoothing_iterations = int(max(low, min(high, round(0.5 * (iterations + estimate)))))
+
     def render_texture(self, texture, stage=0):
         """
         Render a full screen texture.
@@ -5,12 +5,17 @@ from main_window import MainWindow
 
 if __name__ == "__main__":
     if '--help' in sys.argv:
-        print("Run with: python main.py [--disable-advanced-rendering] [--cg-arb] [--cg-glsl] N")
+        print("Run with: python main.py [--disable-advanced-rendering] [--half-res-smoothing] [--adaptive-smoothing] [--cg-arb] [--cg-glsl] N")
+        print("   or: python main.py [options] --replay TRAJECTORY")
         print("\t--disable-advanced-rendering: disables the use of Cg shaders")
+        print("\t--half-res-smoothing: smooth the fluid surface at half the window resolution (faster)")
+        print("\t--adaptive-smoothing: adapt the number of smoothing iterations to a per-frame time budget")
         print("\tChange the vertex/fragment profiles that Cg will use:")
         print("\t\t--cg-arb:\tuse arb profiles.")
         print("\t\t--cg-glsl:\tuse glsl profiles.")
         print("\tN: number of particles. Start with 8000 and slowly increase")
+        print("\t--replay TRAJECTORY: play back a trajectory recorded with python -m sph.run --trajectory-every K")
+        print("\t\t(trajectory.npy or trajectory.sphq) instead of simulating. R restarts the playback.")
         sys.exit(0)
 
     def excepthook(type, value, traceback):
@@ -23,6 +28,17 @@ if __name__ == "__main__":
     
     app = QtGui.QApplication(sys.argv)
 
+    if '--replay' in sys.argv:
+        # N is taken from the trajectory.
+        try:
+            replay = sys.argv[sys.argv.index('--replay') + 1]
+        except IndexError:
+            print("Missing trajectory file. Use 'python main.py --replay run_8000/trajectory.npy', for example")
+            exit(1)
+        window = MainWindow(None, replay=replay)
+        window.show()
+        sys.exit(app.exec_())
+
     # number of particles (last argument in command line)
     try:
         N = int(sys.argv[-1]) #20**3
@@ -7,7 +7,7 @@ from PySide import QtCore,QtGui
 from ui import Ui_MainWindow
 
 class MainWindow(QtGui.QMainWindow):
-    def __init__(self, N):
+    def __init__(self, N, replay=None):
         super(MainWindow, self).__init__()
 
         # This is always the same
@@ -19,7 +19,10 @@ class MainWindow(QtGui.QMainWindow):
         
         from sph_demo import SPHDemo
         enable_advanced_rendering = not '--disable-advanced-rendering' in sys.argv
-        self.sph_demo = SPHDemo(N, size=(self.ui.fluid.width(), self.ui.fluid.height()), enable_advanced_rendering=enable_advanced_rendering)
+        self.sph_demo = SPHDemo(N, size=(self.ui.fluid.width(), self.ui.fluid.height()), enable_advanced_rendering=enable_advanced_rendering,
+                                smoothing_downsample=2 if '--half-res-smoothing' in sys.argv else 1,
+                                smoothing_budget_ms=4 if '--adaptive-smoothing' in sys.argv else None,
+                                replay=replay)
 
         # ui.fluid is the FluidWidget QGLWidget-widget.
         self.ui.fluid.init(self.sph_demo)
@@ -27,13 +30,21 @@ class MainWindow(QtGui.QMainWindow):
 
         self.setup_signals()
         statusBarInfo = QtGui.QLabel()
-        statusBarInfo.setText("%s particles, initial density: %s, mass: %.02f, gas constant k: %s, timestep: %.05f" % (
-                self.sph_demo.fluid_simulator.N,
-                self.sph_demo.fluid_simulator.density0, 
-                self.sph_demo.fluid_simulator.mass,
-                self.sph_demo.fluid_simulator.k,
-                self.sph_demo.fluid_simulator.dt
-                ))
+        if replay is not None:
+            statusBarInfo.setText("%s particles, replaying %s (%i frames, %.05f s apart)" % (
+                    self.sph_demo.fluid_simulator.N,
+                    replay,
+                    len(self.sph_demo.fluid_simulator),
+                    self.sph_demo.fluid_simulator.dt
+                    ))
+        else:
+            statusBarInfo.setText("%s particles, initial density: %s, mass: %.02f, gas constant k: %s, timestep: %.05f" % (
+                    self.sph_demo.fluid_simulator.N,
+                    self.sph_demo.fluid_simulator.density0, 
+                    self.sph_demo.fluid_simulator.mass,
+                    self.sph_demo.fluid_simulator.k,
+                    self.sph_demo.fluid_simulator.dt
+                    ))
 
         self.statusBarFps = QtGui.QLabel()
         self.statusBar().addPermanentWidget(self.statusBarFps)
@@ -124,7 +135,10 @@ class MainWindow(QtGui.QMainWindow):
         """
         key = event.key()
         params = self.sph_demo.params
-        if key == QtCore.Qt.Key_R:
+        if key == QtCore.Qt.Key_R and self.sph_demo.replay is not None:
+            # back to the first frame
+            self.sph_demo.fluid_simulator.seek(0)
+        elif key == QtCore.Qt.Key_R:
             self.sph_demo.fluid_simulator.set_positions()
         elif key == QtCore.Qt.Key_P:
             params.paused = not params.paused
@@ -2,3 +2,9 @@
 A module for simulating fluids using particles.
 """
 from .sph import FluidSimulator
+from .device import DevicePolicy
+from .scene import Scene
+from .trajectory import TrajectoryWriter
+from .replay import TrajectoryPlayer
+from .slabs import SlabSimulator
+from .ensemble import EnsembleSimulator
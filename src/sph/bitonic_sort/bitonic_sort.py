@@ -2,6 +2,8 @@ import pyopencl as cl
 import numpy as np
 import os
 
+from ..program_cache import build_program
+
 class BitonicSort(object):
     def __init__(self, ctx, queue, local_size_limit=None):
         self.ctx = ctx
@@ -12,7 +14,7 @@ class BitonicSort(object):
         self.queue = queue
         cur_dir = os.path.dirname(os.path.abspath(__file__))
         with open('%s/BitonicSort_b.cl' % cur_dir) as f:
-            self.prg = cl.Program(ctx, f.read() % { 'local_size_limit': local_size_limit }).build()
+            self.prg = build_program(ctx, f.read() % { 'local_size_limit': local_size_limit })
         self.local_size_limit = local_size_limit
 
     def sort_in_place(self, d_key, d_val, array_length, dir):
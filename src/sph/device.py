@@ -0,0 +1,148 @@
+"""
+Selection of the OpenCL device to run on.
+"""
+import os
+
+import pyopencl as cl
+
+class DevicePolicy(object):
+    """
+    Describes which OpenCL device to pick.
+
+    device_type: 'gpu', 'cpu', 'accelerator' or 'any'.
+    vendor, name: case insensitive substrings of the device vendor/name. None matches all devices.
+    index: pick the index-th of the matching devices (in platform order). None picks the first.
+    fallback_to_cpu: if no device matches, use the first CPU device instead of failing.
+
+    A policy can be given as a string, e.g. 'cpu', '1', or 'type=gpu,vendor=nvidia,index=0'.
+    The same syntax is used by the environment variable PYSPH_DEVICE (see from_env()).
+    """
+    ENV_VAR = 'PYSPH_DEVICE'
+
+    device_types = {
+        'gpu': cl.device_type.GPU,
+        'cpu': cl.device_type.CPU,
+        'accelerator': cl.device_type.ACCELERATOR,
+        'any': cl.device_type.ALL,
+        }
+
+    def __init__(self, device_type='gpu', vendor=None, name=None, index=None, fallback_to_cpu=True):
+        if device_type not in self.device_types:
+            raise ValueError("Unknown device type '%s', use one of %s" % (device_type, ', '.join(sorted(self.device_types))))
+        self.device_type = device_type
+        self.vendor = vendor
+        self.name = name
+        self.index = index
+        self.fallback_to_cpu = fallback_to_cpu
+
+    @classmethod
+    def from_string(cls, spec):
+        """
+        Parse a policy like 'cpu', '2' or 'type=cpu,vendor=intel,index=0,fallback=no'.
+        """
+        kwargs = {}
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            if '=' in item:
+                key, value = [s.strip() for s in item.split('=', 1)]
+            elif item.isdigit():
+                key, value = 'index', item
+            else:
+                key, value = 'type', item
+
+            if key == 'type':
+                kwargs['device_type'] = value.lower()
+            elif key in ('vendor', 'name'):
+                kwargs[key] = value
+            elif key == 'index':
+                kwargs['index'] = int(value)
+            elif key == 'fallback':
+                kwargs['fallback_to_cpu'] = value.lower() in ('1', 'yes', 'true', 'on')
+            else:
+                raise ValueError("Unknown device policy key '%s' in '%s'" % (key, spec))
+        return cls(**kwargs)
+
+    @classmethod
+    def from_env(cls, default=None):
+        """
+        Policy from the PYSPH_DEVICE environment variable, or default (a GPU policy if None).
+        """
+        spec = os.environ.get(cls.ENV_VAR)
+        if spec:
+            return cls.from_string(spec)
+        return default if default is not None else cls()
+
+    def matches(self, device):
+        if not device.type & self.device_types[self.device_type]:
+            return False
+        if self.vendor is not None and self.vendor.lower() not in device.vendor.lower():
+            return False
+        if self.name is not None and self.name.lower() not in device.name.lower():
+            return False
+        return True
+
+    def pick(self):
+        """
+        Returns the device matching this policy.
+        """
+        devices = [device for platform in cl.get_platforms() for device in platform.get_devices()]
+        candidates = [device for device in devices if self.matches(device)]
+        index = self.index or 0
+        if index < len(candidates):
+            return candidates[index]
+
+        if self.fallback_to_cpu:
+            for device in devices:
+                if device.type & cl.device_type.CPU:
+                    return device
+
+        raise Exception("No suitable device found for %s" % self)
+
+    def pick_many(self, count):
+        """
+        Returns count devices of one platform, which can share a context: the device matching this policy and
+        the next devices of the same type on its platform. If there are not enough, the device is split into
+        count sub-devices (device fission, supported e.g. by CPU runtimes).
+        """
+        device = self.pick()
+        devices = [d for d in device.platform.get_devices() if d.type == device.type]
+        devices = devices[devices.index(device):]
+        if len(devices) >= count:
+            return devices[:count]
+
+        if device.partition_max_sub_devices >= count and \
+                cl.device_partition_property.EQUALLY in device.partition_properties:
+            sub_devices = device.create_sub_devices(
+                [cl.device_partition_property.EQUALLY, device.max_compute_units // count])
+            return sub_devices[:count]
+
+        raise Exception("%s has no %i devices of the type of %s, and it can not be split into %i sub-devices "
+                        "(at most %i)" % (self, count, device.name.strip(), count, device.partition_max_sub_devices))
+
+    def __str__(self):
+        return 'DevicePolicy(type=%s, vendor=%s, name=%s, index=%s, fallback_to_cpu=%s)' % (
+            self.device_type, self.vendor, self.name, self.index, self.fallback_to_cpu)
+
+def device_info(device):
+    """
+    Dictionary describing the device (name, type, compute units, memory sizes).
+    """
+    return {
+        'name': device.name.strip(),
+        'vendor': device.vendor.strip(),
+        'platform': device.platform.name.strip(),
+        'type': cl.device_type.to_string(device.type),
+        'driver_version': device.driver_version,
+        'compute_units': device.max_compute_units,
+        'global_mem_size': device.global_mem_size,
+        'local_mem_size': device.local_mem_size,
+        'max_work_group_size': device.max_work_group_size,
+        }
+
+def describe_device(device):
+    info = device_info(device)
+    return '%s (%s, %s): %i compute units, %i MiB global memory, %i KiB local memory' % (
+        info['name'], info['type'], info['platform'], info['compute_units'],
+        info['global_mem_size'] // 2**20, info['local_mem_size'] // 2**10)
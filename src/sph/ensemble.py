@@ -0,0 +1,189 @@
+"""
+Many independent small simulations advanced together.
+
+An EnsembleSimulator packs the particles of M members (independent simulations of N particles each,
+e.g. of a parameter sweep) into the buffers of one FluidSimulator, so that one program, one radix sort and
+one launch of each kernel advance all of them:
+
+    viscosities = [50, 100, 200, 400]
+    ensemble = EnsembleSimulator(len(viscosities), 10000, params=[{'viscosity': v} for v in viscosities])
+    ensemble.cl_init()
+    ensemble.advance(100)
+    position = ensemble.by_member(ensemble.get_position())   # shape (M, N, 4)
+
+The particles of member m are [m*N, (m+1)*N). Every member has its own range of grid hashes (the member
+index is folded into the hash, see getParticleHash in sph.cl), so the sorted particles are grouped by
+member and the neighbour search never crosses members. The kernels pass params[member] (one Params struct
+per member) to the smoothing kernels and the integration, so the members can differ in all physical
+parameters (dt, mass, h, k, density0, viscosity and boxsize). All members share one grid, sized for the
+largest h and the box of the ensemble.
+"""
+import json
+
+import numpy as np
+import pyopencl as cl
+
+from .sph import FluidSimulator
+from .scene import Scene, dam_break
+
+
+class EnsembleSimulator(FluidSimulator):
+    def __init__(self, members, N, boxsize=(10,10,10), scenes=None, params=None, **kwargs):
+        """
+        members: number of independent simulations.
+        N: number of particles of every member.
+        scenes: list of the initial Scene of every member (None for the default dam break).
+        params: list of dictionaries overriding the default parameters (see FluidSimulator.set_params())
+        of every member, e.g. [{'viscosity': v} for v in viscosities]. By default, every member has the
+        parameters of a FluidSimulator of N particles in its scene.
+        The other arguments are those of FluidSimulator.
+        """
+        assert members >= 1, "need at least one member"
+        self.members = members
+        self.member_size = N
+        self.scenes = list(scenes) if scenes is not None else [None] * members
+        self.member_overrides = list(params) if params is not None else [{}] * members
+        assert len(self.scenes) == members and len(self.member_overrides) == members, \
+            "need the scene and parameters of every member"
+        FluidSimulator.__init__(self, members * N, boxsize, **kwargs)
+        assert self.backend == 'opencl', "ensembles need the opencl backend"
+        assert not (self.neighbour_lists or self.cell_kernels), "ensembles do not support neighbour lists or cell kernels"
+        print('%i members of %i particles' % (self.members, self.member_size))
+
+    def initial_params(self, N, scene):
+        # the parameters of every member for its own number of particles and scene. the attributes of the
+        # ensemble (h, dt, ...) are the parameters of the first member.
+        self.member_params = []
+        for scene, overrides in zip(self.scenes, self.member_overrides):
+            params = FluidSimulator.initial_params(self, self.member_size, scene)
+            params.update(k=self.k, density0=self.density0, viscosity=self.viscosity, boxsize=tuple(self.boxsize))
+            for name in overrides:
+                if name not in self.param_names:
+                    raise ValueError('unknown parameter %s, must be one of %s' % (name, self.param_names))
+            params.update(overrides)
+            self.member_params.append(params)
+        return dict((name, self.member_params[0][name]) for name in ('spacing0', 'dt', 'h', 'mass'))
+
+    def init_grid(self):
+        # the grid of one member, for the largest h of the members. every member gets its own range of
+        # number_of_hashes hashes.
+        FluidSimulator.init_grid(self, self.member_size, max(params['h'] for params in self.member_params))
+        self.number_of_hashes *= self.members
+        self.hash_bits = max(1, int(self.number_of_hashes - 1).bit_length())
+
+    def initialize_positions(self):
+        N = self.member_size
+        for m, (scene, params) in enumerate(zip(self.scenes, self.member_params)):
+            if scene is None:
+                scene = dam_break(N, params['boxsize'], params['spacing0'])
+            self.position[m*N:(m+1)*N] = scene.positions(N, params['spacing0'])
+        self.velocity[:] = 0
+
+    def by_member(self, array):
+        """
+        View of an array of all particles (e.g. get_position()) with the members along the first axis.
+        """
+        return array.reshape((self.members, self.member_size) + array.shape[1:])
+
+    def pack_params(self):
+        # one Params struct per member, all with the number of particles of the ensemble.
+        return b''.join(FluidSimulator.pack_params(self, params) for params in self.member_params)
+
+    def set_params(self, members=None, **params):
+        """
+        Change the parameters of some members between steps, e.g. set_params(3, viscosity=100) or
+        set_params([0, 1], k=2000). members is a member index or a list of them, all members if None.
+        See FluidSimulator.set_params(), h may not grow beyond the cell size of the shared grid.
+        """
+        for name in params:
+            if name not in self.param_names:
+                raise ValueError('unknown parameter %s, must be one of %s' % (name, self.param_names))
+        if params.get('h', 0) > self.cell_size:
+            raise ValueError('h=%s is too large for the grid (cell size %s), create a new EnsembleSimulator' % (
+                params['h'], self.cell_size))
+        if 'boxsize' in params:
+            params['boxsize'] = tuple(params['boxsize'])
+            assert len(params['boxsize']) == 3, "boxsize must have 3 elements"
+
+        if members is None:
+            members = range(self.members)
+        elif isinstance(members, int):
+            members = [members]
+        for m in members:
+            self.member_params[m].update(params)
+        for name in self.param_names:
+            setattr(self, name, self.member_params[0][name])
+
+        if hasattr(self, 'params_cl'):
+            self.last_event = cl.enqueue_copy(self.queue, self.params_cl, self.pack_params(), wait_for=self.wait_for_last())
+            self.last_event.wait()
+
+    def times(self):
+        """
+        The simulated time of every member (the members can have different timesteps).
+        """
+        return [self.steps * params['dt'] for params in self.member_params]
+
+    checkpoint_options = FluidSimulator.checkpoint_options + ('members', 'member_size')
+    # parameters stored for every member.
+    member_param_names = ('spacing0', ) + FluidSimulator.param_names
+
+    def checkpoint_data(self):
+        data = FluidSimulator.checkpoint_data(self)
+        for name in self.member_param_names:
+            data['member_' + name] = np.array([params[name] for params in self.member_params])
+        data['scenes'] = json.dumps([scene.describe() if scene is not None else None for scene in self.scenes])
+        return data
+
+    def load_checkpoint(self, path):
+        """
+        Restores the state and the parameters of all members saved by save_checkpoint(). The number of
+        members and their number of particles must be the same. See FluidSimulator.load_checkpoint().
+        """
+        with np.load(path) as checkpoint:
+            if 'members' not in checkpoint:
+                raise ValueError('checkpoint %s is not a checkpoint of an ensemble' % path)
+            members, member_size = int(checkpoint['members']), int(checkpoint['member_size'])
+            if (members, member_size) != (self.members, self.member_size):
+                raise ValueError('checkpoint %s has %i members of %i particles, not %i of %i' % (
+                    path, members, member_size, self.members, self.member_size))
+            member_params = [{} for m in range(members)]
+            for name in self.member_param_names:
+                for params, value in zip(member_params, checkpoint['member_' + name]):
+                    params[name] = tuple(float(b) for b in value) if name == 'boxsize' else float(value)
+            self.position[:] = checkpoint['position']
+            self.velocity[:] = checkpoint['velocity']
+            self.steps = int(checkpoint['steps'])
+            self.neighbour_skin = float(checkpoint['neighbour_skin'])
+
+        if hasattr(self, 'prg'):
+            for m, params in enumerate(member_params):
+                self.member_params[m]['spacing0'] = params.pop('spacing0')
+                self.set_params(m, **params)
+            self.set_positions()
+        else:
+            self.member_params = member_params
+            self.spacing0 = member_params[0]['spacing0']
+            for name in self.param_names:
+                setattr(self, name, member_params[0][name])
+            self.init_grid()
+
+    @classmethod
+    def from_checkpoint(cls, path, **kwargs):
+        """
+        Creates an EnsembleSimulator with the options, members and scenes stored in the checkpoint and loads
+        it, see FluidSimulator.from_checkpoint().
+        """
+        with np.load(path) as checkpoint:
+            if 'members' not in checkpoint:
+                raise ValueError('checkpoint %s is not a checkpoint of an ensemble' % path)
+            options = dict((name, checkpoint[name].item()) for name in FluidSimulator.checkpoint_options
+                           if name not in ('N', 'boxsize') and name in checkpoint)
+            options.update(members=int(checkpoint['members']), N=int(checkpoint['member_size']),
+                           boxsize=tuple(float(b) for b in checkpoint['boxsize']),
+                           scenes=[Scene.from_description(scene) if scene is not None else None
+                                   for scene in json.loads(checkpoint['scenes'].item())])
+        options.update(kwargs)
+        ensemble = cls(**options)
+        ensemble.load_checkpoint(path)
+        return ensemble
@@ -0,0 +1,210 @@
+"""
+Pure NumPy implementation of the simulation step in sph.cl.
+
+Used as a correctness reference for the OpenCL kernels and as a fallback on machines
+without an OpenCL implementation. Like the OpenCL version, neighbours are found
+using a uniform grid: particles are sorted by cell hash (np.argsort), and the first/last
+particle of each cell is looked up with np.searchsorted.
+"""
+import numpy as np
+
+class NumpyBackend(object):
+    # offsets to the 27 cells around (and including) a cell
+    neighbour_offsets = np.array([(x, y, z) for z in (-1, 0, 1) for y in (-1, 0, 1) for x in (-1, 0, 1)], dtype=np.int64)
+
+    def __init__(self, fluid_simulator, chunk_size=4096):
+        """
+        chunk_size: number of particles whose neighbour pairs are processed at once.
+        Bounds the memory used for the pair lists.
+        """
+        self.fluid_simulator = fluid_simulator
+        self.chunk_size = chunk_size
+
+        # positions/velocities are updated in place.
+        self.position = fluid_simulator.position
+        self.velocity = fluid_simulator.velocity
+
+    def compute_hash(self, position):
+        """
+        Grid hash (cell index) of each particle, same as computeHash in sph.cl.
+        """
+        fs = self.fluid_simulator
+        number_of_cells = np.array(fs.number_of_cells)
+        scale = number_of_cells / np.array(fs.boxsize, dtype=np.float64)
+        grid_position = np.floor(position[:, :3] * scale).astype(np.int64)
+        grid_position = np.clip(grid_position, 0, number_of_cells - 1)
+        return grid_position, self.grid_hash(grid_position)
+
+    def grid_hash(self, grid_position):
+        nx, ny, nz = self.fluid_simulator.number_of_cells
+        return (grid_position[..., 2] * ny + grid_position[..., 1]) * nx + grid_position[..., 0]
+
+    def assign_cells(self):
+        """
+        Sort particles by grid hash and find the start/end of each cell in the sorted arrays
+        (computeHash, sort and reorderDataAndFindCellStart in sph.cl).
+        """
+        fs = self.fluid_simulator
+        grid_position, grid_hash = self.compute_hash(self.position)
+        self.grid_index = np.argsort(grid_hash, kind='stable')
+        sorted_hash = grid_hash[self.grid_index]
+        self.grid_position_sorted = grid_position[self.grid_index]
+
+        cells = np.arange(fs.total_number_of_cells)
+        self.cell_start = np.searchsorted(sorted_hash, cells, side='left')
+        self.cell_end = np.searchsorted(sorted_hash, cells, side='right')
+
+        self.position_sorted = self.position[self.grid_index, :3].astype(np.float64)
+        self.velocity_sorted = self.velocity[self.grid_index, :3].astype(np.float64)
+
+    def neighbour_pairs(self, start, stop):
+        """
+        Candidate neighbour pairs (i, j) for the sorted particles start <= i < stop:
+        all particles j in the 27 cells around the cell of particle i.
+        """
+        fs = self.fluid_simulator
+        number_of_cells = np.array(fs.number_of_cells)
+        n = stop - start
+
+        # (n, 27, 3) neighbour cells of every particle
+        cells = self.grid_position_sorted[start:stop, None, :] + self.neighbour_offsets[None, :, :]
+        valid = np.all((cells >= 0) & (cells < number_of_cells), axis=2)
+        hashes = self.grid_hash(np.clip(cells, 0, number_of_cells - 1))
+
+        first = np.where(valid, self.cell_start[hashes], 0).ravel()
+        counts = np.where(valid, self.cell_end[hashes] - self.cell_start[hashes], 0).ravel()
+
+        # expand the ranges [first, first+count) into one flat array of j's
+        total = counts.sum()
+        offsets = np.cumsum(counts) - counts
+        i = np.repeat(np.repeat(np.arange(start, stop), 27), counts)
+        j = np.arange(total) - np.repeat(offsets, counts) + np.repeat(first, counts)
+        return i, j
+
+    def all_pairs(self, start, stop):
+        """
+        All pairs (i, j) for start <= i < stop (bruteforce neighbour search).
+        """
+        N = self.fluid_simulator.N
+        i = np.repeat(np.arange(start, stop), N)
+        j = np.tile(np.arange(N), stop - start)
+        return i, j
+
+    def pairs(self):
+        """
+        Yields chunks of neighbour pairs (i, j, x_i - x_j, |x_i - x_j|) closer than the kernel support h.
+        """
+        fs = self.fluid_simulator
+        h = fs.h
+        position = self.position_sorted
+        for start in range(0, fs.N, self.chunk_size):
+            stop = min(start + self.chunk_size, fs.N)
+            if fs.use_grid:
+                i, j = self.neighbour_pairs(start, stop)
+            else:
+                i, j = self.all_pairs(start, stop)
+            x_diff = position[i] - position[j]
+            r = np.sqrt(np.einsum('ij,ij->i', x_diff, x_diff))
+            close = r < h
+            yield i[close], j[close], x_diff[close], r[close]
+
+    def kernel_m4(self, r):
+        h = self.fluid_simulator.h
+        q = r / h
+        factor = 2.546479089470325472 / h**3
+        return np.where(q < .5,
+                        factor * (1. - 6. * q * q * (1 - q)),
+                        factor * 2. * (1. - q)**3)
+
+    def kernel_m4_d(self, r):
+        h = self.fluid_simulator.h
+        q = r / h
+        factor = 2.546479089470325472 / h**5
+        return np.where(q < .5,
+                        factor * (-12. + 18. * q),
+                        factor * (-6. * (1. - q)**2 / q))
+
+    def kernel_visc_dd(self, r):
+        h = self.fluid_simulator.h
+        q = r / h
+        return -45. / (np.pi * h**5) * (1 - q)
+
+    def step_density(self, pairs):
+        fs = self.fluid_simulator
+        density = np.zeros(fs.N)
+        for i, j, x_diff, r in pairs:
+            density += np.bincount(i, weights=self.kernel_m4(r), minlength=fs.N)
+        density *= fs.mass
+        self.density = density
+        self.pressure = np.maximum(0., fs.k * (density - fs.density0))
+
+    def step_forces(self, pairs):
+        fs = self.fluid_simulator
+        N = fs.N
+        density, pressure = self.density, self.pressure
+        velocity = self.velocity_sorted
+
+        acceleration = np.zeros((N, 3))
+        for i, j, x_diff, r in pairs:
+            # skip the particle itself
+            other = r != 0.
+            i, j, x_diff, r = i[other], j[other], x_diff[other], r[other]
+
+            # pressure force
+            coeff = -(.5 * (pressure[i] + pressure[j]) / density[j] * self.kernel_m4_d(r)) / r
+            accel = x_diff * coeff[:, None]
+            # viscosity, laplacian of Wviscosity as in Stefan Auer's thesis.
+            accel += (velocity[i] - velocity[j]) * (fs.viscosity / density[j] * self.kernel_visc_dd(r))[:, None]
+
+            for axis in range(3):
+                acceleration[:, axis] += np.bincount(i, weights=accel[:, axis], minlength=N)
+
+        acceleration *= (fs.mass / density)[:, None]
+        # gravity
+        acceleration[:, 1] -= 9.81
+
+        # back to the unsorted order
+        self.acceleration = np.empty_like(acceleration)
+        self.acceleration[self.grid_index] = acceleration
+
+    def step_move(self):
+        fs = self.fluid_simulator
+        dt = fs.dt
+        x = self.position[:, :3].astype(np.float64)
+        v = self.velocity[:, :3].astype(np.float64)
+
+        v += self.acceleration * dt
+        x += v * dt
+
+        damp = 0.4
+        # collisions (the box size is truncated to integers, as in sph.cl)
+        boxsize = np.array([int(b) for b in fs.boxsize], dtype=np.float64)
+        low = x < 0.
+        x[low] = 0.
+        v[low] *= -damp
+        high = x > boxsize
+        x[high] = np.broadcast_to(boxsize, x.shape)[high]
+        v[high] *= -damp
+
+        self.position[:, :3] = x
+        self.position[:, 3] = 0
+        self.velocity[:, :3] = v
+        self.velocity[:, 3] = 0
+
+    def step(self):
+        """
+        Advance simulation by one timestep.
+        """
+        fs = self.fluid_simulator
+        if fs.use_grid:
+            self.assign_cells()
+        else:
+            self.grid_index = np.arange(fs.N)
+            self.position_sorted = self.position[:, :3].astype(np.float64)
+            self.velocity_sorted = self.velocity[:, :3].astype(np.float64)
+
+        # the pairs are generated again for the forces (positions only change in step_move()), so that
+        # only one chunk of pairs is held at a time.
+        self.step_density(self.pairs())
+        self.step_forces(self.pairs())
+        self.step_move()
@@ -0,0 +1,123 @@
+"""
+On-disk cache of compiled OpenCL program binaries.
+
+Building the (rendered) OpenCL sources can take seconds, especially on CPU runtimes. build_program()
+stores the binaries of every program it builds, keyed by the source, the build options and the
+devices (name, vendor, device and driver version), and loads them instead of compiling when the
+same program is built again.
+
+The cache directory is $PYSPH_PROGRAM_CACHE, or ~/.cache/pysph/programs. Set PYSPH_PROGRAM_CACHE=off
+to disable the cache. When the cache grows beyond max_size bytes, the least recently used binaries
+are deleted.
+"""
+import hashlib
+import os
+import tempfile
+
+import pyopencl as cl
+
+ENV_VAR = 'PYSPH_PROGRAM_CACHE'
+
+# default size limit of the cache directory in bytes.
+max_size = 64 * 2**20
+
+
+def cache_dir():
+    """
+    The cache directory, or None if the cache is disabled.
+    """
+    path = os.environ.get(ENV_VAR)
+    if path is None:
+        return os.path.join(os.path.expanduser('~'), '.cache', 'pysph', 'programs')
+    if path.lower() in ('', '0', 'off', 'no'):
+        return None
+    return path
+
+
+def program_key(device, source, options):
+    """
+    Cache key of the binary of source built with options for device.
+    """
+    h = hashlib.sha256()
+    for part in (source, options,
+                 device.name, device.vendor, device.version, device.driver_version,
+                 device.platform.name, device.platform.version):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def build_program(ctx, source, options=None):
+    """
+    Like cl.Program(ctx, source).build(options), but uses the cached binaries if there are any.
+    """
+    options = options or ''
+    directory = cache_dir()
+    if directory is None:
+        return cl.Program(ctx, source).build(options)
+
+    devices = ctx.devices
+    paths = [os.path.join(directory, program_key(device, source, options) + '.bin') for device in devices]
+
+    if all(os.path.exists(path) for path in paths):
+        try:
+            binaries = []
+            for path in paths:
+                with open(path, 'rb') as f:
+                    binaries.append(f.read())
+            program = cl.Program(ctx, devices, binaries).build(options)
+            for path in paths:
+                # the access time is not updated reliably (noatime mounts), mark as recently used.
+                os.utime(path, None)
+            return program
+        except (cl.Error, IOError, OSError) as e:
+            # e.g. a driver update that does not change the version strings, fall back to the source.
+            print('could not load cached program binary (%s), building from source' % e)
+
+    program = cl.Program(ctx, source).build(options)
+    try:
+        store(directory, paths, program.get_info(cl.program_info.BINARIES))
+    except (IOError, OSError) as e:
+        print('could not write program binary to the cache (%s)' % e)
+    return program
+
+
+def store(directory, paths, binaries):
+    """
+    Writes the binaries to paths, then evicts the least recently used binaries if the cache is too large.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for path, binary in zip(paths, binaries):
+        # write to a temporary file and rename it, so that concurrent processes never read a partial binary.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(binary)
+        os.rename(tmp_path, path)
+    evict(directory, max_size)
+
+
+def evict(directory, size):
+    """
+    Deletes the least recently used binaries in directory until they take at most size bytes.
+    """
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith('.bin'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(entry[1] for entry in entries)
+    for mtime, entry_size, path in sorted(entries):
+        if total <= size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= entry_size
@@ -14,37 +14,18 @@
 */
 
 //----------------------------------------------------------------------------
-// Scans each warp in parallel ("warp-scan"), one element per thread.
-// uses 2 numElements of shared memory per thread (64 = elements per warp)
-//----------------------------------------------------------------------------
-#define WARP_SIZE 32
-uint scanwarp(uint val, volatile __local uint* sData, int maxlevel)
-{
-    // The following is the same as 2 * RadixSort::WARP_SIZE * warpId + threadInWarp = 
-    // 64*(threadIdx.x >> 5) + (threadIdx.x & (RadixSort::WARP_SIZE - 1))
-    int localId = get_local_id(0);
-    int idx = 2 * localId - (localId & (WARP_SIZE - 1));
-    sData[idx] = 0;
-    idx += WARP_SIZE;
-    sData[idx] = val;     
-
-    if (0 <= maxlevel) { sData[idx] += sData[idx - 1]; }
-    if (1 <= maxlevel) { sData[idx] += sData[idx - 2]; }
-    if (2 <= maxlevel) { sData[idx] += sData[idx - 4]; }
-    if (3 <= maxlevel) { sData[idx] += sData[idx - 8]; }
-    if (4 <= maxlevel) { sData[idx] += sData[idx -16]; }
-
-    return sData[idx] - val;  // convert inclusive -> exclusive
-}
-
-//----------------------------------------------------------------------------
-// scan4 scans 4*RadixSort::CTA_SIZE numElements in a block (4 per thread), using 
-// a warp-scan algorithm
+// scan4 scans 4*RadixSort::CTA_SIZE numElements in a block (4 per thread).
+//
+// The original NVIDIA version used a warp-synchronous scan (no barriers within
+// a warp of 32 threads). That is only correct if the work-items of a warp run
+// in lockstep, which is not the case on CPU devices (and crashes pocl), so the
+// per-thread sums are scanned with a barrier-synchronized Hillis-Steele scan.
+// Uses 2*CTA_SIZE elements of ptr.
 //----------------------------------------------------------------------------
 uint4 scan4(uint4 idata, __local uint* ptr)
 {    
-    
     uint idx = get_local_id(0);
+    uint localSize = get_local_size(0);
 
     uint4 val4 = idata;
     uint sum[3];
@@ -52,23 +33,25 @@ uint4 scan4(uint4 idata, __local uint* ptr)
     sum[1] = val4.y + sum[0];
     sum[2] = val4.z + sum[1];
     
-    uint val = val4.w + sum[2];
-    
-    val = scanwarp(val, ptr, 4);
-    barrier(CLK_LOCAL_MEM_FENCE);
+    uint total = val4.w + sum[2];
+
+    // the first localSize elements stay zero so that no bounds check is needed
+    uint pos = idx;
+    ptr[pos] = 0;
+    pos += localSize;
+    ptr[pos] = total;
 
-    if ((idx & (WARP_SIZE - 1)) == WARP_SIZE - 1)
+    for(uint offset = 1; offset < localSize; offset <<= 1)
     {
-        ptr[idx >> 5] = val + val4.w + sum[2];
+        barrier(CLK_LOCAL_MEM_FENCE);
+        uint t = ptr[pos] + ptr[pos - offset];
+        barrier(CLK_LOCAL_MEM_FENCE);
+        ptr[pos] = t;
     }
     barrier(CLK_LOCAL_MEM_FENCE);
 
-	if (idx < WARP_SIZE)
-		ptr[idx] = scanwarp(ptr[idx], ptr, 2);
-    
-    barrier(CLK_LOCAL_MEM_FENCE);
-
-    val += ptr[idx >> 5];
+    // inclusive -> exclusive
+    uint val = ptr[pos] - total;
 
     val4.x = val;
     val4.y = val + sum[0];
@@ -446,9 +429,12 @@ void radixSortBlockKeysValues(uint4 *key, uint4 *value, uint nbits, uint startbi
 }
 
 //----------------------------------------------------------------------
-// ERROR: 
-__kernel void radixSortBlocksKeysValues(__global uint4* keysIn, 
-					__global uint4* valuesIn,
+// numElements does not need to be a multiple of the block size: keys past
+// numElements are read as 0xFFFFFFFF, so they are sorted to the end of the
+// last block. reorderDataKeysValues drops them again.
+//----------------------------------------------------------------------
+__kernel void radixSortBlocksKeysValues(__global uint* keysIn, 
+					__global uint* valuesIn,
 					__global uint4* keysOut,
 					__global uint4* valuesOut,
 					uint nbits,
@@ -461,10 +447,24 @@ __kernel void radixSortBlocksKeysValues(__global uint4* keysIn,
 	int globalId = get_global_id(0);
 	__local uint numtrue[1];
 	uint4 key;
-	key = keysIn[globalId];
-
 	uint4 value;
-	value = valuesIn[globalId]; // not sure if needed
+	uint i = 4 * globalId;
+	if(i + 3 < numElements)
+	{
+		key = vload4(globalId, keysIn);
+		value = vload4(globalId, valuesIn);
+	}
+	else
+	{
+		key.x = (i     < numElements) ? keysIn[i]     : 0xFFFFFFFF;
+		key.y = (i + 1 < numElements) ? keysIn[i + 1] : 0xFFFFFFFF;
+		key.z = (i + 2 < numElements) ? keysIn[i + 2] : 0xFFFFFFFF;
+		key.w = (i + 3 < numElements) ? keysIn[i + 3] : 0xFFFFFFFF;
+		value.x = (i     < numElements) ? valuesIn[i]     : 0;
+		value.y = (i + 1 < numElements) ? valuesIn[i + 1] : 0;
+		value.z = (i + 2 < numElements) ? valuesIn[i + 2] : 0;
+		value.w = (i + 3 < numElements) ? valuesIn[i + 3] : 0;
+	}
 	
 	barrier(CLK_LOCAL_MEM_FENCE);
 	
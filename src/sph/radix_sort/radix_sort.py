@@ -3,6 +3,9 @@
 import pyopencl as cl
 import numpy as np
 import struct, os
+from math import log, ceil
+
+from ..program_cache import build_program
 
 mf = cl.mem_flags
 
@@ -21,55 +24,106 @@ class RadixSort(object):
 
         cur_dir = os.path.dirname(os.path.abspath(__file__))
         with open('%s/Scan_b.cl' % cur_dir) as f:
-            self.scan_prg = cl.Program(self.ctx, f.read()).build()
+            self.scan_prg = build_program(self.ctx, f.read())
         with open('%s/RadixSort.cl' % cur_dir) as f:
-            self.radix_prg = cl.Program(self.ctx, f.read()).build()
+            self.radix_prg = build_program(self.ctx, f.read())
 
-        if (max_elements % (cta_size * 4)) == 0:
-            num_blocks = max_elements // (cta_size * 4)
-        else:
-            num_blocks = max_elements // (cta_size * 4) + 1
+        # any number of elements can be sorted. internally, the arrays are padded to a multiple of
+        # the block size (4 elements per work-item), the padding is dropped again when reordering.
+        padded_elements = self.padded_length(max_elements)
+        numscan = self.scan_length(max_elements)
 
-        self.d_temp_keys = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * max_elements)
-        self.d_temp_values = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * max_elements)
+        self.d_temp_keys = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * padded_elements)
+        self.d_temp_values = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * padded_elements)
 
-        self.d_counters = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * self.WARP_SIZE * num_blocks)
-        self.d_counters_sum = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * self.WARP_SIZE * num_blocks)
-        self.d_block_offsets = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * self.WARP_SIZE * num_blocks)
+        self.d_counters = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * numscan)
+        self.d_counters_sum = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * numscan)
+        self.d_block_offsets = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.dtype_size * numscan)
 
-        numscan = max_elements//2//cta_size*16
         if numscan >= self.MIN_LARGE_ARRAY_SIZE:
             #MAX_WORKGROUP_INCLUSIVE_SCAN_SIZE 1024
             self.scan_buffer = cl.Buffer(self.ctx, mf.READ_WRITE, size = self.dtype_size * numscan // 1024)
 
-    def sort(self, d_key, d_val, N):
-        key_bits = self.dtype_size * 8
+        # kernels with arguments already set, see bound_step()
+        self._bound_steps = {}
+
+        # if set, called with ('RadixSort.<kernel name>', event) for every kernel launch (e.g. for profiling).
+        self.event_callback = None
+
+    def padded_length(self, num):
+        """
+        num rounded up to a multiple of the block size of radixSortBlocksKeysValues.
+        """
+        block_size = 4 * self.cta_size
+        return (num + block_size - 1) // block_size * block_size
+
+    def scan_length(self, num):
+        """
+        Number of radix counters (16 per block of 2*cta_size elements) to scan.
+        The large array scan needs a power of two.
+        """
+        length = self.padded_length(num)//2//self.cta_size*16
+        if length >= self.MIN_LARGE_ARRAY_SIZE:
+            length = 2**int(ceil(log(length)/log(2)))
+        return length
+
+    def sort(self, d_key, d_val, N, key_bits=None, wait_for=None):
+        """
+        Sort keys d_key (and values d_val along with them), ascending.
+        key_bits: only the lowest key_bits bits of the keys are sorted by (all bits if None).
+        Each pass sorts 4 bits, so this needs ceil(key_bits/4) passes.
+        wait_for: events to wait for before the sort starts.
+        All passes are enqueued without waiting on the host. Returns the event of the last kernel.
+        """
+        if key_bits is None:
+            key_bits = self.dtype_size * 8
+        assert 0 < key_bits <= self.dtype_size * 8
         bit_step = 4
         i = 0
         while key_bits > i*bit_step:
-            self.step(d_key, d_val, bit_step, i*bit_step, N);
+            event = self.step(d_key, d_val, bit_step, i*bit_step, N, wait_for=wait_for);
+            wait_for = [event]
             i += 1;
-
-    def step(self, d_key, d_val, nbits, startbit, num):
-        self.blocks(d_key, d_val, nbits, startbit, num)
-        self.queue.finish()
-
-        self.find_offsets(startbit, num)
-        self.queue.finish()
-
-        array_length = num//2//self.cta_size*16
-        if array_length < self.MIN_LARGE_ARRAY_SIZE:
-            self.naive_scan(num)
-        else:
-            self.scan(self.d_counters_sum, self.d_counters, 1, array_length);
-        self.queue.finish()
-     
-        self.reorder(d_key, d_val, startbit, num)
-        self.queue.finish()
-
+        return event
+
+    def step(self, d_key, d_val, nbits, startbit, num, wait_for=None):
+        """
+        Enqueue one pass, each kernel waiting for the previous one.
+        Returns the event of the last kernel.
+        """
+        for kernel, global_size, local_size in self.bound_step(d_key, d_val, nbits, startbit, num):
+            event = cl.enqueue_nd_range_kernel(self.queue, kernel, global_size, local_size, wait_for=wait_for)
+            if self.event_callback is not None:
+                self.event_callback('RadixSort.' + kernel.function_name, event)
+            wait_for = [event]
+        return event
+
+    def bound_step(self, d_key, d_val, nbits, startbit, num):
+        """
+        The kernels of one sort pass, with their arguments already set: a list of
+        (kernel, global_size, local_size). Cached, so that sorting the same buffers again
+        does not create kernels or set arguments.
+        """
+        key = (d_key, d_val, nbits, startbit, num)
+        if key not in self._bound_steps:
+            launches = [self.blocks(d_key, d_val, nbits, startbit, num),
+                        self.find_offsets(startbit, num)]
+            array_length = self.scan_length(num)
+            if array_length < self.MIN_LARGE_ARRAY_SIZE:
+                launches.append(self.naive_scan(num))
+            else:
+                launches.extend(self.scan(self.d_counters_sum, self.d_counters, 1, array_length))
+            launches.append(self.reorder(d_key, d_val, startbit, num))
+            self._bound_steps[key] = launches
+        return self._bound_steps[key]
+
+    def _kernel(self, prg, name, *args):
+        kernel = cl.Kernel(prg, name)
+        kernel.set_args(*args)
+        return kernel
 
     def blocks(self, d_key, d_val, nbits, startbit, num):
-        totalBlocks = num//4//self.cta_size
+        totalBlocks = self.padded_length(num)//4//self.cta_size
         global_size = (self.cta_size*totalBlocks,)
         local_size = (self.cta_size,)
         blocks_args = (d_key,
@@ -83,11 +137,11 @@ class RadixSort(object):
                        cl.LocalMemory(4*self.cta_size*self.dtype_size),
                        cl.LocalMemory(4*self.cta_size*self.dtype_size),
             )
-        self.radix_prg.radixSortBlocksKeysValues(self.queue, global_size, local_size, *blocks_args)
+        return self._kernel(self.radix_prg, 'radixSortBlocksKeysValues', *blocks_args), global_size, local_size
 
 
     def find_offsets(self, startbit, num):
-        totalBlocks = num//2//self.cta_size
+        totalBlocks = self.padded_length(num)//2//self.cta_size
         global_size = (self.cta_size*totalBlocks,)
         local_size = (self.cta_size,)
         offsets_args = (self.d_temp_keys,
@@ -99,11 +153,11 @@ class RadixSort(object):
                         np.uint32(totalBlocks),
                         cl.LocalMemory(2*self.cta_size*self.dtype_size),
             )
-        self.radix_prg.findRadixOffsets(self.queue, global_size, local_size, *offsets_args)
+        return self._kernel(self.radix_prg, 'findRadixOffsets', *offsets_args), global_size, local_size
 
 
     def naive_scan(self, num):
-        nhist = num//2//self.cta_size*16
+        nhist = self.scan_length(num)
         global_size = (nhist,)
         local_size = (nhist,)
         extra_space = nhist // 16 #NUM_BANKS defined as 16 in RadixSort.cpp
@@ -113,23 +167,19 @@ class RadixSort(object):
                      np.uint32(nhist),
                      cl.LocalMemory(2*shared_mem_size)
             )
-        self.radix_prg.scanNaive(self.queue, global_size, local_size, *scan_args)
+        return self._kernel(self.radix_prg, 'scanNaive', *scan_args), global_size, local_size
 
 
     def scan(self, dst, src, batch_size, array_length):
-        self.scan_local1(dst, 
-                         src, 
-                         batch_size * array_length // (4 * self.WORKGROUP_SIZE),
-                         4 * self.WORKGROUP_SIZE)
-        self.queue.finish()
-        self.scan_local2(dst, 
-                         src, 
-                         batch_size,
-                         array_length // (4 * self.WORKGROUP_SIZE)
-            )
-        self.queue.finish()
-        self.scan_update(dst, batch_size * array_length // (4 * self.WORKGROUP_SIZE))
-        self.queue.finish()
+        return [self.scan_local1(dst, 
+                                 src, 
+                                 batch_size * array_length // (4 * self.WORKGROUP_SIZE),
+                                 4 * self.WORKGROUP_SIZE),
+                self.scan_local2(dst, 
+                                 src, 
+                                 batch_size,
+                                 array_length // (4 * self.WORKGROUP_SIZE)),
+                self.scan_update(dst, batch_size * array_length // (4 * self.WORKGROUP_SIZE))]
 
     
     def scan_local1(self, dst, src, n, size):
@@ -140,7 +190,7 @@ class RadixSort(object):
                      cl.LocalMemory(2 * self.WORKGROUP_SIZE * self.dtype_size),
                      np.uint32(size)
             )
-        self.scan_prg.scanExclusiveLocal1(self.queue, global_size, local_size, *scan_args)
+        return self._kernel(self.scan_prg, 'scanExclusiveLocal1', *scan_args), global_size, local_size
 
     def scan_local2(self, dst, src, n, size):
         elements = n * size
@@ -159,7 +209,7 @@ class RadixSort(object):
                      np.uint32(elements),
                      np.uint32(size)
             )
-        self.scan_prg.scanExclusiveLocal2(self.queue, global_size, local_size, *scan_args)
+        return self._kernel(self.scan_prg, 'scanExclusiveLocal2', *scan_args), global_size, local_size
 
 
     def scan_update(self, dst, n):
@@ -167,10 +217,10 @@ class RadixSort(object):
         local_size = (self.WORKGROUP_SIZE,)
         scan_args = (dst,
                      self.scan_buffer)
-        self.scan_prg.uniformUpdate(self.queue, global_size, local_size, *scan_args)
+        return self._kernel(self.scan_prg, 'uniformUpdate', *scan_args), global_size, local_size
 
     def reorder(self, d_key, d_val, startbit, num):
-        totalBlocks = num//2//self.cta_size
+        totalBlocks = self.padded_length(num)//2//self.cta_size
         global_size = (self.cta_size*totalBlocks,)
         local_size = (self.cta_size,)
         reorder_args = (d_key,
@@ -186,11 +236,11 @@ class RadixSort(object):
                         cl.LocalMemory(2*self.cta_size*self.dtype_size),
                         cl.LocalMemory(2*self.cta_size*self.dtype_size)
                     )
-        self.radix_prg.reorderDataKeysValues(self.queue, global_size, local_size, *reorder_args)
+        return self._kernel(self.radix_prg, 'reorderDataKeysValues', *reorder_args), global_size, local_size
 
 
 if __name__ == '__main__':
-    N = 2<<10
+    N = (2<<10) + 123
     keys = np.random.randint(1, 300, size=N).astype(np.uint32)
     vals = np.random.randint(1, 300, size=N).astype(np.uint32)
 
@@ -0,0 +1,172 @@
+"""
+Playback of recorded trajectories, in place of a running FluidSimulator.
+
+A TrajectoryPlayer has the attributes of a FluidSimulator that the demo and the renderers use (N, h,
+boxsize, dt, position_vbo, cl_pick_device), so the recorded particles are rendered like simulated ones:
+
+    player = TrajectoryPlayer('run_8000/trajectory.sphq')
+    player.gl_init()          # with a current OpenGL context
+    player.next_frame()       # once per rendered frame
+
+The trajectory file is memory-mapped and indexed by frame (see sph.trajectory), so seeking is O(1) and
+memory use does not grow with the length of the trajectory. A background thread decodes the frames after
+the current one into a small ring of host buffers, next_frame() only hands the next ready buffer to the
+vertex buffer object, which uploads it when it is bound.
+"""
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from .device import DevicePolicy
+from .trajectory import open_trajectory
+
+
+class TrajectoryPlayer(object):
+    def __init__(self, path, boxsize=None, h=None, device_policy=None, ring_size=4):
+        """
+        path: trajectory file of either format (see sph.trajectory.open_trajectory).
+        boxsize: box size, taken from the file for compact trajectories, (10, 10, 10) otherwise.
+        h: particle radius used for rendering, the default smoothing length of a FluidSimulator with the
+        same N and boxsize if None.
+        device_policy: DevicePolicy (or policy string like 'cpu') of the OpenCL device the renderer uses.
+        ring_size: number of host buffers, i.e. frames decoded ahead (at least 3: one shown, one ready,
+        one being decoded).
+        """
+        assert ring_size >= 3, "ring_size must be at least 3"
+        self.trajectory = open_trajectory(path)
+        if len(self.trajectory) == 0:
+            raise ValueError('%s has no frames' % path)
+        self.N = self.trajectory.N
+
+        if boxsize is None:
+            boxsize = tuple(float(b) for b in self.trajectory.boxsizes[0]) \
+                if hasattr(self.trajectory, 'boxsizes') else (10, 10, 10)
+        self.boxsize = boxsize
+        if h is None:
+            # see FluidSimulator: h = 2*initial spacing.
+            h = 2.000001 * 0.5*max(boxsize) / (self.N**(1/3.))
+        self.h = h
+        # time between two frames (which need not be one simulation step apart).
+        times = self.trajectory.times
+        self.dt = float(times[1] - times[0]) if len(times) > 1 else 0.
+
+        if device_policy is None:
+            device_policy = DevicePolicy.from_env()
+        elif isinstance(device_policy, str):
+            device_policy = DevicePolicy.from_string(device_policy)
+        self.device_policy = device_policy
+
+        self.ring_size = ring_size
+        # the frame in position (and position_vbo) and its step and time.
+        self.frame_index = 0
+        self.step = int(self.trajectory.steps[0])
+        self.time = float(times[0])
+
+        # seeking increments generation, frames decoded before are dropped.
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.seek_index = 1
+        self.thread = None
+        self.error = None
+
+    def __len__(self):
+        return len(self.trajectory)
+
+    def cl_pick_device(self):
+        return self.device_policy.pick()
+
+    def gl_init(self):
+        """
+        Creates position_vbo holding the first frame and starts decoding the next ones. Needs an OpenGL context.
+        """
+        from OpenGL.arrays import vbo
+        from OpenGL import GL
+
+        self.free_buffers = queue.Queue()
+        for i in range(self.ring_size - 1):
+            self.free_buffers.put(np.zeros((self.N, 4), dtype=np.float32))
+        # (generation, frame index, buffer) of the decoded frames.
+        self.ready = queue.Queue()
+
+        self.position = np.zeros((self.N, 4), dtype=np.float32)
+        self.position[:, :3] = self.trajectory.frame(0)[0]
+        self.position_vbo = vbo.VBO(data=self.position, usage=GL.GL_STREAM_DRAW, target=GL.GL_ARRAY_BUFFER)
+
+        self.thread = threading.Thread(target=self.decode_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decode_frames(self):
+        try:
+            index, generation = 0, None
+            while True:
+                buffer = self.free_buffers.get()
+                if buffer is None:
+                    return
+                with self.lock:
+                    if generation != self.generation:
+                        generation, index = self.generation, self.seek_index
+                position, velocity = self.trajectory.frame(index % len(self))
+                buffer[:, :3] = position
+                self.ready.put((generation, index % len(self), buffer))
+                index += 1
+        except Exception as e:
+            self.error = e
+            # wake up next_frame() if it waits.
+            self.ready.put(None)
+
+    def check_error(self):
+        if self.error is not None:
+            raise RuntimeError('decoding %s failed: %s' % (self.trajectory.path, self.error))
+
+    def next_frame(self, wait=False):
+        """
+        Shows the next decoded frame (the playback loops). If it is not decoded yet, the current frame is
+        kept, unless wait is True. Returns True if the frame changed.
+        """
+        self.check_error()
+        while True:
+            try:
+                item = self.ready.get(block=wait)
+            except queue.Empty:
+                return False
+            self.check_error()
+            generation, index, buffer = item
+            if generation == self.generation:
+                break
+            # decoded before the last seek.
+            self.free_buffers.put(buffer)
+
+        # the buffer shown before is free once the vertex buffer object holds the new one.
+        previous, self.position = self.position, buffer
+        self.position_vbo.set_array(self.position)
+        self.free_buffers.put(previous)
+        self.frame_index = index
+        self.step = int(self.trajectory.steps[index])
+        self.time = float(self.trajectory.times[index])
+        return True
+
+    def seek(self, index):
+        """
+        Continues the playback at frame index: the next frame shown by next_frame(wait=True) is frame index.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame %i out of range, the trajectory has %i frames' % (index, len(self)))
+        with self.lock:
+            self.generation += 1
+            self.seek_index = index
+
+    def close(self):
+        """
+        Stops the decoding thread.
+        """
+        if self.thread is not None:
+            self.free_buffers.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,255 @@
+"""
+Headless batch runner for the fluid simulator.
+
+Runs a FluidSimulator without Qt, OpenGL or Cg, e.g. on render nodes without a display:
+
+    python -m sph.run 8000 --steps 1000 --snapshot-every 100 --output run_8000
+
+Snapshots are written as .npz files (positions, velocities, step, time), timing
+statistics as stats.json into the output directory.
+
+With --checkpoint-every, the full simulation state is saved to output/checkpoint.npz regularly.
+An interrupted run continues from there with:
+
+    python -m sph.run --resume run_8000/checkpoint.npz --steps 1000 --snapshot-every 100 --output run_8000
+"""
+import argparse
+import json
+import os
+import time
+from math import ceil
+
+import numpy as np
+
+from .sph import FluidSimulator
+from .slabs import SlabSimulator
+from .trajectory import TrajectoryWriter, CompactTrajectoryWriter
+from .device import device_info
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m sph.run',
+                                     description='Run the sph fluid simulation without a GUI.')
+    parser.add_argument('N', type=int, nargs='?',
+                        help='number of particles (not needed with --resume).')
+    parser.add_argument('--boxsize', type=float, nargs=3, default=(10, 10, 10), metavar=('X', 'Y', 'Z'),
+                        help='size of the simulation box (default: 10 10 10).')
+    duration = parser.add_mutually_exclusive_group()
+    duration.add_argument('--steps', type=int, default=None,
+                          help='number of simulation steps to run, including the steps before a checkpoint '
+                        'when resuming, so at least the step of the checkpoint (default: 100).')
+    duration.add_argument('--seconds', type=float, default=None,
+                          help='simulated time to run, in seconds. Converted to steps using the timestep dt.')
+    parser.add_argument('--snapshot-every', type=int, default=0, metavar='K',
+                        help='write a snapshot every K steps (default: 0, only the final state).')
+    parser.add_argument('--trajectory-every', type=int, default=0, metavar='K',
+                        help='append the particles every K steps to output/trajectory.npy, written in the background '
+                        'without stalling the simulation (default: 0, no trajectory).')
+    parser.add_argument('--trajectory-format', choices=('float32', 'compact', 'compact-delta'), default='float32',
+                        help="'float32' (trajectory.npy), 'compact' (trajectory.sphq, positions as 16 bit fixed point and "
+                        "velocities as half floats, quantized on the device) or 'compact-delta' (compact, frames between "
+                        "key frames as compressed differences). Read compact trajectories with "
+                        "sph.trajectory.CompactTrajectory. Default: float32.")
+    parser.add_argument('--checkpoint-every', type=int, default=0, metavar='K',
+                        help='save the simulation state to output/checkpoint.npz every K steps (default: 0, never).')
+    parser.add_argument('--resume', default=None, metavar='CHECKPOINT',
+                        help='continue the run saved in CHECKPOINT (N, box size and the grid options are taken from it).')
+    parser.add_argument('--device', default=None, metavar='POLICY',
+                        help="OpenCL device policy, e.g. 'cpu', 'gpu', '1' or 'type=cpu,vendor=intel' "
+                        "(default: $PYSPH_DEVICE, or a GPU with fallback to a CPU device).")
+    parser.add_argument('--backend', choices=FluidSimulator.backends, default='opencl',
+                        help="'opencl', 'numpy' (reference implementation, no OpenCL needed) or 'auto' "
+                        "(opencl, falling back to numpy if there is no device). Default: opencl.")
+    parser.add_argument('--sort-mode', choices=FluidSimulator.sort_modes, default='radix',
+                        help="'radix' (full sort every step) or 'incremental' (fix up the order of the last step, "
+                        "falling back to the radix sort). Default: radix.")
+    parser.add_argument('--hash', choices=FluidSimulator.hash_modes, default='linear',
+                        help="numbering of the grid cells, 'linear' (row-major), 'morton' (Z-order) or 'sparse' "
+                        "(hash table of about 2N buckets, independent of the box size). Default: linear.")
+    parser.add_argument('--clear-mode', choices=FluidSimulator.clear_modes, default='full',
+                        help="how the grid is reset every step, 'full' (all cells) or 'occupied' (only the cells "
+                        "occupied in the last step). Default: full.")
+    parser.add_argument('--slabs', type=int, default=0, metavar='K',
+                        help='split the box into K slabs along its longest axis, one per device of the platform '
+                        '(a CPU device is split into K sub-devices). Needs the radix sort and clear mode full.')
+    parser.add_argument('--balance-every', type=int, default=0, metavar='K',
+                        help='with --slabs, move the slab bounds every K steps so that the slabs hold equally many '
+                        'particles again (default: 0, never).')
+    parser.add_argument('--neighbour-lists', action='store_true',
+                        help='build neighbour lists (radius h + skin) and reuse them for several steps.')
+    parser.add_argument('--cell-kernels', action='store_true',
+                        help='compute density and forces with one work-group per grid cell, staging neighbours in local memory.')
+    parser.add_argument('--profile', action='store_true',
+                        help='record per-kernel device times and add them to stats.json (opencl backend only).')
+    parser.add_argument('--output', default=None,
+                        help='directory for snapshots and stats.json. Nothing is written if omitted.')
+    args = parser.parse_args(argv)
+    if args.N is None and args.resume is None:
+        parser.error('N is required, unless resuming from a checkpoint')
+    if args.slabs and args.trajectory_every:
+        parser.error('--trajectory-every is not supported with --slabs')
+    if args.balance_every and not args.slabs:
+        parser.error('--balance-every needs --slabs')
+    return args
+
+
+def write_snapshot(fluid_simulator, output, step):
+    """
+    Copies positions and velocities to the host and writes them to output/snapshot_<step>.npz.
+    """
+    position = fluid_simulator.get_position()
+    velocity = fluid_simulator.get_velocity()
+    path = os.path.join(output, 'snapshot_%08i.npz' % step)
+    np.savez(path,
+             position=position[:, :3],
+             velocity=velocity[:, :3],
+             step=step,
+             time=step * fluid_simulator.dt)
+    return path
+
+
+def run(fluid_simulator, n_steps, snapshot_every=0, output=None, checkpoint_every=0, trajectory_every=0,
+        trajectory_format='float32', balance_every=0):
+    """
+    Advance the (initialized) fluid simulator until it did n_steps steps (a resumed simulator starts at
+    fluid_simulator.steps, which must not be beyond n_steps), writing snapshots every snapshot_every,
+    checkpoints every checkpoint_every and trajectory frames every trajectory_every steps (see
+    --trajectory-format). A SlabSimulator is balanced every balance_every steps.
+    Returns a dictionary of timing statistics.
+    """
+    snapshot_time = 0.
+    snapshots = 0
+    checkpoint_time = 0.
+    checkpoints = 0
+
+    if output is None:
+        snapshot_every = checkpoint_every = trajectory_every = 0
+
+    first_step = step = fluid_simulator.steps
+    if n_steps < first_step:
+        raise ValueError('the simulator is at step %i, beyond n_steps=%i' % (first_step, n_steps))
+    # frames captured by this run, none if it does not reach the next multiple of trajectory_every.
+    n_frames = max(n_steps // trajectory_every - first_step // trajectory_every, 0) if trajectory_every else 0
+    if not n_frames:
+        trajectory_every = 0
+    # steps at which the simulator stops to write something, n_steps if nothing is written in between.
+    intervals = [every for every in (snapshot_every, checkpoint_every, trajectory_every, balance_every) if every]
+
+    trajectory = None
+    if trajectory_every and trajectory_format == 'float32':
+        # a resumed run appends to the trajectory written before the checkpoint.
+        trajectory = TrajectoryWriter(fluid_simulator, os.path.join(output, 'trajectory.npy'), n_frames,
+                                      append=first_step > 0)
+    elif trajectory_every:
+        trajectory = CompactTrajectoryWriter(fluid_simulator, os.path.join(output, 'trajectory.sphq'),
+                                             delta=trajectory_format == 'compact-delta', append=first_step > 0)
+
+    t_start = time.time()
+    while step < n_steps:
+        batch = min([n_steps - step] + [every - step % every for every in intervals])
+        fluid_simulator.advance(batch)
+        step += batch
+        if balance_every and step % balance_every == 0:
+            fluid_simulator.balance()
+        if trajectory_every and step % trajectory_every == 0:
+            trajectory.capture()
+        if snapshot_every and step % snapshot_every == 0:
+            t = time.time()
+            write_snapshot(fluid_simulator, output, step)
+            snapshot_time += time.time() - t
+            snapshots += 1
+        if checkpoint_every and step % checkpoint_every == 0:
+            t = time.time()
+            fluid_simulator.save_checkpoint(os.path.join(output, 'checkpoint.npz'))
+            checkpoint_time += time.time() - t
+            checkpoints += 1
+    if trajectory is not None:
+        trajectory.close()
+    total_time = time.time() - t_start
+
+    if output is not None and (not snapshot_every or n_steps % snapshot_every != 0):
+        t = time.time()
+        write_snapshot(fluid_simulator, output, n_steps)
+        snapshot_time += time.time() - t
+        snapshots += 1
+
+    steps = n_steps - first_step
+    step_time = total_time - snapshot_time - checkpoint_time
+    return {
+        'steps': steps,
+        'first_step': first_step,
+        'simulated_seconds': steps * fluid_simulator.dt,
+        'total_seconds': total_time,
+        'step_seconds': step_time,
+        'snapshot_seconds': snapshot_time,
+        'snapshots': snapshots,
+        'checkpoint_seconds': checkpoint_time,
+        'checkpoints': checkpoints,
+        'mean_step_ms': 1000 * step_time / steps if steps > 0 else 0.,
+        'steps_per_second': steps / step_time if step_time > 0 else 0.,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    t = time.time()
+    simulator_class = SlabSimulator if args.slabs else FluidSimulator
+    slab_options = dict(number_of_slabs=args.slabs) if args.slabs else {}
+    if args.resume is not None:
+        fluid_simulator = simulator_class.from_checkpoint(args.resume, gl_interop=False, device_policy=args.device,
+                                                          backend=args.backend, profile=args.profile, **slab_options)
+        print('resuming from %s at step %i' % (args.resume, fluid_simulator.steps))
+    else:
+        fluid_simulator = simulator_class(args.N, tuple(args.boxsize), gl_interop=False,
+                                          device_policy=args.device, backend=args.backend, sort_mode=args.sort_mode,
+                                          profile=args.profile, neighbour_lists=args.neighbour_lists,
+                                          hash_mode=args.hash, cell_kernels=args.cell_kernels, clear_mode=args.clear_mode,
+                                          **slab_options)
+    fluid_simulator.cl_init()
+    init_time = time.time() - t
+
+    if args.seconds is not None:
+        n_steps = int(ceil(args.seconds / fluid_simulator.dt))
+    elif args.steps is not None:
+        n_steps = args.steps
+    else:
+        n_steps = 100
+    if n_steps < fluid_simulator.steps:
+        raise SystemExit('error: %s is at step %i, run at least that many steps (--steps or --seconds)' % (
+            args.resume, fluid_simulator.steps))
+
+    if args.output is not None and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    stats = run(fluid_simulator, n_steps, args.snapshot_every, args.output, args.checkpoint_every, args.trajectory_every,
+                args.trajectory_format, args.balance_every)
+    stats.update(N=fluid_simulator.N,
+                 boxsize=list(fluid_simulator.boxsize),
+                 dt=fluid_simulator.dt,
+                 init_seconds=init_time,
+                 backend=fluid_simulator.backend)
+    if fluid_simulator.backend == 'opencl':
+        stats['device'] = device_info(fluid_simulator.device)
+    if args.profile and fluid_simulator.backend == 'opencl':
+        stats['kernels'] = fluid_simulator.stats()
+    if fluid_simulator.neighbour_lists and fluid_simulator.backend == 'opencl':
+        stats['neighbour_lists'] = dict(fluid_simulator.neighbour_list_stats,
+                                        max_neighbours=fluid_simulator.max_neighbours)
+    if args.slabs:
+        stats['slabs'] = dict(fluid_simulator.slab_stats,
+                              bounds=[float(b) for b in fluid_simulator.bounds],
+                              particles=[slab.n_owned for slab in fluid_simulator.slabs],
+                              devices=[device_info(device) for device in fluid_simulator.devices])
+    if fluid_simulator.sort_mode == 'incremental':
+        stats['sort_stats'] = fluid_simulator.sort_stats
+
+    print('%i steps (%.3f simulated seconds) in %.2fs, %.2f ms/step' % (
+            stats['steps'], stats['simulated_seconds'], stats['step_seconds'], stats['mean_step_ms']))
+
+    if args.output is not None:
+        with open(os.path.join(args.output, 'stats.json'), 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Initial particle configurations.
+
+A Scene is a list of shapes (boxes and spheres) that are filled with particles on a cubic
+lattice, using NumPy:
+
+    scene = Scene().box((0, 0, 0), (4, 2, 10)).sphere((7, 6, 5), 2)
+    fluid_simulator = FluidSimulator(100000, scene=scene)
+
+The lattice spacing is chosen such that the shapes hold exactly the requested number of particles.
+"""
+import numpy as np
+
+
+class Box(object):
+    def __init__(self, lower, upper):
+        self.lower = np.array(lower, dtype=np.float64)
+        self.upper = np.array(upper, dtype=np.float64)
+        if self.lower.shape != (3,) or self.upper.shape != (3,):
+            raise ValueError('box corners must have 3 coordinates')
+        if np.any(self.upper <= self.lower):
+            raise ValueError('box %s - %s is empty' % (tuple(self.lower), tuple(self.upper)))
+
+    def volume(self):
+        return np.prod(self.upper - self.lower)
+
+    def describe(self):
+        return ['box', self.lower.tolist(), self.upper.tolist()]
+
+    def lattice(self, spacing):
+        """
+        Particles at the centers of the cubes of size spacing that fit into the box, from the bottom (y) up.
+        """
+        # the epsilon keeps a box of exactly n*spacing from losing a layer to rounding.
+        counts = np.floor((self.upper - self.lower) / spacing + 1e-6).astype(np.int64)
+        # y is the slowest axis, so that the last particles are the top layer.
+        y, z, x = np.meshgrid(*[np.arange(counts[axis]) for axis in (1, 2, 0)], indexing='ij')
+        cells = np.column_stack((x.ravel(), y.ravel(), z.ravel()))
+        return self.lower + (cells + 0.5) * spacing
+
+
+class Sphere(object):
+    def __init__(self, center, radius):
+        self.center = np.array(center, dtype=np.float64)
+        self.radius = float(radius)
+        if self.center.shape != (3,):
+            raise ValueError('sphere center must have 3 coordinates')
+        if self.radius <= 0:
+            raise ValueError('sphere radius must be positive')
+
+    def volume(self):
+        return 4. / 3. * np.pi * self.radius**3
+
+    def describe(self):
+        return ['sphere', self.center.tolist(), self.radius]
+
+    def lattice(self, spacing):
+        """
+        Particles of the lattice of the bounding box that are inside the sphere, from the bottom (y) up.
+        """
+        bounds = Box(self.center - self.radius, self.center + self.radius)
+        position = bounds.lattice(spacing)
+        inside = np.sum((position - self.center)**2, axis=1) <= self.radius**2
+        return position[inside]
+
+
+class Scene(object):
+    """
+    Shapes filled with particles. The shapes should not overlap.
+    """
+    def __init__(self, shapes=None):
+        self.shapes = list(shapes or [])
+
+    def box(self, lower, upper):
+        """
+        Adds the box from corner lower to corner upper. Returns the scene.
+        """
+        self.shapes.append(Box(lower, upper))
+        return self
+
+    def boxes(self, boxes):
+        """
+        Adds a list of (lower, upper) boxes. Returns the scene.
+        """
+        for lower, upper in boxes:
+            self.box(lower, upper)
+        return self
+
+    def sphere(self, center, radius):
+        """
+        Adds a sphere. Returns the scene.
+        """
+        self.shapes.append(Sphere(center, radius))
+        return self
+
+    def volume(self):
+        return sum(shape.volume() for shape in self.shapes)
+
+    def describe(self):
+        """
+        The shapes as a list of lists like ['box', lower, upper] (e.g. to store them as JSON).
+        """
+        return [shape.describe() for shape in self.shapes]
+
+    @classmethod
+    def from_description(cls, description):
+        """
+        The scene described by describe().
+        """
+        shapes = {'box': Box, 'sphere': Sphere}
+        return cls([shapes[shape[0]](*shape[1:]) for shape in description])
+
+    def lattice(self, spacing):
+        """
+        All lattice positions of all shapes (float64, shape (n, 3)), shape by shape.
+        """
+        if not self.shapes:
+            raise ValueError('the scene is empty')
+        return np.concatenate([shape.lattice(spacing) for shape in self.shapes])
+
+    def spacing(self, N):
+        """
+        The largest lattice spacing (up to 1%) at which the shapes hold at least N particles.
+        """
+        spacing = (self.volume() / N)**(1/3.)
+        # less particles fit than the volume suggests, because of the partial cubes at the boundaries.
+        while len(self.lattice(spacing)) < N:
+            spacing *= 0.99
+        return spacing
+
+    def positions(self, N, spacing=None):
+        """
+        Positions of exactly N particles as a (N, 4) float32 array (w = 0), for FluidSimulator.position.
+        spacing: lattice spacing, chosen with spacing() if None. If the shapes hold more than N particles,
+        the top layer of the last shape is left partially empty.
+        """
+        if spacing is None:
+            spacing = self.spacing(N)
+        lattice = self.lattice(spacing)
+        if len(lattice) < N:
+            raise ValueError('the scene only holds %i particles at spacing %s, not %i' % (len(lattice), spacing, N))
+        position = np.zeros((N, 4), dtype=np.float32)
+        position[:, :3] = lattice[:N]
+        return position
+
+
+def dam_break(N, boxsize, spacing):
+    """
+    The default scene: one large and two smaller cubes (about half the side length) in the corners of the
+    box, holding N particles at spacing. The large cube holds about 80% of the particles, the small ones
+    about 10% each. The last small cube takes the rest, only its top layer is left partially empty.
+    """
+    # sides in particles: the large cube holds about N/1.25 (n**3 + 2*(n/2)**3 = N), the small cubes the rest.
+    large = max(1, int(round((N / 1.25)**(1/3.))))
+    while large > 1 and large**3 >= N:
+        large -= 1
+    rest = N - large**3
+    small = max(1, int(round((rest / 2.)**(1/3.))))
+    # layers of the last cube, about small.
+    height = max(1, -(-(rest - small**3) // small**2))
+    large, small, height = large * spacing, small * spacing, height * spacing
+    bx, by, bz = boxsize
+    return Scene().box((0, 0.01*by, bz - large), (large, 0.01*by + large, bz)) \
+                  .box((0.01*bx, by - small, bz - small), (0.01*bx + small, by, bz)) \
+                  .box((bx - small, 0.15*by, 0), (bx, 0.15*by + height, small))
@@ -0,0 +1,429 @@
+"""
+Domain decomposition of the simulation over several OpenCL devices.
+
+A SlabSimulator splits the box into slabs along its longest axis, one per device. All devices share one
+context, each slab is simulated by a Slab (a FluidSimulator for a varying number of particles) on the
+queue of its device:
+
+    fluid_simulator = SlabSimulator(100000, number_of_slabs=2, device_policy='cpu')
+    fluid_simulator.cl_init()
+    fluid_simulator.advance(100)
+
+A slab holds the particles it owns, followed by the halo: copies of the particles of the neighbouring
+slabs within halo_width of its boundaries. Every slab computes densities, forces and moves for all its
+particles, which is exact for the particles it owns: their neighbours (closer than h) are owned or in the
+halo, and so are the neighbours of these neighbours, whose densities enter the forces.
+
+Before each step, a kernel (splitSlab in sph.cl) splits the owned particles of every slab into the ones it
+keeps and the ones that moved into another slab or are in the halo of a neighbouring slab. Only the latter
+are read back and sent to their slabs, the host only waits for the number of particles per slab.
+
+Without several devices of the same type (e.g. on a CPU), the device picked by the device policy is split
+into sub-devices (device fission, see DevicePolicy.pick_many()).
+"""
+import struct
+from math import ceil
+from collections import deque
+
+import numpy as np
+import pyopencl as cl
+
+from .sph import FluidSimulator
+from .device import describe_device
+
+
+def round_up(n, multiple):
+    return int(ceil(n / float(multiple))) * multiple
+
+
+class Slab(FluidSimulator):
+    """
+    One slab of a SlabSimulator: a FluidSimulator on one device of the shared context, for the first n of
+    its N (the capacity) particles. The first n_owned of them are owned by the slab, the rest is the halo.
+    """
+    # the capacity is a multiple of the sorted length (see sort_length()), and grows by this factor if needed.
+    sort_block = 512
+    growth = 1.5
+
+    def __init__(self, simulator, index, device, capacity):
+        # the options and parameters (grid, h, mass, ...) are the ones of the simulator, the particles are not.
+        self.__dict__.update((name, value) for name, value in simulator.__dict__.items()
+                             if name not in simulator.slab_attributes)
+        self.simulator = simulator
+        self.index = index
+        self.device = device
+        self.ctx = simulator.ctx
+        self.reset_stats()
+        # sized for the number of particles in the slab, only matters for the sparse hash table.
+        self.resize(capacity)
+        self.n = self.n_owned = 0
+
+    def resize(self, capacity):
+        """
+        Sets the capacity N and sizes the host arrays and the grid for it (the device buffers are created
+        by cl_init()). Keeps the first n particles.
+        """
+        n = getattr(self, 'n', 0)
+        self.N = round_up(capacity, self.sort_block)
+        for name, dtype, width in (('position', np.float32, 4), ('velocity', np.float32, 4), ('id', np.uint32, 1)):
+            array = np.zeros((self.N, width) if width > 1 else self.N, dtype=dtype)
+            if n:
+                array[:n] = getattr(self, name)[:n]
+            setattr(self, name, array)
+        self.init_grid()
+        local_size = self.local_size[0]
+        self.global_size = (round_up(self.N, local_size), )
+        self.capacity_out = max(self.sort_block, self.N // 4)
+
+    def cl_init_context(self):
+        properties = cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE
+        if self.profile:
+            properties |= cl.command_queue_properties.PROFILING_ENABLE
+        self.queue = cl.CommandQueue(self.ctx, device=self.device, properties=properties)
+
+    def cl_init_data(self):
+        FluidSimulator.cl_init_data(self)
+        mf = cl.mem_flags
+        si = np.nbytes[np.uint32]
+        self.id_cl = cl.Buffer(self.ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=self.id)
+        self.id_kept_cl = cl.Buffer(self.ctx, mf.READ_WRITE, size=self.N*si)
+        self.counts = np.zeros(2, dtype=np.uint32)
+        self.counts_cl = cl.Buffer(self.ctx, mf.READ_WRITE, size=2*si)
+        self.cl_init_out()
+
+    def cl_init_out(self):
+        """
+        Allocates the buffers for capacity_out outgoing particles.
+        """
+        mf = cl.mem_flags
+        sf, si = np.nbytes[np.float32], np.nbytes[np.uint32]
+        n = self.capacity_out
+        self.position_out_cl = cl.Buffer(self.ctx, mf.READ_WRITE, size=4*n*sf)
+        self.velocity_out_cl = cl.Buffer(self.ctx, mf.READ_WRITE, size=4*n*sf)
+        self.id_out_cl = cl.Buffer(self.ctx, mf.READ_WRITE, size=n*si)
+        self.target_out_cl = cl.Buffer(self.ctx, mf.READ_WRITE, size=n*si)
+
+    def cl_init_kernels(self):
+        FluidSimulator.cl_init_kernels(self)
+        self.clear_counts_kernel = cl.Kernel(self.prg, 'memset')
+        self.clear_counts_kernel.set_args(self.counts_cl, np.uint32(0), np.uint32(2))
+        self.split_kernel = cl.Kernel(self.prg, 'splitSlab')
+
+    def pack_params(self):
+        # the kernels only see the n particles of the slab.
+        return struct.pack('I', self.n) + FluidSimulator.pack_params(self)[4:]
+
+    def sort_length(self):
+        # sorting a multiple of sort_block keeps the number of differently sized sorts (and the kernels
+        # RadixSort binds for each of them) small, although n changes every step.
+        return min(self.N, round_up(max(self.n, 1), self.sort_block))
+
+    def enqueue_split(self):
+        """
+        Enqueues splitSlab for the owned particles and the read of the counts. Returns the event of the read.
+        """
+        simulator = self.simulator
+        self.split_kernel.set_args(self.position_cl, self.velocity_cl, self.id_cl,
+                                   self.position_sorted_cl, self.velocity_sorted_cl, self.id_kept_cl,
+                                   self.position_out_cl, self.velocity_out_cl, self.id_out_cl, self.target_out_cl,
+                                   self.counts_cl, simulator.bounds_cl,
+                                   np.uint32(self.index), np.uint32(simulator.number_of_slabs), np.uint32(simulator.axis),
+                                   np.float32(simulator.halo_width), np.uint32(self.n_owned), np.uint32(self.capacity_out))
+        local_size = (self.wg_size, )
+        event = self.enqueue_kernel(self.clear_counts_kernel, local_size, local_size, wait_for=self.wait_for_last(),
+                                    name='memset(counts)')
+        self.split_event = self.enqueue_kernel(self.split_kernel, (round_up(max(self.n_owned, 1), self.wg_size), ),
+                                               local_size, wait_for=[event])
+        return cl.enqueue_copy(self.queue, self.counts, self.counts_cl, is_blocking=False, wait_for=[self.split_event])
+
+    def enqueue_read_out(self):
+        """
+        Enqueues the reads of the outgoing particles, and copies the kept particles back to the start of the
+        particle buffers. Returns the events.
+        """
+        kept, out = [int(c) for c in self.counts]
+        sf, si = np.nbytes[np.float32], np.nbytes[np.uint32]
+        wait_for = [self.split_event]
+        events = []
+        self.out = (np.empty((out, 4), dtype=np.float32), np.empty((out, 4), dtype=np.float32),
+                    np.empty(out, dtype=np.uint32), np.empty(out, dtype=np.uint32))
+        if out:
+            for host, device in zip(self.out, (self.position_out_cl, self.velocity_out_cl, self.id_out_cl, self.target_out_cl)):
+                events.append(cl.enqueue_copy(self.queue, host, device, is_blocking=False, wait_for=wait_for))
+        if kept:
+            events += [cl.enqueue_copy(self.queue, self.position_cl, self.position_sorted_cl, byte_count=kept*4*sf, wait_for=wait_for),
+                       cl.enqueue_copy(self.queue, self.velocity_cl, self.velocity_sorted_cl, byte_count=kept*4*sf, wait_for=wait_for),
+                       cl.enqueue_copy(self.queue, self.id_cl, self.id_kept_cl, byte_count=kept*si, wait_for=wait_for)]
+        self.queue.flush()
+        return events
+
+    def enqueue_load(self, n_owned, position, velocity, id, offset=0, wait_for=None):
+        """
+        Enqueues the upload of particles (owned ones first, then the halo) after the first offset particles,
+        which are owned, and sets n_owned and n. The host arrays must not change until the upload is done.
+        Grows the slab if needed. Returns the events of the uploads.
+        """
+        n = offset + len(position)
+        if n > self.N:
+            if wait_for:
+                cl.wait_for_events(wait_for)
+            self.grow(n, offset)
+        self.n_owned = n_owned
+        self.n = n
+        sf, si = np.nbytes[np.float32], np.nbytes[np.uint32]
+        self.pending = (position, velocity, id)
+        events = [cl.enqueue_copy(self.queue, self.params_cl, self.pack_params(), wait_for=wait_for)]
+        if len(position):
+            events += [cl.enqueue_copy(self.queue, self.position_cl, position, device_offset=offset*4*sf,
+                                       is_blocking=False, wait_for=wait_for),
+                       cl.enqueue_copy(self.queue, self.velocity_cl, velocity, device_offset=offset*4*sf,
+                                       is_blocking=False, wait_for=wait_for),
+                       cl.enqueue_copy(self.queue, self.id_cl, id, device_offset=offset*si,
+                                       is_blocking=False, wait_for=wait_for)]
+        return events
+
+    def grow(self, n, keep):
+        """
+        Grows the capacity to hold n particles, keeping the first keep particles on the device.
+        """
+        if keep:
+            for host, device in ((self.position, self.position_cl), (self.velocity, self.velocity_cl), (self.id, self.id_cl)):
+                cl.enqueue_copy(self.queue, host, device, wait_for=self.wait_for_last())
+        self.n = keep
+        self.resize(max(n, int(self.N * self.growth)))
+        self.simulator.slab_stats['grows'] += 1
+        self.cl_init()
+
+    def read_owned(self, name):
+        """
+        The owned particles (name 'position' or 'velocity') and their ids, copied to the host.
+        """
+        host = np.empty((self.n_owned, 4), dtype=np.float32)
+        id = np.empty(self.n_owned, dtype=np.uint32)
+        if self.n_owned:
+            cl.enqueue_copy(self.queue, host, getattr(self, name + '_cl'), wait_for=self.wait_for_last())
+            cl.enqueue_copy(self.queue, id, self.id_cl, wait_for=self.wait_for_last())
+        return host, id
+
+
+class SlabSimulator(FluidSimulator):
+    """
+    FluidSimulator that splits the box into number_of_slabs slabs along its longest axis, one per device
+    (see the module docstring). Supports the radix sort, the grid hashes and full clearing of the grid.
+    Positions and velocities (get_position(), checkpoints, ...) are in the order of the particles of a
+    FluidSimulator, the order of the particles on the devices changes every step.
+    cl_init() chooses the bounds of the slabs such that they own equally many particles, balance() moves
+    them again when the fluid has moved.
+    """
+    checkpoint_options = FluidSimulator.checkpoint_options + ('number_of_slabs', )
+    # the particles are spread over the slabs, there are no buffers holding all of them.
+    state_on_device = False
+    # attributes of the simulator not shared with its slabs.
+    slab_attributes = ('slabs', 'devices', 'bounds', 'bounds_cl', 'slab_stats', 'prg', 'position', 'velocity')
+
+    def __init__(self, N, boxsize=(10,10,10), number_of_slabs=2, **kwargs):
+        """
+        number_of_slabs: number of slabs and devices. The other arguments are those of FluidSimulator.
+        The grid memory of every slab scales with the number of cells of the box, unless hash_mode='sparse'.
+        """
+        FluidSimulator.__init__(self, N, boxsize, **kwargs)
+        assert number_of_slabs >= 1, "need at least one slab"
+        assert self.backend == 'opencl', "slabs need the opencl backend"
+        assert not self.gl_interop, "slabs do not support gl interop"
+        assert self.sort_mode == 'radix', "slabs need the radix sort"
+        assert self.clear_mode == 'full', "slabs need clear_mode='full'"
+        assert not (self.neighbour_lists or self.cell_kernels), "slabs do not support neighbour lists or cell kernels"
+        self.number_of_slabs = number_of_slabs
+        self.axis = int(np.argmax(boxsize))
+        # chosen by cl_init(), unless set with set_bounds() before.
+        self.bounds = None
+        # particles sent to other slabs (moved or halo copies), the largest number of particles of a slab and
+        # how often a slab had to grow its buffers.
+        self.slab_stats = {'migrated': 0, 'halo': 0, 'max_particles': 0, 'grows': 0}
+
+    @property
+    def halo_width(self):
+        # neighbours of halo particles closer to the slab than h enter the forces through their density,
+        # so the halo needs two cells.
+        return 2 * self.cell_size
+
+    def set_bounds(self, bounds):
+        """
+        Sets the bounds of the slabs along the axis, slab s owns [bounds[s], bounds[s+1]) (number_of_slabs + 1
+        bounds, the first and the last slab extend to infinity). Call set_positions() afterwards if initialized.
+        """
+        bounds = np.array(bounds, dtype=np.float32)
+        assert len(bounds) == self.number_of_slabs + 1 and np.all(np.diff(bounds) > 0), "bounds must increase"
+        # the halo of a slab is taken from its neighbouring slabs only.
+        if np.any(np.diff(bounds)[1:-1] < self.halo_width):
+            raise ValueError('slabs %s are thinner than the halo (%s), use fewer slabs' % (bounds, self.halo_width))
+        self.bounds = bounds
+        if hasattr(self, 'bounds_cl'):
+            cl.enqueue_copy(self.slabs[0].queue, self.bounds_cl, self.bounds)
+
+    def balanced_bounds(self, position):
+        """
+        Bounds such that all slabs own about the same number of the positions (at least halo_width apart).
+        """
+        bounds = np.percentile(position[:, self.axis], np.linspace(0, 100, self.number_of_slabs + 1))
+        bounds[0] = 0
+        for s in range(1, self.number_of_slabs):
+            bounds[s] = max(bounds[s], bounds[s-1] + self.halo_width)
+        bounds[-1] = max(self.boxsize[self.axis], bounds[-2] + self.halo_width)
+        return bounds
+
+    def balance(self):
+        """
+        Moves the bounds such that all slabs own about the same number of particles again (the fluid moves
+        between the slabs) and redistributes the particles. Copies all particles to the host and back.
+        """
+        self.set_bounds(self.balanced_bounds(self.get_position()))
+        self.get_velocity()
+        self.set_positions()
+
+    def owners(self, position):
+        """
+        Slab index owning each of the positions, like splitSlab.
+        """
+        return np.searchsorted(self.bounds[1:-1], position[:, self.axis], side='right')
+
+    def cl_init(self):
+        self.devices = self.device_policy.pick_many(self.number_of_slabs)
+        self.device = self.devices[0]
+        for device in self.devices:
+            print('using device %s' % describe_device(device))
+        self.ctx = cl.Context(self.devices)
+        if self.bounds is None:
+            self.set_bounds(self.balanced_bounds(self.position))
+        self.bounds_cl = cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=self.bounds)
+
+        counts = np.bincount(self.owners(self.position), minlength=self.number_of_slabs)
+        self.slabs = [Slab(self, index, device, int(count * 1.25) + Slab.sort_block)
+                      for index, (device, count) in enumerate(zip(self.devices, counts))]
+        for slab in self.slabs:
+            slab.cl_init()
+        # the program of the slabs (they all build the same source), also marks the simulator as initialized.
+        self.prg = self.slabs[0].prg
+        self.set_positions()
+
+    def set_positions(self):
+        """
+        Distributes the positions and velocities to the slabs that own them (the halos are exchanged by the next step).
+        """
+        owners = self.owners(self.position)
+        events = []
+        for slab in self.slabs:
+            id = np.flatnonzero(owners == slab.index).astype(np.uint32)
+            events += slab.enqueue_load(len(id), self.position[id], self.velocity[id], id,
+                                        wait_for=slab.wait_for_last())
+        cl.wait_for_events(events)
+        for slab in self.slabs:
+            slab.last_event = None
+
+    def set_params(self, **params):
+        FluidSimulator.set_params(self, **params)
+        if hasattr(self, 'slabs'):
+            for slab in self.slabs:
+                slab.set_params(**params)
+
+    def exchange(self):
+        """
+        Splits the owned particles of all slabs and sends the particles that moved into another slab, and the
+        halo copies, to their slabs. Waits for the previous step. Returns the events to wait for, per slab.
+        """
+        slabs = self.slabs
+        cl.wait_for_events([slab.enqueue_split() for slab in slabs])
+        for slab in slabs:
+            if slab.counts[1] > slab.capacity_out:
+                # splitSlab only reads the particles, split again with room for all outgoing ones.
+                slab.capacity_out = round_up(int(slab.counts[1] * Slab.growth), Slab.sort_block)
+                slab.cl_init_out()
+                slab.enqueue_split().wait()
+
+        read_events = [slab.enqueue_read_out() for slab in slabs]
+        events = [event for events in read_events for event in events]
+        if events:
+            cl.wait_for_events(events)
+
+        position, velocity, id, target = [np.concatenate(arrays) for arrays in zip(*[slab.out for slab in slabs])]
+        halo = target % 2 == 1
+        self.slab_stats['migrated'] += int(np.count_nonzero(~halo))
+        self.slab_stats['halo'] += int(np.count_nonzero(halo))
+
+        wait_fors = []
+        for slab, events in zip(slabs, read_events):
+            kept = int(slab.counts[0])
+            owned = np.flatnonzero(target == 2*slab.index)
+            incoming = np.concatenate((owned, np.flatnonzero(target == 2*slab.index + 1)))
+            wait_fors.append(slab.enqueue_load(kept + len(owned), position[incoming], velocity[incoming], id[incoming],
+                                               offset=kept, wait_for=events))
+            self.slab_stats['max_particles'] = max(self.slab_stats['max_particles'], slab.n)
+        return wait_fors
+
+    def step(self):
+        """
+        Advance simulation. Exchanges the particles between the slabs first, which waits for the last step.
+        """
+        self.steps += 1
+        for slab, wait_for in zip(self.slabs, self.exchange()):
+            slab.last_event = slab.enqueue_step(wait_for)
+            slab.queue.flush()
+        self.collect_slab_profiles()
+
+    def advance(self, n_steps):
+        """
+        Advance simulation by n_steps, then wait for the steps to finish. The slabs step concurrently,
+        but they exchange particles between the steps.
+        """
+        for i in range(n_steps):
+            self.step()
+        self.finish()
+        self.collect_profile()
+
+    def collect_slab_profiles(self):
+        if len(self.slabs[0].profile_events) > self.profile_window:
+            self.collect_profile()
+
+    def collect_profile(self):
+        """
+        Collects the kernel times of all slabs.
+        """
+        for slab in getattr(self, 'slabs', []):
+            slab.collect_profile()
+            for name, times in slab.kernel_times.items():
+                if name not in self.kernel_times:
+                    self.kernel_times[name] = dict(times, recent=deque(times['recent'], maxlen=self.profile_window))
+                else:
+                    mine = self.kernel_times[name]
+                    mine['count'] += times['count']
+                    mine['total'] += times['total']
+                    mine['recent'].extend(times['recent'])
+            slab.reset_stats()
+
+    def reset_stats(self):
+        FluidSimulator.reset_stats(self)
+        for slab in getattr(self, 'slabs', []):
+            slab.reset_stats()
+
+    def finish(self):
+        for slab in self.slabs:
+            slab.queue.finish()
+
+    def gather(self, name):
+        array = getattr(self, name)
+        for slab in self.slabs:
+            owned, id = slab.read_owned(name)
+            array[id] = owned
+        return array
+
+    def get_position(self):
+        """
+        Copies the positions of the particles owned by the slabs to the host.
+        """
+        return self.gather('position')
+
+    def get_velocity(self):
+        """
+        Copies the velocities of the particles owned by the slabs to the host.
+        """
+        return self.gather('velocity')
@@ -2,21 +2,38 @@
 #define M_PI 3.14159265358979323846
 #endif
 
+// must match FluidSimulator.pack_params() in sph.py.
+// can be changed between steps (FluidSimulator.set_params()), without compiling the program again.
+// an ensemble (see ensemble.py) passes an array with the Params of every member.
 typedef struct Params {
   uint N;
   float dt;
   float mass;
-  int numberOfCells;
+  // smoothing length, and the normalization factors of the smoothing kernels for it.
+  float h;
+  float kernelM4Factor;
+  float kernelM4DFactor;
+  float kernelViscFactor;
+  // squared radius of the neighbour lists (h + skin).
+  float neighbourRadius2;
+  // gas constant, rest density
+  float k;
+  float density0;
+  float viscosity;
+  float boxsize[3];
 } Params;
 
 __constant int3 NC = (int3)(${'%i,%i,%i' % number_of_cells});
-__constant float h = ${h};
-__constant float h2 = ${h*h};
-__constant float h3 = ${h**3};
-__constant float h5 = ${h**5};
 
 <%def name="loopneighbours()">
-  % if not use_grid:
+  % if neighbour_lists:
+  // go through the neighbour list built by buildNeighbourLists()
+  const uint neighbourCount_i = neighbourCount[i];
+  for(uint k = 0; k < neighbourCount_i; ++k) {
+    const uint j = neighbours[k*params->N + i];
+    ${caller.body()}
+  }
+  % elif not use_grid:
   // brutefoce, go through all particles
   for(uint j = 0; j < params->N; ++j) {
     ${caller.body()}
@@ -24,13 +41,7 @@ __constant float h5 = ${h**5};
   % else :
   // loop through neighbors efficiently using the grid
   const int3 gridPos = getGridPosition(x);
-  const int zi_min = max(0, gridPos.z-1), zi_max = min(NC.z-1, gridPos.z+1);
-  const int yi_min = max(0, gridPos.y-1), yi_max = min(NC.y-1, gridPos.y+1);
-  const int xi_min = max(0, gridPos.x-1), xi_max = min(NC.x-1, gridPos.x+1);
-  for(int zi = zi_min; zi <= zi_max; zi++) {
-    for(int yi = yi_min; yi <= yi_max; yi++) {
-      for(int xi = xi_min; xi <= xi_max; xi++) {
-	const uint hash = getGridHash((int3)(xi,yi,zi));
+  <%self:loopcells>
 	const uint startIndex = cellStart[hash];
 	if (startIndex == (uint)-1) continue;
 	const uint endIndex = cellEnd[hash];
@@ -43,10 +54,54 @@ __constant float h5 = ${h**5};
 
 	  ${caller.body()}
 	}
+  </%self:loopcells>
+% endif
+</%def>
+
+<%def name="member(index)">
+  % if ensemble:
+  // the member of the ensemble the particle with (unsorted) index belongs to: its parameters and its
+  // range of grid hashes.
+  const uint member = (${index}) / ${member_size}u;
+  params += member;
+  const uint memberHash = member * ${number_of_hashes}u;
+  % endif
+</%def>
+
+<%def name="loopcells()">
+  // visits the grid cells around gridPos, hash is the grid hash of the cell.
+  % if hash_mode == 'sparse':
+  // the grid is unbounded. cells of the neighbourhood can share a bucket of the hash table, each
+  // bucket is visited once. buckets also contain particles of far away cells, which are further
+  // than h and do not contribute.
+  uint visited[27];
+  uint visitedCount = 0;
+  for(int zi = gridPos.z-1; zi <= gridPos.z+1; zi++) {
+    for(int yi = gridPos.y-1; yi <= gridPos.y+1; yi++) {
+      for(int xi = gridPos.x-1; xi <= gridPos.x+1; xi++) {
+	const uint hash = ${'memberHash + ' if ensemble else ''}getGridHash((int3)(xi,yi,zi));
+	bool seen = false;
+	for(uint v = 0; v < visitedCount; v++)
+	  seen |= visited[v] == hash;
+	if(seen) continue;
+	visited[visitedCount++] = hash;
+	${caller.body()}
       }
     }
   }
-% endif
+  % else:
+  const int zi_min = max(0, gridPos.z-1), zi_max = min(NC.z-1, gridPos.z+1);
+  const int yi_min = max(0, gridPos.y-1), yi_max = min(NC.y-1, gridPos.y+1);
+  const int xi_min = max(0, gridPos.x-1), xi_max = min(NC.x-1, gridPos.x+1);
+  for(int zi = zi_min; zi <= zi_max; zi++) {
+    for(int yi = yi_min; yi <= yi_max; yi++) {
+      for(int xi = xi_min; xi <= xi_max; xi++) {
+	const uint hash = ${'memberHash + ' if ensemble else ''}getGridHash((int3)(xi,yi,zi));
+	${caller.body()}
+      }
+    }
+  }
+  % endif
 </%def>
 
 
@@ -56,25 +111,25 @@ inline float vlen(const float3 x) {
   return sqrt(dot(x,x));
 }
 
-inline float kernelM4(const float x) {
-  const float q = x / h;
+inline float kernelM4(const float x, __constant Params *params) {
+  const float q = x / params->h;
   if(q >= 1.f)
     return 0.f;
   
-  const float factor = ${2.546479089470325472 / h**3};
+  const float factor = params->kernelM4Factor;
   if(q < .5f)
     return factor * (1.f - 6.f * q * q * (1 - q));
   float a = 1.f - q;
   return factor * 2.f * a*a*a;
 }
 
-inline float kernelM4_d(const float x) {
-  const float q = x / h;
+inline float kernelM4_d(const float x, __constant Params *params) {
+  const float q = x / params->h;
   
   if(q >= 1.f)
     return 0.f;
   
-  const float factor = ${2.546479089470325472 / h**5};
+  const float factor = params->kernelM4DFactor;
   if(q < .5f)
     return factor * (-12.f + 18.f * q);
   
@@ -82,10 +137,10 @@ inline float kernelM4_d(const float x) {
 }
 
 // laplacian of Wviscosity as in Stefan Auer's thesis
-inline float kernelVisc_dd(const float x) {
-  const float q = x / h;
+inline float kernelVisc_dd(const float x, __constant Params *params) {
+  const float q = x / params->h;
   if(q <= 1.f)
-    return -45.f / (M_PI * h5)*(1-q);
+    return params->kernelViscFactor*(1-q);
   
   return 0.f;
 }
@@ -94,15 +149,56 @@ inline float kernelVisc_dd(const float x) {
 % if use_grid:
 // only need those functions if we are using a grid based search
 
+% if hash_mode == 'sparse':
+// the sparse grid is unbounded, cells are numbered from the origin in all directions.
+inline int3 getGridPosition(float3 position) {
+  return convert_int3_rtn(position * ${1./cell_size}f);
+}
+% else:
 inline int3 getGridPosition(float3 position) {
   position.x *= ${number_of_cells[0]/float(boxsize[0])}f;
   position.y *= ${number_of_cells[1]/float(boxsize[1])}f;
   position.z *= ${number_of_cells[2]/float(boxsize[2])}f;
-  return (int3)(min((int)position.x, NC.x-1), min((int)position.y, NC.y-1), min((int)position.z, NC.z-1));
+  // clamp to the grid, also particles outside the box (e.g. initial positions) get a valid hash.
+  return clamp((int3)((int)position.x, (int)position.y, (int)position.z), (int3)(0), NC-1);
 }
+% endif
 
+% if hash_mode == 'sparse':
+// spatial hash of the cell (Teschner et al. 2003), folded into the buckets of the hash table.
 inline uint getGridHash(int3 gridPos) {
-  return (gridPos.z * NC.z + gridPos.y) * NC.y + gridPos.x;
+  return (((uint)gridPos.x * 73856093u) ^ ((uint)gridPos.y * 19349663u) ^ ((uint)gridPos.z * 83492791u)) & ${number_of_hashes-1}u;
+}
+% elif hash_mode == 'morton':
+// spreads the lowest 10 bits of v apart, with two zero bits between each of them.
+inline uint spreadBits(uint v) {
+  v &= 0x3ff;
+  v = (v | (v << 16)) & 0x030000FF;
+  v = (v | (v << 8)) & 0x0300F00F;
+  v = (v | (v << 4)) & 0x030C30C3;
+  v = (v | (v << 2)) & 0x09249249;
+  return v;
+}
+
+// Morton (Z-order) code of the cell: the interleaved bits of x, y and z.
+// Cells close in any direction get close hashes, so their particles end up close in the sorted arrays.
+inline uint getGridHash(int3 gridPos) {
+  return spreadBits(gridPos.x) | (spreadBits(gridPos.y) << 1) | (spreadBits(gridPos.z) << 2);
+}
+% else:
+inline uint getGridHash(int3 gridPos) {
+  return (gridPos.z * NC.y + gridPos.y) * NC.x + gridPos.x;
+}
+% endif
+
+// grid hash of the particle with (unsorted) index at position p. the members of an ensemble hash to
+// separate ranges, so the sort groups the particles by member.
+inline uint getParticleHash(float3 p, uint index) {
+  % if ensemble:
+  return (index / ${member_size}u) * ${number_of_hashes}u + getGridHash(getGridPosition(p));
+  % else:
+  return getGridHash(getGridPosition(p));
+  % endif
 }
 
 __kernel void computeHash(__global float4 *position,
@@ -111,20 +207,114 @@ __kernel void computeHash(__global float4 *position,
 			  __constant Params *params
 			  ) {
   uint i = get_global_id(0);
+  if(i >= params->N) {
+    // padding up to the number of sorted hashes (see FluidSimulator.sort_length()), sorted to the end.
+    gridHash[i] = 0xFFFFFFFF;
+    gridIndex[i] = i;
+    return;
+  }
 
-  float3 p = as_float3(position[i]);
-  
-  int3 gridPos = getGridPosition(p);
-  gridHash[i] = getGridHash(gridPos);;
+  gridHash[i] = getParticleHash(as_float3(position[i]), i);
   gridIndex[i] = i;
 }
 
+// computeHash for the incremental sort: the particles are hashed in the order of the last sort
+// (gridIndex is kept from the previous step), so gridHash is almost sorted already.
+// Counts the descents (gridHash[i] > gridHash[i+1]) in *descents.
+__kernel void computeHashSorted(__global float4 *position,
+				__global uint *gridHash,
+				__global uint *gridIndex,
+				__global uint *descents,
+				__constant Params *params
+				) {
+  uint i = get_global_id(0);
+  uint N = params->N;
+  if(i >= N) return;
+
+  const uint index = gridIndex[i];
+  uint hash = getParticleHash(as_float3(position[index]), index);
+  gridHash[i] = hash;
+  // the hash of the next particle is computed again instead of synchronizing with its work-item.
+  if(i+1 < N && hash > getParticleHash(as_float3(position[gridIndex[i+1]]), gridIndex[i+1]))
+    atomic_inc(descents);
+}
+
+// Sorts the windows [offset + k*W, offset + (k+1)*W) of gridHash (and gridIndex along with it)
+// in local memory, using a bitonic sort. W = 2*get_local_size(0) must be a power of two.
+// Keys that are out of place by less than about W/2 positions end up in place after sorting
+// the windows once with offset 0 and once with offset W/2.
+__kernel void sortWindows(__global uint *gridHash,
+			  __global uint *gridIndex,
+			  uint offset,
+			  uint N,
+			  __local uint *localHash,
+			  __local uint *localIndex
+			  ) {
+  const uint lid = get_local_id(0);
+  const uint groupSize = get_local_size(0);
+  const uint W = 2*groupSize;
+  const uint start = offset + get_group_id(0)*W;
+
+  // pad the last window with the largest key, so that the padding stays at the end.
+  for(uint k = lid; k < W; k += groupSize) {
+    uint i = start + k;
+    localHash[k] = i < N ? gridHash[i] : 0xFFFFFFFF;
+    localIndex[k] = i < N ? gridIndex[i] : 0;
+  }
+
+  for(uint size = 2; size <= W; size <<= 1) {
+    for(uint stride = size/2; stride > 0; stride >>= 1) {
+      barrier(CLK_LOCAL_MEM_FENCE);
+      uint pos = 2*lid - (lid & (stride-1));
+      bool ascending = (lid & (size/2)) == 0;
+      uint a = localHash[pos], b = localHash[pos+stride];
+      if((a > b) == ascending) {
+	localHash[pos] = b;
+	localHash[pos+stride] = a;
+	uint t = localIndex[pos];
+	localIndex[pos] = localIndex[pos+stride];
+	localIndex[pos+stride] = t;
+      }
+    }
+  }
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  for(uint k = lid; k < W; k += groupSize) {
+    uint i = start + k;
+    if(i < N) {
+      gridHash[i] = localHash[k];
+      gridIndex[i] = localIndex[k];
+    }
+  }
+}
+
+// Counts the descents (gridHash[i] > gridHash[i+1]) in *descents, zero if gridHash is sorted.
+__kernel void countDescents(__global uint *gridHash,
+			    __global uint *descents,
+			    uint N
+			    ) {
+  uint i = get_global_id(0);
+  if(i+1 < N && gridHash[i] > gridHash[i+1])
+    atomic_inc(descents);
+}
+
 __kernel void memset(__global uint *d_Data, uint val, uint N) {
   uint i = get_global_id(0);
   if(i < N)
     d_Data[i] = val;
 }
 
+// Resets the starts of the cells occupied in the last step (the hashes of the last step are
+// still in gridHash), all other cell starts are still cleared from before.
+__kernel void clearOccupiedCells(__global uint *gridHash,
+				 __global uint *cellStart,
+				 __constant Params *params
+				 ) {
+  uint i = get_global_id(0);
+  if(i < params->N)
+    cellStart[gridHash[i]] = (uint)-1;
+}
+
 __kernel void reorderDataAndFindCellStart(__global uint *cellStart,
 					  __global uint *cellEnd,
 					  __global uint *gridHash,
@@ -153,9 +343,12 @@ __kernel void reorderDataAndFindCellStart(__global uint *cellStart,
     //First thread in block must load neighbor particle hash
     if(index > 0 && get_local_id(0) == 0)
       localHash[0] = gridHash[index - 1];
+  }
 
-    barrier(CLK_LOCAL_MEM_FENCE);
+  // all work-items of the group need to reach the barrier, also the ones past N.
+  barrier(CLK_LOCAL_MEM_FENCE);
 
+  if(index < N) {
     // If this particle has a different cell index to the previous
     // particle then it must be the first particle in the cell,
     // so store the index of this particle in the cell.
@@ -180,6 +373,64 @@ __kernel void reorderDataAndFindCellStart(__global uint *cellStart,
   }
 }
 
+% if neighbour_lists:
+// Lists the neighbours closer than h + skin of every particle (in sorted order, using the grid).
+// The k-th neighbour of particle i is neighbours[k*N + i], so that neighbouring work-items read
+// neighbouring elements. Lists longer than maxNeighbours are truncated, the largest number of
+// neighbours is written to *neighbourCountMax so that the host can notice and enlarge the lists.
+__kernel void buildNeighbourLists(__global float4 *position,
+				  __global uint *neighbours,
+				  __global uint *neighbourCount,
+				  __global uint *neighbourCountMax,
+				  uint maxNeighbours,
+				  __global uint *cellStart,
+				  __global uint *cellEnd,
+				  __constant Params *params
+				  ) {
+  uint i = get_global_id(0);
+  uint N = params->N;
+  if(i >= N) return;
+
+  const float3 x = as_float3(position[i]);
+  const float r2 = params->neighbourRadius2;
+  uint count = 0;
+
+  const int3 gridPos = getGridPosition(x);
+  <%self:loopcells>
+	const uint startIndex = cellStart[hash];
+	if (startIndex == (uint)-1) continue;
+	const uint endIndex = cellEnd[hash];
+	for(uint j = startIndex; j < endIndex; ++j) {
+	  const float3 d = x - as_float3(position[j]);
+	  if(dot(d, d) < r2) {
+	    if(count < maxNeighbours)
+	      neighbours[count*N + i] = j;
+	    count++;
+	  }
+	}
+  </%self:loopcells>
+  neighbourCount[i] = min(count, maxNeighbours);
+  if(count > *neighbourCountMax)
+    atomic_max(neighbourCountMax, count);
+}
+
+// Copies positions/velocities to the sorted order of the last sort (like reorderDataAndFindCellStart),
+// when the neighbour lists are reused.
+__kernel void reorderData(__global uint *gridIndex,
+			  __global float4 *position,
+			  __global float4 *positionSorted,
+			  __global float4 *velocity,
+			  __global float4 *velocitySorted,
+			  __constant Params *params
+			  ) {
+  const uint index = get_global_id(0);
+  if(index >= params->N) return;
+  uint sortedIndex = gridIndex[index];
+  positionSorted[index] = position[sortedIndex];
+  velocitySorted[index] = velocity[sortedIndex];
+}
+% endif
+
 % endif // use_grid
 
 __kernel void stepDensity(__global float4 *position
@@ -188,26 +439,32 @@ __kernel void stepDensity(__global float4 *position
 			  , __constant Params *params
 % if use_grid:
 			  , __global uint *gridIndex
+  % if neighbour_lists:
+			  , __global uint *neighbours
+			  , __global uint *neighbourCount
+  % else:
 			  , __global uint *cellStart
 			  , __global uint *cellEnd
+  % endif
 % endif
 			  ) {
   uint i = get_global_id(0);
   if(i >= params->N) return;
+  ${member('gridIndex[i]' if reorder else 'i')}
 
   float3 x = as_float3(position[i]);
   float _density = 0.f;
 
   <%self:loopneighbours>
     float3 x_j = as_float3(position[j]);
-    _density += kernelM4(vlen(x-x_j));
+    _density += kernelM4(vlen(x-x_j), params);
   </%self:loopneighbours>
 
   _density *= params->mass;
   
   density[i] = _density;
   
-  pressure[i] = max(0.f, ${k} * (_density - ${density0}));
+  pressure[i] = max(0.f, params->k * (_density - params->density0));
 }
 
 __kernel void stepForces(__global float4 *position
@@ -218,12 +475,18 @@ __kernel void stepForces(__global float4 *position
 			 , __constant Params *params
 % if use_grid:
 			 , __global uint *gridIndex
+  % if neighbour_lists:
+			 , __global uint *neighbours
+			 , __global uint *neighbourCount
+  % else:
 			 , __global uint *cellStart
 			 , __global uint *cellEnd
+  % endif
 % endif
 			 ) {
   uint i = get_global_id(0);
   if(i >= params->N) return;
+  ${member('gridIndex[i]' if reorder else 'i')}
   float3 x = as_float3(position[i]);
   float3 v = as_float3(velocity[i]);
   float _density = density[i];
@@ -240,13 +503,13 @@ __kernel void stepForces(__global float4 *position
       float _pressure_j = pressure[j];
       
       // pressure force
-      accel -= x_diff/len * (.5f * (_pressure + _pressure_j) / _density_j * kernelM4_d(len));
+      accel -= x_diff/len * (.5f * (_pressure + _pressure_j) / _density_j * kernelM4_d(len, params));
       
       // viscosity
-      const float v_coeff = ${viscosity}.f;
+      const float v_coeff = params->viscosity;
 
       // laplacian of Wviscosity as in Stefan Auer's thesis.
-      accel += (v - v_j) * (v_coeff / _density_j * kernelVisc_dd(len));
+      accel += (v - v_j) * (v_coeff / _density_j * kernelVisc_dd(len, params));
     }	
   </%self:loopneighbours>
       
@@ -262,16 +525,261 @@ __kernel void stepForces(__global float4 *position
   % endif
 }
 
+% if cell_kernels:
+// Cell-centric variants of stepDensity/stepForces: a work-group handles the particles of one cell
+// (get_group_id(0) is the cell hash). The particles of the 27 cells around it are staged through
+// __local memory in tiles of get_local_size(0) particles, so that each neighbour is read from
+// global memory once per cell instead of once per particle.
+
+// Finds the ranges of sorted particles in the cells around gridPos: range r starts at starts[r],
+// offsets[r] is the number of particles in the ranges before r, offsets[27] the total.
+void neighbourRanges(int3 gridPos, __global uint *cellStart, __global uint *cellEnd,
+		     __local uint *starts, __local uint *offsets) {
+  if(get_local_id(0) == 0) {
+    uint total = 0, r = 0;
+    for(int zi = gridPos.z-1; zi <= gridPos.z+1; zi++) {
+      for(int yi = gridPos.y-1; yi <= gridPos.y+1; yi++) {
+	for(int xi = gridPos.x-1; xi <= gridPos.x+1; xi++) {
+	  uint start = 0, count = 0;
+	  if(xi >= 0 && yi >= 0 && zi >= 0 && xi < NC.x && yi < NC.y && zi < NC.z) {
+	    const uint hash = getGridHash((int3)(xi,yi,zi));
+	    start = cellStart[hash];
+	    if(start != (uint)-1)
+	      count = cellEnd[hash] - start;
+	  }
+	  starts[r] = start;
+	  offsets[r] = total;
+	  total += count;
+	  r++;
+	}
+      }
+    }
+    offsets[27] = total;
+  }
+  barrier(CLK_LOCAL_MEM_FENCE);
+}
+
+// Sorted index of the e-th particle of the ranges found by neighbourRanges().
+inline uint neighbourIndex(uint e, __local uint *starts, __local uint *offsets) {
+  uint r = 0;
+  while(offsets[r+1] <= e)
+    r++;
+  return starts[r] + e - offsets[r];
+}
+
+__kernel void stepDensityCells(__global float4 *position
+			       , __global float *density
+			       , __global float *pressure
+			       , __constant Params *params
+			       , __global uint *cellStart
+			       , __global uint *cellEnd
+			       , __local float4 *tilePosition
+			       ) {
+  __local uint starts[27];
+  __local uint offsets[28];
+
+  const uint cell = get_group_id(0);
+  const uint start = cellStart[cell];
+  // the same for the whole work-group
+  if(start == (uint)-1) return;
+  const uint end = cellEnd[cell];
+  const uint lid = get_local_id(0), groupSize = get_local_size(0);
+
+  neighbourRanges(getGridPosition(as_float3(position[start])), cellStart, cellEnd, starts, offsets);
+  const uint total = offsets[27];
+
+  // if the cell has more particles than work-items, handle them in batches.
+  for(uint first = start; first < end; first += groupSize) {
+    const uint i = first + lid;
+    const float3 x = as_float3(position[min(i, end-1)]);
+    float _density = 0.f;
+
+    for(uint tile = 0; tile < total; tile += groupSize) {
+      barrier(CLK_LOCAL_MEM_FENCE);
+      if(tile + lid < total)
+	tilePosition[lid] = position[neighbourIndex(tile + lid, starts, offsets)];
+      barrier(CLK_LOCAL_MEM_FENCE);
+
+      const uint n = min(groupSize, total - tile);
+      for(uint k = 0; k < n; k++)
+	_density += kernelM4(vlen(x - as_float3(tilePosition[k])), params);
+    }
+
+    if(i < end) {
+      _density *= params->mass;
+      density[i] = _density;
+      pressure[i] = max(0.f, params->k * (_density - params->density0));
+    }
+  }
+}
+
+__kernel void stepForcesCells(__global float4 *position
+			      , __global float4 *velocity
+			      , __global float4 *acceleration
+			      , __global float *density
+			      , __global float *pressure
+			      , __constant Params *params
+			      , __global uint *gridIndex
+			      , __global uint *cellStart
+			      , __global uint *cellEnd
+			      , __local float4 *tilePosition
+			      , __local float4 *tileVelocity
+			      , __local float *tileDensity
+			      , __local float *tilePressure
+			      ) {
+  __local uint starts[27];
+  __local uint offsets[28];
+
+  const uint cell = get_group_id(0);
+  const uint start = cellStart[cell];
+  // the same for the whole work-group
+  if(start == (uint)-1) return;
+  const uint end = cellEnd[cell];
+  const uint lid = get_local_id(0), groupSize = get_local_size(0);
+
+  neighbourRanges(getGridPosition(as_float3(position[start])), cellStart, cellEnd, starts, offsets);
+  const uint total = offsets[27];
+
+  for(uint first = start; first < end; first += groupSize) {
+    const uint i = min(first + lid, end-1);
+    const float3 x = as_float3(position[i]);
+    const float3 v = as_float3(velocity[i]);
+    const float _density = density[i];
+    const float _pressure = pressure[i];
+    float3 accel = (float3)(0.f, 0.f, 0.f);
+
+    for(uint tile = 0; tile < total; tile += groupSize) {
+      barrier(CLK_LOCAL_MEM_FENCE);
+      if(tile + lid < total) {
+	const uint j = neighbourIndex(tile + lid, starts, offsets);
+	tilePosition[lid] = position[j];
+	tileVelocity[lid] = velocity[j];
+	tileDensity[lid] = density[j];
+	tilePressure[lid] = pressure[j];
+      }
+      barrier(CLK_LOCAL_MEM_FENCE);
+
+      const uint n = min(groupSize, total - tile);
+      for(uint k = 0; k < n; k++) {
+	float3 x_diff = x - as_float3(tilePosition[k]);
+	float len = vlen(x_diff);
+	if(len != 0.f) {
+	  float _density_j = tileDensity[k];
+	  // pressure force
+	  accel -= x_diff/len * (.5f * (_pressure + tilePressure[k]) / _density_j * kernelM4_d(len, params));
+	  // viscosity, laplacian of Wviscosity as in Stefan Auer's thesis.
+	  accel += (v - as_float3(tileVelocity[k])) * (params->viscosity / _density_j * kernelVisc_dd(len, params));
+	}
+      }
+    }
+
+    if(first + lid < end) {
+      accel *= params->mass / _density;
+      // gravity
+      accel.y -= 9.81f;
+      acceleration[gridIndex[i]] = as_float4(accel);
+    }
+  }
+}
+% endif
+
+// Compact copy of the particles for trajectories (see trajectory.py): positions as 16 bit fixed point
+// relative to the box, velocities as half floats, both without the w component.
+__kernel void quantizeState(__global float4 *position,
+			    __global float4 *velocity,
+			    __global ushort *positionQuantized,
+			    __global half *velocityQuantized,
+			    __constant Params *params
+			    ) {
+  uint i = get_global_id(0);
+  if(i >= params->N) return;
+  ${member('i')}
+  const float3 boxsize = (float3)(params->boxsize[0], params->boxsize[1], params->boxsize[2]);
+  const float3 x = clamp(as_float3(position[i]) / boxsize, 0.f, 1.f) * 65535.f;
+  vstore3(convert_ushort3_rte(x), i, positionQuantized);
+  vstore_half3(as_float3(velocity[i]), i, velocityQuantized);
+}
+
+// Splits the first nOwned particles of slab `slab` of a slab decomposition (see slabs.py) after a step:
+// the particles the slab still owns are appended to positionKept/velocityKept/idKept (count in counts[0]).
+// The particles that moved into another slab, and the copies of particles within haloWidth of a neighbouring
+// slab (its halo), are appended to positionOut/velocityOut/idOut (count in counts[1]), with their destination
+// in targetOut: 2*slab for particles owned by slab, 2*slab+1 for halo copies. Only the first capacityOut are
+// written, the host notices counts[1] > capacityOut and splits again with larger buffers.
+// Slab s owns [bounds[s], bounds[s+1]) along axis, the first and the last slab extend to infinity.
+__kernel void splitSlab(__global float4 *position,
+			__global float4 *velocity,
+			__global uint *id,
+			__global float4 *positionKept,
+			__global float4 *velocityKept,
+			__global uint *idKept,
+			__global float4 *positionOut,
+			__global float4 *velocityOut,
+			__global uint *idOut,
+			__global uint *targetOut,
+			__global uint *counts,
+			__constant float *bounds,
+			uint slab,
+			uint slabs,
+			uint axis,
+			float haloWidth,
+			uint nOwned,
+			uint capacityOut
+			) {
+  uint i = get_global_id(0);
+  if(i >= nOwned) return;
+
+  const float4 p = position[i];
+  const float4 v = velocity[i];
+  const float x = axis == 0 ? p.x : (axis == 1 ? p.y : p.z);
+  uint owner = 0;
+  while(owner + 1 < slabs && x >= bounds[owner + 1])
+    owner++;
+
+  uint targets[3];
+  uint count = 0;
+  if(owner == slab) {
+    const uint k = atomic_inc(&counts[0]);
+    positionKept[k] = p;
+    velocityKept[k] = v;
+    idKept[k] = id[i];
+  } else {
+    targets[count++] = 2*owner;
+  }
+  if(owner > 0 && x < bounds[owner] + haloWidth)
+    targets[count++] = 2*(owner-1) + 1;
+  if(owner + 1 < slabs && x >= bounds[owner + 1] - haloWidth)
+    targets[count++] = 2*(owner+1) + 1;
+
+  for(uint t = 0; t < count; t++) {
+    const uint k = atomic_inc(&counts[1]);
+    if(k < capacityOut) {
+      positionOut[k] = p;
+      velocityOut[k] = v;
+      idOut[k] = id[i];
+      targetOut[k] = targets[t];
+    }
+  }
+}
+
 __kernel void stepMove(__global float4 *position, 
 		       __global float4 *velocity, 
 		       __global float4 *acceleration, 
 		       __constant Params *params
+% if neighbour_lists:
+		       , __global float4 *positionBuild
+		       , __global uint *maxDisplacement
+% endif
 		       ) {
   uint i = get_global_id(0);
   if(i >= params->N) return;
+  ${member('i')}
   float3 x = as_float3(position[i]);
   float3 v = as_float3(velocity[i]);
   float3 a = as_float3(acceleration[i]);
+% if neighbour_lists:
+  const float3 x_old = x;
+% endif
   
   v += a * params->dt;
   x += v * params->dt;
@@ -292,7 +800,7 @@ __kernel void stepMove(__global float4 *position,
     v.z *= -damp;
   }
 
-  const int3 boxsize = (int3)(${'%i,%i,%i' % boxsize});
+  const float3 boxsize = (float3)(params->boxsize[0], params->boxsize[1], params->boxsize[2]);
   if(x.x > boxsize.x) {
     x.x = boxsize.x;
     v.x *= -damp;
@@ -306,6 +814,20 @@ __kernel void stepMove(__global float4 *position,
     v.z *= -damp;
   }
 
+% if neighbour_lists:
+  // largest squared distance moved since the neighbour lists were built (maxDisplacement[0]), and the
+  // largest squared distance moved in one step since then (maxDisplacement[1]).
+  // non-negative floats compare like their bit patterns as uints.
+  const float3 d = x - as_float3(positionBuild[i]);
+  const uint displacement = as_uint(dot(d, d));
+  if(displacement > maxDisplacement[0])
+    atomic_max(maxDisplacement, displacement);
+  const float3 s = x - x_old;
+  const uint stepDisplacement = as_uint(dot(s, s));
+  if(stepDisplacement > maxDisplacement[1])
+    atomic_max(maxDisplacement + 1, stepDisplacement);
+% endif
+
   position[i] = as_float4(x);
   velocity[i] = as_float4(v);
 }
@@ -1,30 +1,88 @@
 import pyopencl as cl
 
 import sys, os, struct
-from math import log, ceil
+from math import ceil
+from collections import deque
 
 import numpy as np
 
 from .radix_sort import RadixSort
+from .program_cache import build_program
+from .scene import dam_break
+from .device import DevicePolicy, describe_device
 
 class FluidSimulator(object):
-    def __init__(self, N, boxsize=(10,10,10), gl_interop=False):
-
-        # modify N here such that it is useful to set positions (see initialize_positions()).
-        # in this example, we make sure to have the right number of particles 
-        # to build one large and two smaller cubes (using not more particles than the user requested).
-        assert N > 270, "N must be larger than 270."
-        a = 0
-        while a**3 * 1.25 <= N: 
-            a += 2
-        N = ((a-2)**3 * 5) // 4
+    backends = ('opencl', 'numpy', 'auto')
+    sort_modes = ('radix', 'incremental')
+    hash_modes = ('linear', 'morton', 'sparse')
+    clear_modes = ('full', 'occupied')
+    # physical parameters, see set_params().
+    param_names = ('dt', 'mass', 'h', 'k', 'density0', 'viscosity', 'boxsize')
+    # number of independent simulations in the buffers, see ensemble.py.
+    members = 1
+    # whether the state can be copied on the device (enqueue_copy_state(), enqueue_quantize_state()).
+    state_on_device = True
+
+    def __init__(self, N, boxsize=(10,10,10), gl_interop=False, device_policy=None, backend='opencl', sort_mode='radix',
+                 profile=False, neighbour_lists=False, hash_mode='linear', cell_kernels=False, clear_mode='full',
+                 scene=None):
+        """
+        device_policy: DevicePolicy (or policy string like 'cpu') choosing the OpenCL device.
+        Defaults to the PYSPH_DEVICE environment variable, or a GPU with fallback to a CPU device.
+        backend: 'opencl', 'numpy' (reference implementation, see numpy_backend.py) or 'auto'
+        (opencl if a device is available, numpy otherwise).
+        sort_mode: how the particles are sorted by grid hash, 'radix' (full radix sort every step) or
+        'incremental' (fix up the order of the last step, see sort_incremental()).
+        profile: if True, the device start/end times of all kernels are recorded, see stats().
+        neighbour_lists: if True, the neighbours within h + neighbour_skin of every particle are listed and
+        the lists are reused until a particle moved more than neighbour_skin/2 (see update_neighbour_lists()).
+        hash_mode: how grid cells are numbered, 'linear' (row-major) or 'morton' (Z-order, neighbouring
+        cells in all directions get close hashes, so neighbours end up close together in the sorted arrays)
+        or 'sparse' (cells are hashed into a table of about 2N buckets, so memory and clearing the table scale
+        with N instead of the volume of the box).
+        cell_kernels: if True, the density and forces are computed by one work-group per grid cell, staging the
+        neighbouring particles in local memory (falls back to the per-particle kernels if the device has too
+        little local memory).
+        clear_mode: how the cell starts are reset before each sort, 'full' (clear the whole table) or
+        'occupied' (only clear the cells occupied in the last step, O(N) instead of O(number of cells)).
+        scene: Scene (see scene.py) holding the initial particles. The particle spacing (and with it the
+        particle mass and h) is chosen such that the scene holds exactly N particles. By default, the particles
+        start in one large and two smaller cubes (see scene.dam_break()).
+        """
+
+        assert N > 0, "N must be positive."
         self.N = N
+        self.scene = scene
         self.gl_interop = gl_interop
 
-        # set p2 to be the smallest power of 2 larger or equals than N
-        # needed for the current implementation of radix sort, which requires the arrays to be sorted to have
-        # lengths of powers of two.
-        self.p2 = 2**int(ceil(log(N)/log(2)))
+        assert backend in self.backends, "backend must be one of %s" % (self.backends,)
+        assert not (gl_interop and backend == 'numpy'), "gl interop needs the opencl backend"
+        self.backend = backend
+
+        assert sort_mode in self.sort_modes, "sort_mode must be one of %s" % (self.sort_modes,)
+        self.sort_mode = sort_mode
+        # incremental sort: fall back to the radix sort directly if more than this fraction of
+        # the hashes are out of order, instead of trying to fix them up in windows first.
+        self.incremental_sort_threshold = 0.01
+        # number of elements sorted by one work group when fixing up the order (a power of two).
+        self.sort_window = 512
+        # how often each path of the incremental sort was taken: the hashes were
+        # 'sorted' already, fixed up in 'windows', or sorted with the 'radix' sort.
+        self.sort_stats = {'sorted': 0, 'windows': 0, 'radix': 0}
+
+        assert clear_mode in self.clear_modes, "clear_mode must be one of %s" % (self.clear_modes,)
+        self.clear_mode = clear_mode
+
+        self.profile = profile
+        # kernel times are kept for the percentiles of the last profile_window launches of each kernel.
+        self.profile_window = 10000
+        self.reset_stats()
+
+        if device_policy is None:
+            device_policy = DevicePolicy.from_env()
+        elif isinstance(device_policy, str):
+            device_policy = DevicePolicy.from_string(device_policy)
+        self.device_policy = device_policy
 
         # gas constant
         self.k = 1000
@@ -39,19 +97,33 @@ class FluidSimulator(object):
         # if False, positions/velocities won't be reordered for better memory coherency.
         self.reorder = True 
 
-        # put all particles in a cube of length 0.5
-        self.spacing0 = 0.5*max(boxsize) / (N**(1/3.))
-        self.dt = 0.5 * self.spacing0 / self.k**0.5;
-        self.h = 2.000001 * self.spacing0; # h=2*intial spacing
-        
         # water rest density
         self.density0 = 1000
-        # particle mass
-        self.mass = self.spacing0**3 * self.density0
+        # initial spacing, timestep, h and particle mass
+        for name, value in self.initial_params(N, scene).items():
+            setattr(self, name, value)
 
-        # for grid based neighbour search
-        self.number_of_cells = tuple([int(ceil(boxsize/self.h)) for boxsize in self.boxsize]); # 1h is support of kernel
-        self.total_number_of_cells = self.number_of_cells[0] * self.number_of_cells[1] * self.number_of_cells[2]
+        assert not (neighbour_lists and cell_kernels), "neighbour lists and cell kernels can not be combined"
+        self.neighbour_lists = neighbour_lists
+        self.cell_kernels = cell_kernels
+        # work-group size of the cell kernels, also the number of neighbours staged in local memory at once.
+        # a cell holds about 8 particles at rest density, larger groups would mostly idle.
+        self.cell_wg_size = 16
+        # neighbour lists contain all particles closer than h + neighbour_skin.
+        self.neighbour_skin = 0.3 * self.h
+        # initial length of the lists, grows if a particle has more neighbours.
+        self.max_neighbours = 96
+        # how often the neighbour lists were built, and how often they were reused.
+        # overflows counts the builds that found more neighbours than fit into the lists (see check_neighbour_count()).
+        self.neighbour_list_stats = {'builds': 0, 'reuses': 0, 'overflows': 0}
+
+        assert hash_mode in self.hash_modes, "hash_mode must be one of %s" % (self.hash_modes,)
+        assert not (cell_kernels and hash_mode == 'sparse'), "cell kernels need a hash per cell, not the sparse hash table"
+        self.hash_mode = hash_mode
+        self.init_grid()
+
+        # number of steps simulated so far.
+        self.steps = 0
 
         # initialize positions on the cpu and later move them to the gpu
         self.position = np.ndarray((N, 4), dtype=np.float32)
@@ -73,59 +145,84 @@ class FluidSimulator(object):
 
         print('%i particles' % self.N)
         print('initial density: %s, mass: %s, gas constant k: %s, timestep: %s' % (self.density0, self.mass, self.k, self.dt))
-        print('%s %s cells' % (self.number_of_cells, self.total_number_of_cells))
+        if hash_mode == 'sparse':
+            print('%i hash table buckets' % self.number_of_hashes)
+        else:
+            print('%s %s cells' % (self.number_of_cells, self.total_number_of_cells))
+
+    def initial_params(self, N, scene):
+        """
+        The initial particle spacing of N particles in scene (the dam break if None), and the timestep dt,
+        h and particle mass for it, as a dictionary. Uses the gas constant k and density0.
+        """
+        if scene is None:
+            # put all particles in a cube of length 0.5
+            spacing0 = 0.5*max(self.boxsize) / (N**(1/3.))
+        else:
+            spacing0 = scene.spacing(N)
+        return {'spacing0': spacing0,
+                'dt': 0.5 * spacing0 / self.k**0.5,
+                # h=2*intial spacing
+                'h': 2.000001 * spacing0,
+                'mass': spacing0**3 * self.density0}
+
+    def init_grid(self, N=None, h=None):
+        """
+        Size the grid for the neighbour search of N particles (default self.N) with smoothing length h
+        (default self.h) and the box size.
+        """
+        N = self.N if N is None else N
+        h = self.h if h is None else h
+        # 1h is support of kernel. the neighbour lists need all particles within h + skin.
+        self.cell_size = h + self.neighbour_skin if self.neighbour_lists else h
+        self.number_of_cells = tuple([int(ceil(boxsize/self.cell_size)) for boxsize in self.boxsize]);
+        self.total_number_of_cells = self.number_of_cells[0] * self.number_of_cells[1] * self.number_of_cells[2]
+
+        if self.hash_mode == 'sparse':
+            # several cells can share a bucket of the table. the table has at least twice as many buckets
+            # as particles (a power of two), so few of the occupied cells collide.
+            self.number_of_hashes = 2**int(ceil(np.log2(2*N)))
+        elif self.hash_mode == 'morton':
+            assert max(self.number_of_cells) <= 1024, "morton hashes support up to 1024 cells per dimension"
+            # morton codes are not contiguous, but increase with each coordinate: the last cell has the largest one.
+            self.number_of_hashes = self.morton_code(*[n - 1 for n in self.number_of_cells]) + 1
+        else:
+            self.number_of_hashes = self.total_number_of_cells
+        # number of bits the radix sort needs to sort the grid hashes by (hashes are < number_of_hashes).
+        self.hash_bits = max(1, int(self.number_of_hashes - 1).bit_length())
+
+    @staticmethod
+    def morton_code(x, y, z):
+        """
+        Morton (Z-order) code of cell (x, y, z), same as getGridHash in sph.cl with hash_mode='morton'.
+        """
+        code = 0
+        for bit in range(10):
+            code |= ((x >> bit) & 1) << (3*bit)
+            code |= ((y >> bit) & 1) << (3*bit + 1)
+            code |= ((z >> bit) & 1) << (3*bit + 2)
+        return code
 
     def initialize_positions(self):
         """
         Initalize the initial positions/velocities of the particles.
         Using self.N particles.
         """
-        i = 0
-        position = self.position
-        spacing0 = self.spacing0
-
-        # arrange particles in one large and two small cubes
-        # (N needs to be a cubic number)
-        n = int((self.N/1.25)**(1/3.)+0.5)
-        for x in range(n):
-            for y in range(n):
-                for z in range(n):
-                    position[i, 0] = (x + 0.5) * spacing0
-                    position[i, 1] = (y + 0.5) * spacing0 + 0.01*self.boxsize[1]
-                    position[i, 2] = self.boxsize[2] - (z + 0.5) * spacing0
-                    position[i, 3] = 0
-                    i += 1
-
-        for x in range(n//2):
-            for y in range(n//2):
-                for z in range(n//2):
-                    position[i, 0] = (x + 0.5) * spacing0 + 0.01*self.boxsize[0]
-                    position[i, 1] = self.boxsize[1] - (y + 0.5) * spacing0 
-                    position[i, 2] = self.boxsize[2] - (z + 0.5) * spacing0
-                    position[i, 3] = 0
-                    i += 1
-
-        for x in range(n//2):
-            for y in range(n//2):
-                for z in range(n//2):
-                    position[i, 0] = self.boxsize[0] - (x + 0.5) * spacing0
-                    position[i, 1] = (y + 0.5) * spacing0 + 0.15*self.boxsize[1]
-                    position[i, 2] = (z + 0.5) * spacing0
-                    position[i, 3] = 0
-                    i += 1
+        scene = self.scene
+        if scene is None:
+            scene = dam_break(self.N, self.boxsize, self.spacing0)
+        self.position[:] = scene.positions(self.N, self.spacing0)
+        self.velocity[:] = 0
 
     def cl_pick_device(self):
-        for platform in cl.get_platforms():
-            for device in platform.get_devices():
-                if device.type == cl.device_type.GPU:
-                    return device
-        raise Exception("No suitable device found")
+        return self.device_policy.pick()
 
     def cl_init_context(self):
         """
         Define context and queue.
         """
-        device = self.cl_pick_device()
+        self.device = device = self.cl_pick_device()
+        print('using device %s' % describe_device(device))
         platform = device.platform
         additional_properties = []
         if self.gl_interop:
@@ -136,12 +233,29 @@ class FluidSimulator(object):
             self.ctx = cl.Context(properties=[(cl.context_properties.PLATFORM, platform)] + additional_properties)
         except:
             self.ctx = cl.Context(properties=[(cl.context_properties.PLATFORM, platform)] + additional_properties, devices=[device])
-        self.queue = cl.CommandQueue(self.ctx, device=device, properties=cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE)
+        properties = cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE
+        if self.profile:
+            properties |= cl.command_queue_properties.PROFILING_ENABLE
+        self.queue = cl.CommandQueue(self.ctx, device=device, properties=properties)
 
     def cl_init(self):
         """
         Initialize opencl context, queue and device buffers.
+        With the numpy backend, only the numpy backend is set up.
         """
+        if self.backend == 'auto':
+            try:
+                self.cl_pick_device()
+                self.backend = 'opencl'
+            except Exception as e:
+                print('no opencl device available (%s), using numpy backend' % e)
+                self.backend = 'numpy'
+
+        if self.backend == 'numpy':
+            from .numpy_backend import NumpyBackend
+            self.numpy_backend = NumpyBackend(self)
+            return
+
         if self.gl_interop:
             # create a opengl vertex buffer object we can can share the particle positions
             # with opengl (for rendering).
@@ -156,6 +270,13 @@ class FluidSimulator(object):
             self.position_vbo.unbind()
         else:
             self.cl_init_context()
+        if self.cell_kernels:
+            # tiles of position, velocity (float4), density and pressure (float), plus the neighbour ranges.
+            local_mem = self.cell_wg_size * (2*16 + 2*4) + 55*4
+            if local_mem > self.device.local_mem_size or self.cell_wg_size > self.device.max_work_group_size:
+                print('not enough local memory for the cell kernels, using the particle kernels')
+                self.cell_kernels = False
+
         # load opencl code
         cur_dir = os.path.dirname(os.path.abspath(__file__))
         from mako.template import Template
@@ -166,19 +287,29 @@ class FluidSimulator(object):
                 # it is compiled
                 use_grid=self.use_grid,
                 reorder=self.use_grid and self.reorder,
+                neighbour_lists=self.neighbour_lists,
+                hash_mode=self.hash_mode,
+                cell_kernels=self.cell_kernels,
                 local_hash_size=self.wg_size+1,
-                h=self.h,
                 number_of_cells=self.number_of_cells,
+                # hashes of one member of an ensemble (see ensemble.py), each member has its own range.
+                number_of_hashes=self.number_of_hashes // self.members,
+                cell_size=self.cell_size,
                 boxsize=self.boxsize,
-                density0=self.density0,
-                k=self.k,
-                viscosity=self.viscosity,
+                ensemble=self.members > 1,
+                member_size=self.N // self.members,
                 ))
-            self.prg = cl.Program(self.ctx, code).build()
+            self.prg = build_program(self.ctx, code)
+
+        assert not self.neighbour_lists or (self.use_grid and self.reorder), "neighbour lists need the grid and reordering"
+        assert not self.cell_kernels or (self.use_grid and self.reorder), "cell kernels need the grid and reordering"
 
-        self.radix_sort = RadixSort(self.ctx, self.queue, self.p2, np.uint32)
+        self.radix_sort = RadixSort(self.ctx, self.queue, self.N, np.uint32)
+        if self.profile:
+            self.radix_sort.event_callback = self.record_event
 
         self.cl_init_data()
+        self.cl_init_kernels()
 
 
     def cl_init_data(self):
@@ -195,12 +326,8 @@ class FluidSimulator(object):
         si = np.nbytes[np.uint32]
 
         # constant params made available to the kernels
-        # can be updated though by copying a new set of parameters to the device 
-        params = struct.pack('Iff',
-                             np.uint32(N),
-                             np.float32(self.dt),
-                             np.float32(self.mass))
-        self.params_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=params)
+        # can be updated though by copying a new set of parameters to the device, see set_params().
+        self.params_cl = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=self.pack_params())
 
 
         if self.gl_interop:
@@ -226,31 +353,319 @@ class FluidSimulator(object):
         self.velocity_sorted_cl = cl.Buffer(ctx, mf.READ_WRITE, size=4*N*sf)
         self.acceleration_cl = cl.Buffer(ctx, mf.READ_WRITE, size=4*N*sf)
 
-        p2 = self.p2
+        # grid_hash and grid_index will be sorted (exactly N elements).
+        # grid_index starts as the identity, the incremental sort starts from the order of the last sort.
+        self.grid_hash_cl = cl.Buffer(ctx, mf.READ_WRITE, size=N*si)
+        self.grid_index_cl = cl.Buffer(ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=np.arange(N, dtype=np.uint32))
+        # number of out of order hashes, see sort_incremental()
+        self.descents = np.zeros(1, dtype=np.uint32)
+        self.descents_cl = cl.Buffer(ctx, mf.READ_WRITE, size=si)
 
-        # grid_hash and grid_index will be sorted, and the sort algorithm can only sort arrays that have lengths that are powers of two.
-        # prefill grid_hash_cl with the largest uint32 (=unused) so that the ascending sort will make the unused elements end up at the end.
-        grid_hash_preset = np.zeros((p2, 1), dtype=np.uint32)
-        grid_hash_preset.fill(-1) # largest uint32
-        self.grid_hash_cl = cl.Buffer(ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=grid_hash_preset)
-        
-        self.grid_index_cl = cl.Buffer(ctx, mf.READ_WRITE, size=p2*si)
-        self.cell_start_cl = cl.Buffer(ctx, mf.READ_WRITE, size=self.total_number_of_cells*si)
-        self.cell_end_cl = cl.Buffer(ctx, mf.READ_WRITE, size=self.total_number_of_cells*si)
+        if self.neighbour_lists:
+            self.cl_init_neighbour_lists()
+            # positions when the neighbour lists were built, and the largest squared distance a particle
+            # moved since then and in one step since then (as the bits of float32s).
+            self.position_build_cl = cl.Buffer(ctx, mf.READ_WRITE, size=4*N*sf)
+            self.max_displacement_cl = cl.Buffer(ctx, mf.READ_WRITE, size=2*si)
+            # (event, host array, number of builds) of the non-blocking reads of max_displacement_cl after the
+            # last steps, and the largest distance a particle moved in one step, as last read.
+            self.displacement_reads = deque()
+            self.step_displacement = 0.
+            # the largest number of neighbours found when building the lists, and the event of its read.
+            self.neighbour_count_max = np.zeros(1, dtype=np.uint32)
+            self.neighbour_count_max_cl = cl.Buffer(ctx, mf.READ_WRITE, size=si)
+            self.neighbour_count_read = None
+            self.rebuild_neighbour_lists = True
+        # indexed by hash. with morton hashes, some entries do not belong to a cell and stay unused.
+        # with sparse hashes, an entry is a bucket of the hash table shared by all cells hashed to it.
+        self.cell_start_cl = cl.Buffer(ctx, mf.READ_WRITE, size=self.number_of_hashes*si)
+        self.cell_end_cl = cl.Buffer(ctx, mf.READ_WRITE, size=self.number_of_hashes*si)
+        # the cell starts are not initialized yet, the first assign_cells() clears all of them.
+        self.clear_all_cells = True
         
         self.queue.finish()
+        # event of the last enqueued command of the last step, see step().
+        self.last_event = None
+
+
+    def pack_params(self, params=None):
+        """
+        The Params struct of sph.cl for the current parameters, or for the parameters in the dictionary
+        params where given.
+        """
+        p = dict((name, getattr(self, name)) for name in self.param_names)
+        p.update(params or {})
+        h = p['h']
+        return struct.pack('Iff' 'fffff' 'fff' 'fff',
+                           self.N,
+                           p['dt'],
+                           p['mass'],
+                           h,
+                           2.546479089470325472 / h**3,
+                           2.546479089470325472 / h**5,
+                           -45. / (np.pi * h**5),
+                           (h + self.neighbour_skin)**2,
+                           p['k'],
+                           p['density0'],
+                           p['viscosity'],
+                           # the walls are at integer coordinates.
+                           *[int(b) for b in p['boxsize']])
+
+    def set_params(self, **params):
+        """
+        Change physical parameters between steps, e.g. set_params(viscosity=100, k=2000).
+        Possible parameters: dt, mass, h, k, density0, viscosity and boxsize.
+        The parameters are copied to the device, the program is not compiled again. The grid is kept,
+        so h may not grow beyond the cell size the grid was built for. If the box grows, particles outside
+        the grid share its outermost cells, which is correct but slow.
+        """
+        for name in params:
+            if name not in self.param_names:
+                raise ValueError('unknown parameter %s, must be one of %s' % (name, self.param_names))
+        h = params.get('h', self.h)
+        if self.use_grid and h + (self.neighbour_skin if self.neighbour_lists else 0) > self.cell_size:
+            raise ValueError('h=%s is too large for the grid (cell size %s), create a new FluidSimulator' % (h, self.cell_size))
+        if 'boxsize' in params:
+            params['boxsize'] = tuple(params['boxsize'])
+            assert len(params['boxsize']) == 3, "boxsize must have 3 elements"
+
+        for name, value in params.items():
+            setattr(self, name, value)
 
+        if self.backend == 'opencl' and hasattr(self, 'params_cl'):
+            self.last_event = cl.enqueue_copy(self.queue, self.params_cl, self.pack_params(), wait_for=self.wait_for_last())
+            self.last_event.wait()
+
+    def cl_init_neighbour_lists(self):
+        """
+        Allocate the neighbour lists for max_neighbours neighbours per particle.
+        neighbours[k*N + i] is the k-th neighbour of the particle with sorted index i.
+        """
+        si = np.nbytes[np.uint32]
+        self.neighbours_cl = cl.Buffer(self.ctx, cl.mem_flags.READ_WRITE, size=self.max_neighbours*self.N*si)
+        self.neighbour_count_cl = cl.Buffer(self.ctx, cl.mem_flags.READ_WRITE, size=self.N*si)
+
+    def cl_init_kernels(self):
+        """
+        Create the kernel objects and set their arguments once, so that enqueueing a step
+        does not rebuild argument lists.
+        """
+        prg = self.prg
+        wg_size = self.wg_size
+
+        def kernel(name, *args):
+            kernel = cl.Kernel(prg, name)
+            kernel.set_args(*args)
+            return kernel
+
+        # if we use a grid based neighbour search, we need to pass
+        # some additional arguments.
+        if self.neighbour_lists:
+            grid_args = [self.grid_index_cl,
+                         self.neighbours_cl,
+                         self.neighbour_count_cl]
+        elif self.use_grid:
+            grid_args = [self.grid_index_cl,
+                         self.cell_start_cl,
+                         self.cell_end_cl]
+        else:
+            grid_args = []
+        reordered = self.use_grid and self.reorder
+
+        if self.use_grid:
+            self.hash_kernel = kernel('computeHash',
+                                      self.position_cl,
+                                      self.grid_hash_cl,
+                                      self.grid_index_cl,
+                                      self.params_cl)
+            self.memset_kernel = kernel('memset',
+                                        self.cell_start_cl,
+                                        np.uint32(-1),
+                                        np.uint32(self.number_of_hashes))
+            self.memset_global_size = (int(ceil(self.number_of_hashes/float(wg_size)))*wg_size, )
+            self.clear_occupied_cells_kernel = kernel('clearOccupiedCells',
+                                                      self.grid_hash_cl,
+                                                      self.cell_start_cl,
+                                                      self.params_cl)
+            self.clear_descents_kernel = kernel('memset',
+                                                self.descents_cl,
+                                                np.uint32(0),
+                                                np.uint32(1))
+            self.hash_sorted_kernel = kernel('computeHashSorted',
+                                             self.position_cl,
+                                             self.grid_hash_cl,
+                                             self.grid_index_cl,
+                                             self.descents_cl,
+                                             self.params_cl)
+            self.count_descents_kernel = kernel('countDescents',
+                                                self.grid_hash_cl,
+                                                self.descents_cl,
+                                                np.uint32(self.N))
+            # the window is sorted by half as many work-items, limited by the device.
+            window = self.sort_window
+            while window > 2 and (window//2 > self.device.max_work_group_size or
+                                  2*window*np.nbytes[np.uint32] > self.device.local_mem_size):
+                window //= 2
+            self.sort_window = window
+            self.sort_windows_kernels = []
+            for offset in (0, window//2):
+                self.sort_windows_kernels.append(
+                    (kernel('sortWindows',
+                            self.grid_hash_cl,
+                            self.grid_index_cl,
+                            np.uint32(offset),
+                            np.uint32(self.N),
+                            cl.LocalMemory(window*np.nbytes[np.uint32]),
+                            cl.LocalMemory(window*np.nbytes[np.uint32])),
+                     (int(ceil((self.N-offset)/float(window)))*window//2, )))
+            self.reorder_kernel = kernel('reorderDataAndFindCellStart',
+                                         self.cell_start_cl,
+                                         self.cell_end_cl,
+                                         self.grid_hash_cl,
+                                         self.grid_index_cl,
+                                         self.position_cl,
+                                         self.position_sorted_cl,
+                                         self.velocity_cl,
+                                         self.velocity_sorted_cl,
+                                         self.params_cl)
+            self.reorder_global_size = (int(ceil(self.N/float(wg_size)))*wg_size, )
+
+        if self.cell_kernels:
+            # one work-group per hash (groups of hashes without particles return immediately).
+            cell_wg_size = self.cell_wg_size
+            self.density_kernel = kernel('stepDensityCells',
+                                         self.position_sorted_cl,
+                                         self.density_cl,
+                                         self.pressure_cl,
+                                         self.params_cl,
+                                         self.cell_start_cl,
+                                         self.cell_end_cl,
+                                         cl.LocalMemory(cell_wg_size*16))
+            self.forces_kernel = kernel('stepForcesCells',
+                                        self.position_sorted_cl,
+                                        self.velocity_sorted_cl,
+                                        self.acceleration_cl,
+                                        self.density_cl,
+                                        self.pressure_cl,
+                                        self.params_cl,
+                                        self.grid_index_cl,
+                                        self.cell_start_cl,
+                                        self.cell_end_cl,
+                                        cl.LocalMemory(cell_wg_size*16),
+                                        cl.LocalMemory(cell_wg_size*16),
+                                        cl.LocalMemory(cell_wg_size*4),
+                                        cl.LocalMemory(cell_wg_size*4))
+            self.step_sizes = ((self.number_of_hashes*cell_wg_size, ), (cell_wg_size, ))
+        else:
+            self.density_kernel = kernel('stepDensity',
+                                         self.position_sorted_cl if reordered else self.position_cl,
+                                         self.density_cl,
+                                         self.pressure_cl,
+                                         self.params_cl, *grid_args)
+            self.forces_kernel = kernel('stepForces',
+                                        self.position_sorted_cl if reordered else self.position_cl,
+                                        self.velocity_sorted_cl if reordered else self.velocity_cl,
+                                        self.acceleration_cl,
+                                        self.density_cl,
+                                        self.pressure_cl,
+                                        self.params_cl, *grid_args)
+            self.step_sizes = (self.global_size, self.local_size)
+        move_args = [self.position_build_cl, self.max_displacement_cl] if self.neighbour_lists else []
+        self.move_kernel = kernel('stepMove',
+                                  self.position_cl,
+                                  self.velocity_cl,
+                                  self.acceleration_cl,
+                                  self.params_cl, *move_args)
+
+        if self.neighbour_lists:
+            self.build_neighbour_lists_kernel = kernel('buildNeighbourLists',
+                                                       self.position_sorted_cl,
+                                                       self.neighbours_cl,
+                                                       self.neighbour_count_cl,
+                                                       self.neighbour_count_max_cl,
+                                                       np.uint32(self.max_neighbours),
+                                                       self.cell_start_cl,
+                                                       self.cell_end_cl,
+                                                       self.params_cl)
+            self.reorder_data_kernel = kernel('reorderData',
+                                              self.grid_index_cl,
+                                              self.position_cl,
+                                              self.position_sorted_cl,
+                                              self.velocity_cl,
+                                              self.velocity_sorted_cl,
+                                              self.params_cl)
+            self.clear_max_displacement_kernel = kernel('memset',
+                                                        self.max_displacement_cl,
+                                                        np.uint32(0),
+                                                        np.uint32(2))
+            self.clear_neighbour_count_max_kernel = kernel('memset',
+                                                           self.neighbour_count_max_cl,
+                                                           np.uint32(0),
+                                                           np.uint32(1))
 
     def step(self):
         """
         Advance simulation.
+        The step is only enqueued, use finish() (or advance()) to wait for it.
         """
-        prg = self.prg
+        self.steps += 1
+        if self.backend == 'numpy':
+            self.numpy_backend.step()
+            return
+
+        queue = self.queue
+
+        # the queue is out of order: instead of waiting for each kernel on the host,
+        # every kernel waits for the events of the kernels it depends on.
+        wait_for = self.wait_for_last()
+
+        if self.gl_interop:
+            wait_for = [cl.enqueue_acquire_gl_objects(queue, self.cl_gl_objects, wait_for=wait_for)]
+
+        event = self.enqueue_step(wait_for)
+
+        if self.gl_interop:
+            event = cl.enqueue_release_gl_objects(queue, self.cl_gl_objects, wait_for=[event])
+
+        self.last_event = event
+        if len(self.profile_events) > self.profile_window:
+            # do not let the events of steps nobody waits for pile up.
+            self.collect_profile()
+        return event
+
+    def advance(self, n_steps):
+        """
+        Advance simulation by n_steps. All steps are enqueued back to back (the gl objects
+        are only acquired/released once), then this waits for them to finish.
+        """
+        self.steps += n_steps
+        if self.backend == 'numpy':
+            for i in range(n_steps):
+                self.numpy_backend.step()
+            return
+
         queue = self.queue
+        wait_for = self.wait_for_last()
 
         if self.gl_interop:
-            cl.enqueue_acquire_gl_objects(queue, self.cl_gl_objects)
+            wait_for = [cl.enqueue_acquire_gl_objects(queue, self.cl_gl_objects, wait_for=wait_for)]
 
+        for i in range(n_steps):
+            wait_for = [self.enqueue_step(wait_for)]
+
+        if self.gl_interop:
+            wait_for = [cl.enqueue_release_gl_objects(queue, self.cl_gl_objects, wait_for=wait_for)]
+
+        if wait_for:
+            self.last_event = wait_for[0]
+            self.last_event.wait()
+        self.collect_profile()
+
+    def enqueue_step(self, wait_for=None):
+        """
+        Enqueue the kernels of one simulation step, without acquiring the gl objects.
+        Returns the event of the last kernel.
+        """
         ## one simulation step consists of four steps:
         ## step 1) assign particles to cells in the uniform grid
         ## step 2) compute densities
@@ -259,98 +674,385 @@ class FluidSimulator(object):
         ## for now, simple collision detection is done in the last step.
 
         # step 1)
-        if self.use_grid:
-            self.assign_cells()
+        if self.neighbour_lists:
+            wait_for = self.update_neighbour_lists(wait_for)
+        elif self.use_grid:
+            wait_for = [self.assign_cells(wait_for)]
 
         global_size = self.global_size
         local_size = self.local_size
 
-        # if we use a grid based neighbour search, we need to pass
-        # some additional arguments.
-        grid_args = [self.grid_index_cl,
-                     self.cell_start_cl,
-                     self.cell_end_cl] if self.use_grid else []
-
         # step 2)
-        prg.stepDensity(queue, global_size, local_size, 
-                        self.position_sorted_cl if self.use_grid and self.reorder else self.position_cl,
-                        self.density_cl,
-                        self.pressure_cl,
-                        self.params_cl, *grid_args).wait()
+        event = self.enqueue_kernel(self.density_kernel, *self.step_sizes, wait_for=wait_for)
 
         # step 3)
-        prg.stepForces(queue, global_size, local_size,
-                       self.position_sorted_cl if self.use_grid and self.reorder else self.position_cl,
-                       self.velocity_sorted_cl if self.use_grid and self.reorder else self.velocity_cl,
-                       self.acceleration_cl,
-                       self.density_cl,
-                       self.pressure_cl,
-                       self.params_cl, *grid_args).wait()
+        event = self.enqueue_kernel(self.forces_kernel, *self.step_sizes, wait_for=[event])
 
         # step 4)
-        prg.stepMove(queue, global_size, local_size,
-                     self.position_cl,
-                     self.velocity_cl,
-                     self.acceleration_cl,
-                     self.params_cl).wait()
+        event = self.enqueue_kernel(self.move_kernel, global_size, local_size, wait_for=[event])
 
-        if self.gl_interop:
-            cl.enqueue_release_gl_objects(queue, self.cl_gl_objects)
+        if self.neighbour_lists:
+            # read back how far the particles moved without waiting for it, update_neighbour_lists() decides
+            # on it one step later.
+            max_displacement = np.zeros(2, dtype=np.uint32)
+            read = cl.enqueue_copy(self.queue, max_displacement, self.max_displacement_cl, is_blocking=False,
+                                   wait_for=[event])
+            self.displacement_reads.append((read, max_displacement, self.neighbour_list_stats['builds']))
+        return event
 
-    def assign_cells(self):
+    def update_neighbour_lists(self, wait_for=None):
         """
-        Do some work so we can efficiently find neighbours using a grid.
+        Rebuild the neighbour lists if a particle may have moved more than neighbour_skin/2 since they were
+        built, no particle can have come closer than h to a particle not on its list then. Otherwise, only
+        the positions and velocities are copied to the sorted order of the lists.
+        The host does not wait for the last step (still running) to decide: it waits for the displacements
+        read back after the step before, and adds twice the largest distance a particle moved in one step
+        as a bound for the last step.
+        Returns the events to wait for before the density step.
         """
-        prg = self.prg
-        queue = self.queue
+        local_size = (self.wg_size, )
+        self.check_neighbour_count()
+        displacement = 0.
+        if len(self.displacement_reads) > 1:
+            read, max_displacement, builds = self.displacement_reads.popleft()
+            read.wait()
+            read_displacement, self.step_displacement = max_displacement.view(np.float32)**0.5
+            # if the lists were built in the last step, the particles only moved in that step.
+            if builds == self.neighbour_list_stats['builds']:
+                displacement = read_displacement
+        if not self.rebuild_neighbour_lists:
+            self.rebuild_neighbour_lists = displacement + 2*self.step_displacement > 0.5 * self.neighbour_skin
+        if not self.rebuild_neighbour_lists:
+            self.neighbour_list_stats['reuses'] += 1
+            return [self.enqueue_kernel(self.reorder_data_kernel, self.reorder_global_size, local_size, wait_for=wait_for)]
 
-        # compute hashes
+        self.neighbour_list_stats['builds'] += 1
+        self.rebuild_neighbour_lists = False
+        # sort particles into the grid
+        cells_event = self.assign_cells(wait_for)
 
-        prg.computeHash(queue, (self.N,), None,
-                        self.position_cl,
-                        self.grid_hash_cl,
-                        self.grid_index_cl,
-                        self.params_cl).wait()
-        
-        # sort particles based on hash, ascending.
-        self.radix_sort.sort(self.grid_hash_cl, self.grid_index_cl, self.p2)
+        # remember the positions the lists are built for
+        copy_event = cl.enqueue_copy(self.queue, self.position_build_cl, self.position_cl, wait_for=wait_for)
+        # the displacements of the last steps are still being read back.
+        reads = [read for read, max_displacement, builds in self.displacement_reads]
+        clear_event = self.enqueue_kernel(self.clear_max_displacement_kernel, local_size, local_size,
+                                          wait_for=(wait_for or []) + reads, name='memset(max_displacement)')
+
+        event = self.enqueue_kernel(self.clear_neighbour_count_max_kernel, local_size, local_size, wait_for=[cells_event],
+                                    name='memset(neighbour_count_max)')
+        event = self.enqueue_kernel(self.build_neighbour_lists_kernel, self.reorder_global_size, local_size, wait_for=[event])
+        # checked by the next step, see check_neighbour_count().
+        self.neighbour_count_read = cl.enqueue_copy(self.queue, self.neighbour_count_max, self.neighbour_count_max_cl,
+                                                    is_blocking=False, wait_for=[event])
+        return [event, copy_event, clear_event]
+
+    def check_neighbour_count(self):
+        """
+        Waits for the largest number of neighbours found by the last build of the lists (read back without
+        blocking). If it comes close to max_neighbours, the lists are enlarged and built again, before
+        they can overflow. If a list did overflow, it was truncated for one step (counted as an overflow in
+        neighbour_list_stats).
+        """
+        if self.neighbour_count_read is None:
+            return
+        self.neighbour_count_read.wait()
+        self.neighbour_count_read = None
+        count = int(self.neighbour_count_max[0])
+        if count > self.max_neighbours:
+            self.neighbour_list_stats['overflows'] += 1
+        if count > 0.8 * self.max_neighbours:
+            self.max_neighbours = int(ceil(count * 1.5))
+            self.cl_init_neighbour_lists()
+            self.cl_init_kernels()
+            self.rebuild_neighbour_lists = True
+
+    def enqueue_kernel(self, kernel, global_size, local_size, wait_for=None, name=None):
+        """
+        Enqueue a (pre-bound) kernel, recording its event for stats() if profiling, under name (default: the
+        name of the kernel function, a name tells apart uses of the same kernel like memset).
+        """
+        event = cl.enqueue_nd_range_kernel(self.queue, kernel, global_size, local_size, wait_for=wait_for)
+        if self.profile:
+            self.record_event(name or kernel.function_name, event)
+        return event
+
+    def record_event(self, name, event):
+        self.profile_events.append((name, event))
+
+    def collect_profile(self):
+        """
+        Wait for the recorded kernel events and add their device times to the statistics.
+        """
+        if not self.profile_events:
+            return
+        cl.wait_for_events([event for name, event in self.profile_events])
+        for name, event in self.profile_events:
+            ms = 1e-6 * (event.profile.end - event.profile.start)
+            if name not in self.kernel_times:
+                self.kernel_times[name] = {'count': 0, 'total': 0., 'recent': deque(maxlen=self.profile_window)}
+            times = self.kernel_times[name]
+            times['count'] += 1
+            times['total'] += ms
+            times['recent'].append(ms)
+        self.profile_events = []
+
+    def stats(self):
+        """
+        Device times (in ms) of the kernels launched so far, per kernel name (RadixSort kernels are prefixed
+        with 'RadixSort.'): count, mean, total, and p50/p99 over the last profile_window launches.
+        Needs profile=True. Waits for the enqueued kernels.
+        """
+        assert self.profile, "stats() needs FluidSimulator(..., profile=True)"
+        self.collect_profile()
+        stats = {}
+        for name, times in self.kernel_times.items():
+            recent = np.array(times['recent'])
+            stats[name] = {
+                'count': times['count'],
+                'mean': times['total'] / times['count'],
+                'p50': float(np.percentile(recent, 50)),
+                'p99': float(np.percentile(recent, 99)),
+                'total': times['total'],
+            }
+        return stats
+
+    def reset_stats(self):
+        """
+        Forget the kernel times recorded so far (e.g. after warming up).
+        """
+        self.profile_events = []
+        self.kernel_times = {}
+
+    def assign_cells(self, wait_for=None):
+        """
+        Do some work so we can efficiently find neighbours using a grid.
+        wait_for: events to wait for before reading the positions.
+        Returns the event of the last kernel.
+        """
+        local_size = (self.wg_size, )
+        if self.clear_mode == 'occupied' and not self.clear_all_cells:
+            # clear the cells of the last step. they are known from the hashes of the last step,
+            # so the hashes can only be computed again afterwards.
+            clear_event = self.enqueue_kernel(self.clear_occupied_cells_kernel, self.reorder_global_size, local_size,
+                                              wait_for=wait_for)
+            wait_for = [clear_event]
+        else:
+            # clear cell starts. independent of the sort, only needs to wait until the previous step is done reading them.
+            clear_event = self.enqueue_kernel(self.memset_kernel, self.memset_global_size, local_size, wait_for=wait_for)
+            # the cell starts are all cleared now, from here on only occupied cells need clearing.
+            self.clear_all_cells = False
+
+        # compute hashes and sort particles based on hash, ascending.
+        if self.sort_mode == 'incremental':
+            sort_event = self.sort_incremental(wait_for)
+        else:
+            sort_length = self.sort_length()
+            hash_event = self.enqueue_kernel(self.hash_kernel, (sort_length,), None, wait_for=wait_for)
+            sort_event = self.radix_sort.sort(self.grid_hash_cl, self.grid_index_cl, sort_length,
+                                              key_bits=self.hash_bits, wait_for=[hash_event])
 
-        
         # find cell start / cell end
-        global_size = (self.p2 - self.p2 % self.wg_size, )
+        return self.enqueue_kernel(self.reorder_kernel, self.reorder_global_size, local_size,
+                                   wait_for=[sort_event, clear_event])
+
+    def sort_length(self):
+        """
+        Number of hashes computed and sorted by the radix sort. Hashes past params.N are padding that is
+        sorted to the end (see computeHash), e.g. for a slab with a varying number of particles (see slabs.py).
+        """
+        return self.N
+
+    def sort_incremental(self, wait_for=None):
+        """
+        Compute the hashes in the order of the last sort and sort them, exploiting that particles
+        barely move between two steps: if only few hashes are out of order, the order is fixed up by
+        sorting windows of sort_window elements in local memory. The radix sort is only used if too many
+        hashes are out of order, or if the windows did not suffice. Counts the path taken in sort_stats.
+        Reads the number of out of order hashes back to the host, so this waits for the previous step.
+        Returns the event of the last kernel.
+        """
         local_size = (self.wg_size, )
 
-        prg.memset(queue, global_size, local_size,
-                   self.cell_start_cl,
-                   np.uint32(-1),
-                   np.uint32(self.total_number_of_cells)).wait()
-        
-        prg.reorderDataAndFindCellStart(queue, global_size, local_size,
-                                        self.cell_start_cl,
-                                        self.cell_end_cl,
-                                        self.grid_hash_cl,
-                                        self.grid_index_cl,
-                                        self.position_cl,
-                                        self.position_sorted_cl,
-                                        self.velocity_cl,
-                                        self.velocity_sorted_cl,
-                                        self.params_cl).wait()
+        event = self.enqueue_kernel(self.clear_descents_kernel, local_size, local_size, wait_for=wait_for,
+                                    name='memset(descents)')
+        event = self.enqueue_kernel(self.hash_sorted_kernel, self.reorder_global_size, local_size, wait_for=[event])
+        descents = self.read_descents(event)
+        if descents == 0:
+            self.sort_stats['sorted'] += 1
+            return event
+
+        if descents <= self.incremental_sort_threshold * self.N:
+            event = self.enqueue_kernel(self.clear_descents_kernel, local_size, local_size, wait_for=[event],
+                                        name='memset(descents)')
+            for kernel, global_size in self.sort_windows_kernels:
+                event = self.enqueue_kernel(kernel, global_size, (self.sort_window//2, ), wait_for=[event])
+            event = self.enqueue_kernel(self.count_descents_kernel, self.reorder_global_size, local_size, wait_for=[event])
+            if self.read_descents(event) == 0:
+                self.sort_stats['windows'] += 1
+                return event
+
+        self.sort_stats['radix'] += 1
+        return self.radix_sort.sort(self.grid_hash_cl, self.grid_index_cl, self.N,
+                                    key_bits=self.hash_bits, wait_for=[event])
+
+    def read_descents(self, event):
+        """
+        Copies the number of out of order hashes counted by the kernel of event to the host.
+        """
+        cl.enqueue_copy(self.queue, self.descents, self.descents_cl, wait_for=[event])
+        return int(self.descents[0])
 
     def get_position(self):
         """
         Copies the position buffer from device to host.
         """
+        if self.backend == 'numpy':
+            return self.position
         assert not self.gl_interop, "currently not working with gl interop"
-        cl.enqueue_copy(self.queue, self.position, self.position_cl)
+        cl.enqueue_copy(self.queue, self.position, self.position_cl, wait_for=self.wait_for_last())
         return self.position
 
+    def get_velocity(self):
+        """
+        Copies the velocity buffer from device to host.
+        """
+        if self.backend == 'numpy':
+            return self.velocity
+        cl.enqueue_copy(self.queue, self.velocity, self.velocity_cl, wait_for=self.wait_for_last())
+        return self.velocity
+
+    def enqueue_copy_state(self, position_cl, velocity_cl):
+        """
+        Enqueues copies of the positions and velocities to the device buffers position_cl and velocity_cl
+        (e.g. to read them to the host while the simulation goes on, see trajectory.py).
+        Works with gl interop. The next step waits for the copies. Returns the event of the copies.
+        """
+        return self.enqueue_reading_state(lambda wait_for: [
+                cl.enqueue_copy(self.queue, position_cl, self.position_cl, wait_for=wait_for),
+                cl.enqueue_copy(self.queue, velocity_cl, self.velocity_cl, wait_for=wait_for)])
+
+    def enqueue_quantize_state(self, position_quantized_cl, velocity_quantized_cl):
+        """
+        Like enqueue_copy_state(), but writes the positions as 16 bit fixed point relative to the box
+        (3 uint16 per particle) and the velocities as half floats (3 float16 per particle), see quantizeState.
+        """
+        kernel = cl.Kernel(self.prg, 'quantizeState')
+        kernel.set_args(self.position_cl, self.velocity_cl, position_quantized_cl, velocity_quantized_cl, self.params_cl)
+        return self.enqueue_reading_state(lambda wait_for: [
+                self.enqueue_kernel(kernel, self.global_size, self.local_size, wait_for=wait_for)])
+
+    def enqueue_reading_state(self, enqueue):
+        """
+        Calls enqueue(wait_for) to enqueue commands that read the positions/velocities after the last step,
+        acquiring the gl objects around them if needed. The next step waits for the commands.
+        Returns an event that completes with them.
+        """
+        queue = self.queue
+        wait_for = self.wait_for_last()
+        if self.gl_interop:
+            wait_for = [cl.enqueue_acquire_gl_objects(queue, self.cl_gl_objects, wait_for=wait_for)]
+        event = cl.enqueue_marker(queue, wait_for=enqueue(wait_for))
+        if self.gl_interop:
+            self.last_event = cl.enqueue_release_gl_objects(queue, self.cl_gl_objects, wait_for=[event])
+        else:
+            self.last_event = event
+        return event
+
+    def wait_for_last(self):
+        """
+        Wait list for commands that need the results of the last step.
+        (the queue is out of order, so commands do not implicitly wait for earlier ones).
+        """
+        return [self.last_event] if self.last_event is not None else None
+
+    def finish(self):
+        """
+        Block until all enqueued work is done.
+        """
+        if self.backend != 'numpy':
+            self.queue.finish()
+
     def set_positions(self):
         """
         Copies the positions (and velocities) from host to device
         """
-        self.position_vbo.set_array(self.position)
-        cl.enqueue_copy(self.queue, self.velocity_cl, self.velocity).wait()
-        
+        if self.backend == 'numpy':
+            # the numpy backend works on the host arrays.
+            return
+        if self.gl_interop:
+            self.position_vbo.set_array(self.position)
+        else:
+            cl.enqueue_copy(self.queue, self.position_cl, self.position, wait_for=self.wait_for_last())
+        self.last_event = cl.enqueue_copy(self.queue, self.velocity_cl, self.velocity, wait_for=self.wait_for_last())
+        self.last_event.wait()
+        if self.neighbour_lists:
+            self.rebuild_neighbour_lists = True
+
+    # parameters stored in checkpoints, besides the particles.
+    checkpoint_options = ('N', 'boxsize', 'sort_mode', 'hash_mode', 'neighbour_lists', 'cell_kernels', 'clear_mode')
+    checkpoint_params = ('dt', 'mass', 'h', 'k', 'density0', 'viscosity', 'spacing0', 'neighbour_skin')
+
+    def save_checkpoint(self, path):
+        """
+        Writes the simulation state (positions, velocities, number of steps) and all parameters to path,
+        an uncompressed .npz file. The file is replaced atomically, an interrupted save keeps the old checkpoint.
+        """
+        position = self.get_position()
+        velocity = self.get_velocity()
+        data = self.checkpoint_data()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, position=position, velocity=velocity, steps=self.steps, version=1, **data)
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+
+    def checkpoint_data(self):
+        """
+        The options and parameters save_checkpoint() stores besides the particles, as a dictionary.
+        """
+        return dict((name, getattr(self, name)) for name in self.checkpoint_options + self.checkpoint_params)
+
+    def load_checkpoint(self, path):
+        """
+        Restores the state and parameters saved by save_checkpoint(). N must be the same.
+        Before cl_init(), the grid is sized for the restored parameters. Afterwards, the parameters are
+        changed with set_params() (h can not grow beyond the cell size).
+        """
+        with np.load(path) as checkpoint:
+            if int(checkpoint['N']) != self.N:
+                raise ValueError('checkpoint %s has %i particles, not %i' % (path, int(checkpoint['N']), self.N))
+            params = dict((name, float(checkpoint[name])) for name in self.checkpoint_params)
+            params['boxsize'] = tuple(float(b) for b in checkpoint['boxsize'])
+            self.position[:] = checkpoint['position']
+            self.velocity[:] = checkpoint['velocity']
+            self.steps = int(checkpoint['steps'])
+
+        self.spacing0 = params.pop('spacing0')
+        self.neighbour_skin = params.pop('neighbour_skin')
+        if self.backend != 'numpy' and hasattr(self, 'prg'):
+            self.set_params(**params)
+            self.set_positions()
+        else:
+            for name, value in params.items():
+                setattr(self, name, value)
+            self.init_grid()
+
+    @classmethod
+    def from_checkpoint(cls, path, **kwargs):
+        """
+        Creates a FluidSimulator with the options (N, box size, sort/hash mode, ...) stored in the checkpoint
+        and loads it. kwargs are passed to the constructor, e.g. device_policy, or override the stored options.
+        Call cl_init() afterwards.
+        """
+        with np.load(path) as checkpoint:
+            # options missing in the checkpoint (e.g. saved by another class) keep their defaults.
+            options = dict((name, checkpoint[name].item()) for name in cls.checkpoint_options
+                           if name != 'boxsize' and name in checkpoint)
+            options['boxsize'] = tuple(float(b) for b in checkpoint['boxsize'])
+        options.update(kwargs)
+        fluid_simulator = cls(**options)
+        fluid_simulator.load_checkpoint(path)
+        return fluid_simulator
+
 if __name__ == '__main__':
     N = 10**3
     fluid_simulator = FluidSimulator(N)
@@ -0,0 +1,440 @@
+"""
+Writing trajectories (positions and velocities every K steps) of a running simulation.
+
+A trajectory file (TrajectoryWriter) is a .npy file holding an array of frames with the fields step, time,
+position (N, 3) and velocity (N, 3). It is preallocated for a number of frames, frames that were not written
+have step -1. Read it with np.load(path, mmap_mode='r') or Trajectory(path).
+
+A compact trajectory file (CompactTrajectoryWriter, read with CompactTrajectory) stores positions as 16 bit
+fixed point relative to the box and velocities as half floats, 12 bytes per particle instead of 24.
+Optionally, frames between key frames store the difference to the previous frame, compressed with zlib.
+The format (little endian):
+
+    header: magic 'SPHQ', version (uint32), N (uint32)
+    frame:  step (int64), time (float64), boxsize (3 float32), kind (uint8, 0 = key, 1 = delta),
+            payload size (uint32), payload
+    key payload: positions (N, 3) uint16, velocities (N, 3) float16
+    delta payload: zlib compressed positions minus positions of the previous frame (N, 3) uint16
+                   (modulo 2**16), velocities (N, 3) float16
+
+open_trajectory(path) opens a file of either format.
+"""
+import os
+import struct
+import threading
+import zlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import pyopencl as cl
+
+
+def frame_dtype(N):
+    return np.dtype([('step', np.int64),
+                     ('time', np.float64),
+                     ('position', np.float32, (N, 3)),
+                     ('velocity', np.float32, (N, 3))])
+
+
+class Slot(object):
+    """
+    Buffers for one frame in flight: device buffers the particles are copied to at the end of a step
+    (so that the simulation can go on), and pinned host buffers they are read into.
+    shapes and dtypes: of the position and velocity arrays of the frame.
+    """
+    def __init__(self, fluid_simulator, shapes, dtypes):
+        self.events = None
+        if fluid_simulator.backend == 'numpy':
+            self.position, self.velocity = [np.empty(shape, dtype=dtype) for shape, dtype in zip(shapes, dtypes)]
+            return
+
+        ctx, command_queue = fluid_simulator.ctx, fluid_simulator.queue
+        mf = cl.mem_flags
+        sizes = [int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in zip(shapes, dtypes)]
+        self.position_cl, self.velocity_cl = [cl.Buffer(ctx, mf.READ_WRITE, size=size) for size in sizes]
+        # ALLOC_HOST_PTR buffers are page-locked on most platforms, mapped once for the lifetime of the slot.
+        self.pinned = [cl.Buffer(ctx, mf.READ_WRITE | mf.ALLOC_HOST_PTR, size=size) for size in sizes]
+        self.position, self.velocity = [cl.enqueue_map_buffer(command_queue, buf, cl.map_flags.READ | cl.map_flags.WRITE,
+                                                              0, shape, dtype)[0]
+                                        for buf, shape, dtype in zip(self.pinned, shapes, dtypes)]
+
+    def enqueue_read(self, command_queue, wait_for):
+        """
+        Reads the device buffers into the pinned host buffers, without waiting.
+        """
+        self.events = [cl.enqueue_copy(command_queue, self.position, self.position_cl, is_blocking=False, wait_for=wait_for),
+                       cl.enqueue_copy(command_queue, self.velocity, self.velocity_cl, is_blocking=False, wait_for=wait_for)]
+        # the reads are not waited for by anything else, make sure the device starts them.
+        command_queue.flush()
+
+
+class TrajectoryWriter(object):
+    """
+    Writes frames of a simulation to a trajectory file without waiting for the disk.
+
+    capture() copies the particles on the device into one of ring_size slots, and reads them into pinned
+    host memory with non-blocking copies. The next simulation step only waits for the device copy. A
+    background thread waits for the read and writes the frame to the memory-mapped file. capture() only
+    blocks if all slots are still in flight.
+
+    n_frames: number of frames to write.
+    append: if True and path exists (e.g. when resuming from a checkpoint), the frames in it up to the current
+    step of the simulator are kept and the new frames are written after them. Frames of later steps were
+    written after the checkpoint and are dropped, the simulator writes them again.
+    """
+    def __init__(self, fluid_simulator, path, n_frames, ring_size=3, append=False):
+        if fluid_simulator.backend != 'numpy' and not fluid_simulator.state_on_device:
+            raise ValueError('%s can not copy its particles on the device, trajectories are not supported'
+                             % type(fluid_simulator).__name__)
+        self.fluid_simulator = fluid_simulator
+        self.path = path
+        self.n_frames = n_frames
+        self.append = append
+        self.frames_written = 0
+        self.open()
+
+        self.free_slots = queue.Queue()
+        for i in range(ring_size):
+            self.free_slots.put(self.make_slot())
+        # (slot, frame index, step, time) of the captured frames, None to stop the thread.
+        self.pending = queue.Queue()
+        self.error = None
+
+        self.thread = threading.Thread(target=self.write_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self):
+        N = self.fluid_simulator.N
+        if not (self.append and os.path.exists(self.path)):
+            self.frames = np.lib.format.open_memmap(self.path, mode='w+', dtype=frame_dtype(N), shape=(self.n_frames,))
+            self.frames['step'] = -1
+            return
+
+        old = Trajectory(self.path)
+        if old.N != N:
+            raise ValueError('trajectory %s has %i particles, not %i' % (self.path, old.N, N))
+        kept = int(np.searchsorted(old.steps, self.fluid_simulator.steps, side='right'))
+        self.frames_written = kept
+        self.n_frames += kept
+        # the file has no room for more frames: copy the kept ones into a larger file, which replaces it.
+        tmp_path = self.path + '.tmp'
+        self.frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=frame_dtype(N), shape=(self.n_frames,))
+        self.frames['step'] = -1
+        self.frames[:kept] = old.frames[:kept]
+        self.frames.flush()
+        del old
+        getattr(os, 'replace', os.rename)(tmp_path, self.path)
+
+    def make_slot(self):
+        N = self.fluid_simulator.N
+        return Slot(self.fluid_simulator, [(N, 4), (N, 4)], [np.float32, np.float32])
+
+    def capture(self):
+        """
+        Adds the current state of the simulation as the next frame.
+        """
+        self.check_error()
+        if self.n_frames is not None and self.frames_written >= self.n_frames:
+            raise ValueError('trajectory %s is full (%i frames)' % (self.path, self.n_frames))
+        fluid_simulator = self.fluid_simulator
+
+        slot = self.free_slots.get()
+        self.fill_slot(slot)
+        step = fluid_simulator.steps
+        self.pending.put((slot, self.frames_written, step, step * fluid_simulator.dt))
+        self.frames_written += 1
+
+    def fill_slot(self, slot):
+        fluid_simulator = self.fluid_simulator
+        if fluid_simulator.backend == 'numpy':
+            slot.position[:] = fluid_simulator.position
+            slot.velocity[:] = fluid_simulator.velocity
+        else:
+            copied = fluid_simulator.enqueue_copy_state(slot.position_cl, slot.velocity_cl)
+            slot.enqueue_read(fluid_simulator.queue, [copied])
+
+    def write_frames(self):
+        """
+        Background thread, writes the captured frames to the file as their copies complete.
+        """
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            slot, index, step, time = item
+            try:
+                if slot.events is not None:
+                    cl.wait_for_events(slot.events)
+                self.write_frame(slot, index, step, time)
+            except Exception as e:
+                self.error = e
+            self.free_slots.put(slot)
+
+    def write_frame(self, slot, index, step, time):
+        self.frames['position'][index] = slot.position[:, :3]
+        self.frames['velocity'][index] = slot.velocity[:, :3]
+        self.frames['time'][index] = time
+        # written last: frames with step -1 are incomplete.
+        self.frames['step'][index] = step
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Waits until all captured frames are written and closes the file.
+        """
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+            self.close_file()
+        self.check_error()
+
+    def close_file(self):
+        self.frames.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+MAGIC = b'SPHQ'
+VERSION = 1
+header_format = '<4sII'
+frame_header_format = '<qd3fBI'
+KEY, DELTA = 0, 1
+
+
+def quantize(position, velocity, boxsize):
+    """
+    NumPy version of quantizeState in sph.cl: (N, 3) uint16 positions and (N, 3) float16 velocities.
+    """
+    x = np.clip(position[:, :3] / np.asarray(boxsize, dtype=np.float32), 0, 1) * np.float32(65535)
+    return np.rint(x).astype(np.uint16), velocity[:, :3].astype(np.float16)
+
+
+class CompactTrajectoryWriter(TrajectoryWriter):
+    """
+    TrajectoryWriter for the compact format (see the top of this file). The particles are quantized on the
+    device, so only 12 bytes per particle are read back. Frames are appended, there is no frame limit.
+    delta: store frames as compressed differences to the previous frame, with a key frame every
+    keyframe_every frames (and whenever the box size changes).
+    append: see TrajectoryWriter. The first frame appended is a key frame.
+    """
+    def __init__(self, fluid_simulator, path, delta=False, keyframe_every=100, ring_size=3, append=False):
+        self.delta = delta
+        self.keyframe_every = keyframe_every
+        self.previous = None
+        self.previous_boxsize = None
+        TrajectoryWriter.__init__(self, fluid_simulator, path, None, ring_size, append)
+
+    def open(self):
+        N = self.fluid_simulator.N
+        if not (self.append and os.path.exists(self.path)):
+            self.file = open(self.path, 'wb')
+            self.file.write(struct.pack(header_format, MAGIC, VERSION, N))
+            return
+
+        old = CompactTrajectory(self.path)
+        if old.N != N:
+            raise ValueError('trajectory %s has %i particles, not %i' % (self.path, old.N, N))
+        kept = int(np.searchsorted(old.steps, self.fluid_simulator.steps, side='right'))
+        if kept:
+            offset, size = old.offsets[kept - 1]
+            end = offset + size
+        else:
+            end = struct.calcsize(header_format)
+        self.frames_written = kept
+        del old
+        # cut off the frames written after the checkpoint, and an incomplete last frame.
+        with open(self.path, 'r+b') as f:
+            f.truncate(end)
+        self.file = open(self.path, 'ab')
+
+    def make_slot(self):
+        N = self.fluid_simulator.N
+        return Slot(self.fluid_simulator, [(N, 3), (N, 3)], [np.uint16, np.float16])
+
+    def fill_slot(self, slot):
+        fluid_simulator = self.fluid_simulator
+        # the walls are at integer coordinates, like in stepMove.
+        slot.boxsize = [float(int(b)) for b in fluid_simulator.boxsize]
+        if fluid_simulator.backend == 'numpy':
+            slot.position[:], slot.velocity[:] = quantize(fluid_simulator.position, fluid_simulator.velocity, slot.boxsize)
+        else:
+            quantized = fluid_simulator.enqueue_quantize_state(slot.position_cl, slot.velocity_cl)
+            slot.enqueue_read(fluid_simulator.queue, [quantized])
+
+    def write_frame(self, slot, index, step, time):
+        position = slot.position
+        key = (not self.delta or self.previous is None or index % self.keyframe_every == 0
+               or slot.boxsize != self.previous_boxsize)
+        if key:
+            payload = position.tobytes() + slot.velocity.tobytes()
+        else:
+            # uint16 arithmetic wraps around, the reader adds the difference back modulo 2**16 as well.
+            payload = zlib.compress((position - self.previous).tobytes() + slot.velocity.tobytes(), 1)
+        if self.delta:
+            self.previous = position.copy()
+            self.previous_boxsize = slot.boxsize
+        self.file.write(struct.pack(frame_header_format, step, time, slot.boxsize[0], slot.boxsize[1], slot.boxsize[2],
+                                    KEY if key else DELTA, len(payload)))
+        self.file.write(payload)
+
+    def close_file(self):
+        self.file.close()
+
+
+class CompactTrajectory(object):
+    """
+    Reads a compact trajectory file, memory-mapped. frame(i) (or trajectory[i]) decodes the positions and
+    velocities of frame i as (N, 3) float32 arrays. steps and times are arrays over all frames.
+    An incomplete last frame (e.g. of an interrupted run) is ignored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        header_size = struct.calcsize(header_format)
+        magic, version, self.N = struct.unpack(header_format, self.data[:header_size].tobytes())
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a compact trajectory (version %i)' % (path, VERSION))
+
+        frame_header_size = struct.calcsize(frame_header_format)
+        offsets, steps, times, boxsizes, kinds = [], [], [], [], []
+        offset = header_size
+        while offset + frame_header_size <= len(self.data):
+            step, time, bx, by, bz, kind, size = struct.unpack(
+                frame_header_format, self.data[offset:offset + frame_header_size].tobytes())
+            offset += frame_header_size
+            if offset + size > len(self.data):
+                break
+            offsets.append((offset, size))
+            steps.append(step)
+            times.append(time)
+            boxsizes.append((bx, by, bz))
+            kinds.append(kind)
+            offset += size
+        self.offsets = offsets
+        self.steps = np.array(steps, dtype=np.int64)
+        self.times = np.array(times, dtype=np.float64)
+        self.boxsizes = np.array(boxsizes, dtype=np.float32).reshape(-1, 3)
+        self.kinds = np.array(kinds, dtype=np.uint8)
+
+        # the last decoded frame (index, quantized positions and velocities), to decode delta frames in order.
+        self.decoded_index = None
+        self.decoded = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return self.frame(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.frame(index)
+
+    def payload(self, index):
+        offset, size = self.offsets[index]
+        payload = self.data[offset:offset + size]
+        if self.kinds[index] == DELTA:
+            return np.frombuffer(zlib.decompress(payload.tobytes()), dtype=np.uint8)
+        return payload
+
+    def quantized(self, index):
+        """
+        Quantized positions ((N, 3) uint16) and half float velocities of frame index.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame %i out of range, %s has %i frames' % (index, self.path, len(self)))
+        if index == self.decoded_index:
+            return self.decoded
+        # delta frames are decoded from the last key frame before them, or the frame decoded before.
+        first = index
+        while self.kinds[first] == DELTA and first != self.decoded_index:
+            first -= 1
+        if first == self.decoded_index and self.kinds[index] == DELTA:
+            position = self.decoded[0]
+            first += 1
+        else:
+            position = None
+
+        n = 3 * self.N
+        for i in range(first, index + 1):
+            payload = self.payload(i)
+            quantized = np.frombuffer(payload[:2*n], dtype=np.uint16).reshape(self.N, 3)
+            position = quantized if self.kinds[i] == KEY else position + quantized
+        velocity = np.frombuffer(payload[2*n:4*n], dtype=np.float16).reshape(self.N, 3)
+
+        self.decoded_index = index
+        self.decoded = position, velocity
+        return self.decoded
+
+    def frame(self, index):
+        """
+        Positions and velocities of frame index as (N, 3) float32 arrays.
+        """
+        position, velocity = self.quantized(index)
+        position = position.astype(np.float32) * (self.boxsizes[index] / np.float32(65535))
+        return position, velocity.astype(np.float32)
+
+
+class Trajectory(object):
+    """
+    Reads a trajectory file written by TrajectoryWriter, memory-mapped, with the same interface as
+    CompactTrajectory. Frames that were not written (step -1, e.g. of an interrupted run) are ignored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.frames = np.load(path, mmap_mode='r')
+        if self.frames.dtype.names != frame_dtype(0).names:
+            raise ValueError('%s is not a trajectory file' % path)
+        self.N = self.frames.dtype['position'].shape[0]
+        # the frames are written in order, the first unwritten frame ends the trajectory.
+        steps = np.array(self.frames['step'])
+        unwritten = np.flatnonzero(steps < 0)
+        n_frames = unwritten[0] if len(unwritten) else len(steps)
+        self.steps = steps[:n_frames]
+        self.times = np.array(self.frames['time'][:n_frames])
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, index):
+        return self.frame(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.frame(index)
+
+    def frame(self, index):
+        """
+        Positions and velocities of frame index as (N, 3) float32 arrays (views of the mapped file).
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame %i out of range, %s has %i frames' % (index, self.path, len(self)))
+        frame = self.frames[index]
+        return frame['position'], frame['velocity']
+
+
+def open_trajectory(path):
+    """
+    Opens a trajectory file of either format (Trajectory or CompactTrajectory, told apart by the magic).
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        return CompactTrajectory(path)
+    return Trajectory(path)
@@ -1,35 +1,52 @@
 from sph import FluidSimulator
+from sph.replay import TrajectoryPlayer
 
 from OpenGL.GL import *
 import base_demo
 
 class SPHDemo(base_demo.BaseDemo):
     
-    def __init__(self, N=1000, size=(800,800), enable_advanced_rendering=True):
+    def __init__(self, N=1000, size=(800,800), enable_advanced_rendering=True, smoothing_downsample=1, smoothing_budget_ms=None,
+                 replay=None):
         """
         enable_advanced_rendering: if False, disable advanced rendering using Cg (balls/advanced rendering).
+        smoothing_downsample, smoothing_budget_ms: see FluidRenderer.
+        replay: path of a recorded trajectory to play back instead of simulating (N is taken from the file).
         """
         super(SPHDemo, self).__init__(size=size)
         
-        self.N = N
-
         self.initrans = [-6., -4., -20.]
 
-        # box size in x, y and z dimension.
-        self.boxsize = (10, 10, 10)
-        self.fluid_simulator = FluidSimulator(self.N, self.boxsize, gl_interop=True)
+        self.replay = replay
+        if replay is not None:
+            # the player stands in for the fluid simulator, the renderers use the same attributes.
+            self.fluid_simulator = TrajectoryPlayer(replay)
+            self.N = self.fluid_simulator.N
+            self.boxsize = self.fluid_simulator.boxsize
+        else:
+            self.N = N
+            # box size in x, y and z dimension.
+            self.boxsize = (10, 10, 10)
+            self.fluid_simulator = FluidSimulator(self.N, self.boxsize, gl_interop=True)
         self.framerate = 60
 
         self.enable_advanced_rendering = enable_advanced_rendering
+        self.smoothing_downsample = smoothing_downsample
+        self.smoothing_budget_ms = smoothing_budget_ms
 
     def glinit(self):
         super(SPHDemo, self).glinit()
 
         # fluid simulator needs vertex buffer objects, this is why this needs to be initialized here    
-        self.fluid_simulator.cl_init()
+        if self.replay is not None:
+            self.fluid_simulator.gl_init()
+        else:
+            self.fluid_simulator.cl_init()
         if self.enable_advanced_rendering:
             from fluid_rendering.fluid_renderer import FluidRenderer
-            self.fluid_renderer = fluid_renderer = FluidRenderer(self.size, self.fluid_simulator, self.projection_matrix)
+            self.fluid_renderer = fluid_renderer = FluidRenderer(self.size, self.fluid_simulator, self.projection_matrix,
+                                                                 smoothing_downsample=self.smoothing_downsample)
+            fluid_renderer.smoothing_budget_ms = self.smoothing_budget_ms
 
         class Params(object):
             def __init__(self, **kwargs):
@@ -135,15 +152,17 @@ class SPHDemo(base_demo.BaseDemo):
         self.render_box()
 
         ## do the simulation
-        if not self.params.paused:
+        if not self.params.paused and self.replay is not None:
+            # one recorded frame per rendered frame, skipped if the next frame is not decoded yet.
+            self.fluid_simulator.next_frame()
+        elif not self.params.paused:
             # n = 1/(30 * dt), if exectuted n times, we would simulate one second of physics in 30 frames.
             # i.e., if we screenshoted this and made a movie at framerate 30 fps, we would have a real time simulation.
             # TODO: since this number is rounded, it is not entirely accurate.
             # improve with the method explained here: http://gafferongames.com/game-physics/fix-your-timestep/
 
-            for i in range(int(1/(self.framerate*self.fluid_simulator.dt))):
-               self.fluid_simulator.step()
-            #self.fluid_simulator.step()
+            # the steps are enqueued back to back, advance() waits for them before opengl reads the positions.
+            self.fluid_simulator.advance(int(1/(self.framerate*self.fluid_simulator.dt)))
 
         ## render particles
         self.mouse_transform()